@@ -1,4 +1,24 @@
-from .driver import Driver
+import importlib
+from .driver import Driver, AsyncDriver
 from .listener import Listener
-from .plotter import Plotter
-from .plotter import tools
+
+# Plotter and tools pull in plotly, spym, xarray, scipy, cv2 and matplotlib, so they are imported on
+# first access and a script that only drives R9 does not pay for them
+LAZY = {
+    'Plotter': ('.plotter', 'Plotter'),
+    'tools': ('.plotter.tools', None),
+}
+
+
+def __getattr__(name: str):
+    if name not in LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    module_name, attribute = LAZY[name]
+    module = importlib.import_module(module_name, __name__)
+    value = module if attribute is None else getattr(module, attribute)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(list(globals()) + list(LAZY))
@@ -0,0 +1,207 @@
+import dataclasses
+from typing import List, Tuple
+import json
+import os
+import re
+import threading
+import time
+import numpy as np
+from xarray.core.dataarray import DataArray
+from ..driver import Driver
+from ..plotter import Plotter
+from ..plotter import tools
+
+SAVE_NAME = re.compile(r'^(.*?)\d*(\.sm4)?$', re.IGNORECASE)
+NM = 1e-9  # (m) R9 offsets are in m, image coordinates in nm
+
+
+@dataclasses.dataclass
+class DriftCompensator:
+    # Background drift compensation. Every frame R9 saves (File Name Index increments) is registered against
+    # the reference frame. The drift of the sample is the measured image shift plus the offset correction
+    # that was applied during the frame. A weighted linear fit of the last fit_frames drifts gives the drift
+    # velocity. X/Y Offset then follow the fit feed-forward: once per frame, or every update_interval
+    # seconds (e.g. the line time) while the next frame is scanned.
+    # Give it its own Driver, a Driver is not safe to share between threads.
+    driver: Driver
+    plotter: Plotter = None  # loads the saved frames; by default one on the R9 save path and file name
+    reference: int = None  # file index of the reference frame, default the first frame saved after start()
+    update_interval: float = None  # (s) feed-forward period between frames, None corrects once per frame
+    poll_interval: float = 1.0  # (s)
+    fit_frames: int = 5  # frames in the drift velocity fit
+    axis_signs: Tuple[float, float] = (1.0, 1.0)  # image x/y direction relative to X/Y Offset
+    max_velocity: float = 0.5  # (nm/s) a larger fitted velocity is clipped to this
+    max_step: float = 5.0  # (nm) largest change of an offset in one correction
+    max_total: float = 50.0  # (nm) largest distance of the offsets from the reference offsets
+    min_step: float = 0.01  # (nm) smaller corrections are not sent
+    max_sigma: float = 1.0  # (nm) frames registered with a larger uncertainty are ignored
+    upsample: int = 20
+    log_file: str = None  # JSON lines file receiving every log entry
+    samples: List[dict] = dataclasses.field(init=False, default_factory=list)
+    log: List[dict] = dataclasses.field(init=False, default_factory=list)
+    velocity: np.ndarray = dataclasses.field(init=False, default=None)
+    thread: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self._stop = threading.Event()
+        self._reference = None  # (spectrum, pixel size (nm), shape) of the reference frame
+        self._offset_reference = None  # (m) X/Y Offset when the reference frame was scanned
+        self._offsets = []  # (time, x, y) of every offset sent, (m)
+        self._fit = None  # (time, drift (nm), velocity (nm/s)) of the last fit
+        return
+
+    def load(self, index: int) -> DataArray:
+        # Leveled topography of a saved frame
+        self.plotter.load_file(index)
+        self.plotter.load_image()
+        return self.plotter.data_topo
+
+    def _open_plotter(self) -> None:
+        path_dir = self.driver.get_save_path().strip()
+        prefix = SAVE_NAME.match(os.path.basename(self.driver.get_save_name().strip())).group(1)
+        self.plotter = Plotter(False, path_dir, prefix, prefix)
+        return
+
+    def _mean_offset(self, start: float, end: float) -> np.ndarray:
+        # Time average of the offsets over [start, end] (m); the offsets hold their value until the next one is sent
+        times = np.array([entry[0] for entry in self._offsets])
+        values = np.array([entry[1:] for entry in self._offsets])
+        if end <= start:
+            return values[max(np.searchsorted(times, end, side='right') - 1, 0)]
+        edges = np.concatenate([[start], times[(times > start) & (times < end)], [end]])
+        which = np.maximum(np.searchsorted(times, edges[:-1], side='right') - 1, 0)
+        return (values[which] * np.diff(edges)[:, None]).sum(axis=0) / (end - start)
+
+    def measure(self, index: int, start: float, end: float) -> dict:
+        # Registers frame index, scanned between start and end, and adds its sample drift to samples
+        image = self.load(index)
+        spectrum = tools.image_spectrum(image.values)
+        size = tools.pixel_size(image)
+        if self._reference is None:
+            self._reference = (spectrum, size, image.shape)
+            shift, sigma = np.zeros(2), np.zeros(2)
+        elif image.shape != self._reference[2] or not np.allclose(size, self._reference[1]):
+            print(f'Frame {index} differs in size from the reference, skipped')
+            return None
+        else:
+            shift, sigma, _ = tools.phase_correlation(self._reference[0], spectrum, self.upsample, 0.0)
+            shift = shift[::-1] * size * self.axis_signs
+            sigma = sigma[::-1] * np.abs(size)
+            if np.any(sigma > self.max_sigma):
+                print(f'Frame {index} not registered (uncertainty {sigma.max():.3f} nm), skipped')
+                return None
+        # Features move by the drift minus the offset correction made since the reference frame
+        applied = (self._mean_offset(start, end) - self._offset_reference) / NM
+        drift = shift + applied
+        sample = dict(index=index, time=(start + end) / 2, dx=float(drift[0]), dy=float(drift[1]), sigma_x=float(sigma[0]), sigma_y=float(sigma[1]))
+        self.samples.append(sample)
+        return sample
+
+    def fit(self) -> None:
+        # Weighted linear fit of the drift of the last fit_frames frames
+        samples = self.samples[-self.fit_frames:]
+        times = np.array([sample['time'] for sample in samples])
+        drift = np.array([[sample['dx'], sample['dy']] for sample in samples])
+        sigma = np.array([[sample['sigma_x'], sample['sigma_y']] for sample in samples])
+        if len(samples) < 2:
+            self.velocity = np.zeros(2)
+            self._fit = (times[-1], drift[-1], self.velocity)
+            return
+        weights = 1 / np.maximum(sigma, self.min_step)
+        t0 = times[-1]
+        velocity, position = np.zeros(2), np.zeros(2)
+        for axis in range(2):
+            velocity[axis], position[axis] = np.polyfit(times - t0, drift[:, axis], 1, w=weights[:, axis])
+        if np.any(np.abs(velocity) > self.max_velocity):
+            print(f'Drift velocity {velocity} nm/s clipped to {self.max_velocity} nm/s')
+            velocity = np.clip(velocity, -self.max_velocity, self.max_velocity)
+        self.velocity = velocity
+        self._fit = (t0, position, velocity)
+        return
+
+    def correct(self, index: int = None) -> dict:
+        # Moves the offsets to the reference offsets plus the drift predicted for now, within the limits
+        now = time.monotonic()
+        t0, position, velocity = self._fit
+        target = position + velocity * (now - t0)
+        current = np.array(self._offsets[-1][1:])
+        step = target - (current - self._offset_reference) / NM
+        clipped = bool(np.any(np.abs(step) > self.max_step))
+        step = np.clip(step, -self.max_step, self.max_step)
+        total = (current - self._offset_reference) / NM + step
+        clipped |= bool(np.any(np.abs(total) > self.max_total))
+        total = np.clip(total, -self.max_total, self.max_total)
+        offset = self._offset_reference + total * NM
+        if np.all(np.abs(offset - current) / NM < self.min_step):
+            return None
+        with self.driver.batch() as batch:
+            self.driver.set_x_offset(offset[0])
+            self.driver.set_y_offset(offset[1])
+        if not all(reply.ok for reply in batch.replies):
+            print(f'Offset correction not applied: {[reply.error for reply in batch.replies]}')
+            return None
+        self._offsets.append((now, offset[0], offset[1]))
+        entry = dict(
+            time=time.time(),
+            index=index,
+            x_offset=float(offset[0]),
+            y_offset=float(offset[1]),
+            dx=float(target[0]),
+            dy=float(target[1]),
+            vx=float(velocity[0]),
+            vy=float(velocity[1]),
+            clipped=clipped,
+        )
+        self.log.append(entry)
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def run(self) -> List[dict]:
+        self._stop.clear()
+        if self.plotter is None:
+            self._open_plotter()
+        self._offset_reference = np.array([self.driver.get_x_offset(), self.driver.get_y_offset()])
+        self._offsets = [(time.monotonic(), *self._offset_reference)]
+        if self.reference is not None:
+            now = time.monotonic()
+            self.measure(self.reference, now, now)
+        index = int(float(self.driver.get_save_index()))
+        frame_start = time.monotonic()
+        last_update = frame_start
+        while not self._stop.is_set():
+            saved = int(float(self.driver.get_save_index()))
+            now = time.monotonic()
+            if saved != index:
+                # R9 saves under the index read before the scan, so the new frame is saved - 1
+                try:
+                    sample = self.measure(saved - 1, frame_start, now)
+                except (ValueError, OSError) as e:
+                    print(f'Frame {saved - 1} not loaded: {e}')
+                    sample = None
+                index = saved
+                frame_start = now
+                if sample is not None:
+                    print(f"Drift of frame {sample['index']}: ({sample['dx']:.3f}, {sample['dy']:.3f}) nm")
+                    self.fit()
+                    self.correct(sample['index'])
+                    last_update = time.monotonic()
+            elif self.update_interval is not None and self._fit is not None and now - last_update >= self.update_interval:
+                self.correct()
+                last_update = now
+            self._stop.wait(self.poll_interval if self.update_interval is None else min(self.poll_interval, self.update_interval))
+        return self.log
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self) -> None:
+        self._stop.set()
+        return
+
+    def join(self, timeout: float = None) -> None:
+        self.thread.join(timeout)
+        return
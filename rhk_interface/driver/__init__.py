@@ -1,8 +1,12 @@
 import dataclasses
 from typing import List, Tuple
+import select
 import socket
 import time
 import numpy as np
+from .batch import Batch, Reply
+from .async_driver import AsyncDriver
+from ..metrics import Metrics
 
 
 @dataclasses.dataclass
@@ -10,43 +14,347 @@ class Driver:
     IP_Address_R9_PC: str
     TCP_Port_R9s: int
     BUFFER_SIZE: int = 4096
+    persistent: bool = False
+    interval: float = 0.0  # (s) delay between commands in a persistent session
+    cache: bool = False
+    cache_ttl: float = 5.0  # (s) how long a read value is served from the cache
+    metrics: Metrics = None
     response: str = dataclasses.field(init=False, default=None)
+    s: socket.socket = dataclasses.field(init=False, default=None, repr=False)
+    retry_count: int = dataclasses.field(init=False, default=0)
+    reconnect_count: int = dataclasses.field(init=False, default=0)
+    cache_hits: int = dataclasses.field(init=False, default=0)
+    cache_misses: int = dataclasses.field(init=False, default=0)
+    _cache: dict = dataclasses.field(init=False, default_factory=dict, repr=False)
+    _buffer: bytearray = dataclasses.field(init=False, default=None, repr=False)
+    _buffered: int = dataclasses.field(init=False, default=0, repr=False)
+    _batch: Batch = dataclasses.field(init=False, default=None, repr=False)
+    _opened_from: bool = dataclasses.field(init=False, default=None, repr=False)  # persistent before open()
     RETRY = 5
+    TIMEOUT = 10.0  # (s)
+    TERMINATOR = b'\n'  # End of each R9 reply
+    IDLE_GAP = None  # (s) if set, a reply without TERMINATOR also ends when R9 sends nothing for this long
+    COMMAND_TERMINATOR = '\n'  # R9 reads a command up to here; appended to commands written without it
     BIAS_LIMIT = (0.01, 1)  # (V)
     CURRENT_LIMIT = (50e-12, 2000e-12)  # (A)
     IMAGE_SCAN_PROCEDURE = 'dI-dV Image Map 5.0'
+    # Parameters changed by R9 itself, never served from the cache
+    CACHE_EXCLUDE = (
+        ('SWParameter', 'Measure Item', 'Status'),
+        ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'File Name Index'),
+        ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'File Name'),
+        ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'Save Path'),
+    )
+
+    def __post_init__(self) -> None:
+        self._buffer = bytearray(self.BUFFER_SIZE)
+
+    def __enter__(self) -> 'Driver':
+        self.open()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
 
     def _connect(self) -> None:
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.settimeout(self.TIMEOUT)
+        if self.persistent:
+            # Keep one connection alive between commands instead of reconnecting for each query
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.s.connect((self.IP_Address_R9_PC, self.TCP_Port_R9s))
+            return
         self.s.connect((self.IP_Address_R9_PC, self.TCP_Port_R9s))
         time.sleep(0.1)
         return
 
     def _disconnect(self) -> None:
-        self.s.close()
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+        self._buffered = 0
+        return
+
+    def open(self) -> None:
+        # Persistent session until close(), which restores the previous mode
+        if self._opened_from is None:
+            self._opened_from = self.persistent
+        self.persistent = True
+        if self.s is None:
+            self._connect()
+        return
+
+    def close(self) -> None:
+        self._disconnect()
+        if self._opened_from is not None:
+            self.persistent = self._opened_from
+            self._opened_from = None
+        return
+
+    def _peer_closed(self) -> bool:
+        # True if R9 has closed the connection: it is readable but holds no data
+        readable, _, _ = select.select([self.s], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.s.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def _reconnected(self, key: str) -> None:
+        self.reconnect_count += 1
+        if self.metrics is not None:
+            self.metrics.increment('driver_reconnects', key)
+        print('Reconnect')
         return
 
+    def _send_session(self, data: bytes, key: str) -> None:
+        # Reconnect if R9 has dropped the connection since the last command, and resend once if the send
+        # itself fails. Nothing is resent after a successful send: the command may already have run on R9.
+        if self.s is not None and self._peer_closed():
+            self._disconnect()
+            self._reconnected(key)
+        for attempt in range(2):
+            if self.s is None:
+                self._connect()
+            try:
+                self.s.sendall(data)
+                return
+            except OSError:
+                self._disconnect()
+                if attempt > 0:
+                    raise
+                self._reconnected(key)
+
+    def _query_session(self, message: str) -> str:
+        self._send_session(self._encode(message), self._command_key(message))
+        try:
+            self.response = self._read_reply()
+        except OSError:
+            # e.g. a timeout; the state of the connection is unknown, so the next command reconnects
+            self._disconnect()
+            raise
+        if self.interval > 0:
+            time.sleep(self.interval)
+        return self.response
+
+    def _encode(self, message: str) -> bytes:
+        # Several set/get methods are written without the terminator; a session or batch needs it to split commands
+        if not message.endswith(self.COMMAND_TERMINATOR):
+            message += self.COMMAND_TERMINATOR
+        return message.encode()
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
     def query(self, message: str) -> str:
+        if self._batch is not None:
+            return self._batch.queue(message)
+        if self.cache:
+            cached = self._cache_lookup(message)
+            if cached is not None:
+                if self.metrics is not None:
+                    self.metrics.increment('driver_cache_hits', self._command_key(message))
+                self.response = cached
+                return self.response
+        if self.metrics is not None:
+            self._query_measured(message)
+        elif self.persistent:
+            self._query_session(message)
+        else:
+            self._query_connect(message)
+        if self.cache:
+            self._cache_store(message, self.response)
+        return self.response
+
+    def _query_measured(self, message: str) -> str:
+        key = self._command_key(message)
+        start = time.perf_counter()
+        try:
+            if self.persistent:
+                self._query_session(message)
+            else:
+                self._query_connect(message)
+        except OSError:
+            self.metrics.increment('driver_failures', key)
+            raise
+        self.metrics.observe('driver_command', key, time.perf_counter() - start)
+        return self.response
+
+    @staticmethod
+    def _command_key(message: str) -> str:
+        # Command verb and parameter path, without the value of a Set command
+        message = message.strip()
+        if message.startswith('Set'):
+            return message.rsplit(',', 1)[0]
+        return message
+
+    def _query_connect(self, message: str) -> str:
         self._connect()
-        self.s.send((message).encode())
-        data = self.s.recv(self.BUFFER_SIZE)
-        self._disconnect()
-        self.response = data.decode()
+        try:
+            self.s.sendall(self._encode(message))
+            self.response = self._read_reply()
+        finally:
+            self._disconnect()
         time.sleep(0.1)
         return self.response
 
+    def query_many(self, messages: List[str]) -> List[str]:
+        # Pipeline the commands over one connection: send all, then read one reply per command.
+        # Commands left without a reply after a connection failure get None.
+        if not messages:
+            return []
+        data = b''.join(self._encode(message) for message in messages)
+        responses = []
+        start = time.perf_counter()
+        try:
+            if self.persistent:
+                self._send_session(data, 'batch')
+            else:
+                self._connect()
+                self.s.sendall(data)
+            while len(responses) < len(messages):
+                responses.append(self._read_reply())
+        except OSError:
+            # Commands sent but not answered are not sent again, they may have run on R9
+            self._disconnect()
+        finally:
+            if not self.persistent:
+                self._disconnect()
+        if not self.persistent:
+            time.sleep(0.1)
+        elif self.interval > 0:
+            time.sleep(self.interval)
+        if self.metrics is not None:
+            self.metrics.observe('driver_batch', 'batch', time.perf_counter() - start)
+            self.metrics.increment('driver_batch_commands', 'batch', len(messages))
+            if len(responses) < len(messages):
+                self.metrics.increment('driver_failures', 'batch', len(messages) - len(responses))
+        responses += [None] * (len(messages) - len(responses))
+        if self.cache:
+            for message, response in zip(messages, responses):
+                if response is not None:
+                    self._cache_store(message, response)
+        self.response = responses[-1]
+        return responses
+
+    @staticmethod
+    def _split_command(message: str) -> Tuple[str, tuple, str]:
+        # "SetSWParameter, Scan Area Window, X Offset, 1.0" -> ('Set', ('SWParameter', 'Scan Area Window', 'X Offset'), '1.0')
+        fields = [field.strip() for field in message.split(',')]
+        verb = fields[0]
+        if verb.startswith('Set') and len(fields) > 2:
+            return 'Set', (verb[3:],) + tuple(fields[1:-1]), fields[-1]
+        if verb.startswith('Get'):
+            return 'Get', (verb[3:],) + tuple(fields[1:]), None
+        return verb, None, None
+
+    @staticmethod
+    def _same_value(a: str, b: str) -> bool:
+        try:
+            return float(a) == float(b)
+        except ValueError:
+            return a == b
+
+    def _cache_lookup(self, message: str) -> str:
+        verb, path, value = self._split_command(message)
+        if path is None or path in self.CACHE_EXCLUDE:
+            return None
+        entry = self._cache.get(path)
+        if entry is not None:
+            fresh = time.monotonic() - entry[1] < self.cache_ttl
+            if verb == 'Set' and fresh and self._same_value(entry[0], value):
+                self.cache_hits += 1
+                return 'Cached'
+            if verb == 'Get' and fresh:
+                self.cache_hits += 1
+                return entry[0]
+        self.cache_misses += 1
+        return None
+
+    def _cache_store(self, message: str, response: str) -> None:
+        verb, path, value = self._split_command(message)
+        if verb in ('StartProcedure', 'StopProcedure'):
+            # A procedure may change any parameter
+            self.cache_clear()
+        elif path is not None and path not in self.CACHE_EXCLUDE:
+            if self._failed(response):
+                # The value R9 holds is unknown after a rejected command
+                self._cache.pop(path, None)
+            else:
+                self._cache[path] = (value if verb == 'Set' else response.strip(), time.monotonic())
+        return
+
+    @staticmethod
+    def _failed(response: str) -> bool:
+        return response is None or response.strip() == '' or 'error' in response.lower()
+
+    def cache_invalidate(self, message: str) -> None:
+        self._cache.pop(self._split_command(message)[1], None)
+        return
+
+    def cache_clear(self) -> None:
+        self._cache.clear()
+        return
+
+    def _reject(self, message: str, error: str) -> str:
+        print(error)
+        if self._batch is not None:
+            self._batch.reject(message, error)
+        return "Error"
+
+    def _read_reply(self) -> str:
+        # Read into the reusable buffer until TERMINATOR, growing it for long replies.
+        # Bytes received after the terminator are kept for the next reply. A reply cut short by R9
+        # closing the connection is returned as it is; with IDLE_GAP, so is one R9 stops sending.
+        size = self._buffered
+        start = 0
+        while True:
+            end = self._buffer.find(self.TERMINATOR, start, size)
+            if end >= 0:
+                break
+            start = max(size - len(self.TERMINATOR) + 1, 0)
+            if size == len(self._buffer):
+                self._buffer.extend(bytes(len(self._buffer)))
+            idle = self.IDLE_GAP is not None and size > 0
+            if self.IDLE_GAP is not None:
+                self.s.settimeout(self.IDLE_GAP if idle else self.TIMEOUT)
+            try:
+                with memoryview(self._buffer) as view, view[size:] as free:
+                    n = self.s.recv_into(free)
+            except socket.timeout:
+                if not idle:
+                    raise
+                n = 0
+            if n == 0:
+                if size == 0:
+                    raise ConnectionResetError('Connection closed by R9')
+                # Unterminated reply closed or timed out by R9
+                end = size
+                break
+            size += n
+        reply = self._buffer[:end].decode().rstrip('\r')
+        rest = min(end + len(self.TERMINATOR), size)
+        self._buffered = size - rest
+        self._buffer[:self._buffered] = self._buffer[rest:size]
+        return reply
+
     def get_value(self, message: str) -> float:
         retry = 0
         while retry < self.RETRY:
             try:
-                value = float(self.query(message))
-                break
-            except:
+                return float(self.query(message))
+            except (ValueError, TypeError, OSError) as e:
+                error = e
                 retry += 1
+                self.retry_count += 1
+                if self.metrics is not None:
+                    self.metrics.increment('driver_retries', self._command_key(message))
+                self.cache_invalidate(message)
                 print(f'Retry: {str(retry)}')
                 time.sleep(0.1)
-
-        return value
+        raise ValueError(f'No valid reply to {message.strip()} after {self.RETRY} tries') from error
 
     def start_procedure(self, procedure: str) -> str:
         print(f"Start: {procedure}")
@@ -61,21 +369,21 @@ class Driver:
     def set_bias(self, value: float) -> str:
         # Set STM Bias. Value should be in unit of V. If polarity is inversed, Setpoint is also inversed.
         value = float(value)
+        message = f"SetSWParameter, STM Bias, Value, {str(value)}\n"
         if np.abs(value) < self.BIAS_LIMIT[0] or np.abs(value) > self.BIAS_LIMIT[1]:
-            print("Bias range over")
-            return "Error"
+            return self._reject(message, "Bias range over")
         print(f"STM Bias is set to {value} (V)")
-        self.response = self.query(f"SetSWParameter, STM Bias, Value, {str(value)}\n")
+        self.response = self.query(message)
         return self.response
 
     def set_setpoint(self, value: float) -> str:
         value = float(value)
         # Set STM SetPoint. Value should be in unit of A. If polarity is inversed, Bias is also inversed.
+        message = f"SetHWSubParameter, Z PI Controller, Set Point, Value, {str(value)}\n"
         if np.abs(value) < self.CURRENT_LIMIT[0] or np.abs(value) > self.CURRENT_LIMIT[1]:
-            print("SetPoint range over")
-            return "Error"
+            return self._reject(message, "SetPoint range over")
         print(f"STM SetPoint is set to {value} (A)")
-        self.response = self.query(f"SetHWSubParameter, Z PI Controller, Set Point, Value, {str(value)}\n")
+        self.response = self.query(message)
         return self.response
 
     def measure_save_enable(self) -> str:
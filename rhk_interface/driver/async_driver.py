@@ -0,0 +1,210 @@
+import asyncio
+import dataclasses
+from typing import Callable, Union
+import numpy as np
+
+
+@dataclasses.dataclass
+class AsyncDriver:
+    # asyncio version of Driver. One persistent connection is shared by all coroutines;
+    # commands are serialized with a lock so replies cannot interleave.
+    IP_Address_R9_PC: str
+    TCP_Port_R9s: int
+    BUFFER_SIZE: int = 4096
+    interval: float = 0.0  # (s) delay between commands
+    response: str = dataclasses.field(init=False, default=None)
+    retry_count: int = dataclasses.field(init=False, default=0)
+    reconnect_count: int = dataclasses.field(init=False, default=0)
+    reader: asyncio.StreamReader = dataclasses.field(init=False, default=None, repr=False)
+    writer: asyncio.StreamWriter = dataclasses.field(init=False, default=None, repr=False)
+    _lock: asyncio.Lock = dataclasses.field(init=False, default=None, repr=False)
+    RETRY = 5
+    TIMEOUT = 10.0  # (s)
+    TERMINATOR = b'\n'  # End of each R9 reply
+    COMMAND_TERMINATOR = '\n'  # R9 reads a command up to here; appended to commands written without it
+    BIAS_LIMIT = (0.01, 1)  # (V)
+    CURRENT_LIMIT = (50e-12, 2000e-12)  # (A)
+    IMAGE_SCAN_PROCEDURE = 'dI-dV Image Map 5.0'
+    STATUS_POLL_INTERVAL = (0.05, 2.0)  # (s) first and longest wait between get_status polls
+
+    async def __aenter__(self) -> 'AsyncDriver':
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def open(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Connect under the lock, so concurrent first commands share one connection
+        async with self._lock:
+            if self.writer is None:
+                await self._connect()
+        return
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader, self.writer = None, None
+        return
+
+    async def _connect(self) -> None:
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.IP_Address_R9_PC, self.TCP_Port_R9s, limit=max(self.BUFFER_SIZE, 2 ** 16)),
+            self.TIMEOUT)
+        return
+
+    async def _exchange(self, message: str) -> str:
+        if not message.endswith(self.COMMAND_TERMINATOR):
+            message += self.COMMAND_TERMINATOR
+        self.writer.write(message.encode())
+        await self.writer.drain()
+        data = await asyncio.wait_for(self.reader.readuntil(self.TERMINATOR), self.TIMEOUT)
+        return data[:-len(self.TERMINATOR)].decode().rstrip('\r')
+
+    async def query(self, message: str) -> str:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Reconnect once if R9 has dropped the connection since the last command
+            for attempt in range(2):
+                if self.writer is None:
+                    await self._connect()
+                try:
+                    self.response = await self._exchange(message)
+                    break
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    # TimeoutError and LimitOverrunError are not OSError before Python 3.11
+                    await self.close()
+                    if attempt > 0:
+                        raise
+                    self.reconnect_count += 1
+                    print('Reconnect')
+            if self.interval > 0:
+                await asyncio.sleep(self.interval)
+        return self.response
+
+    async def get_value(self, message: str) -> float:
+        retry = 0
+        while retry < self.RETRY:
+            try:
+                return float(await self.query(message))
+            except (ValueError, OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError) as e:
+                error = e
+                retry += 1
+                self.retry_count += 1
+                print(f'Retry: {str(retry)}')
+                await asyncio.sleep(0.1)
+        raise ValueError(f'No valid reply to {message.strip()} after {self.RETRY} tries') from error
+
+    async def wait_for_status(self, status: Union[str, Callable[[str], bool]], timeout: float = None) -> str:
+        # Poll get_status until it equals status (or status(reply) is true).
+        # The wait between polls grows while the status is unchanged and resets when it changes.
+        done = status if callable(status) else (lambda reply: reply.strip() == status)
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        wait, last = self.STATUS_POLL_INTERVAL[0], None
+        while True:
+            reply = await self.get_status()
+            if done(reply):
+                return reply
+            if reply != last:
+                wait, last = self.STATUS_POLL_INTERVAL[0], reply
+            else:
+                wait = min(wait * 2, self.STATUS_POLL_INTERVAL[1])
+            if deadline is not None:
+                if loop.time() >= deadline:
+                    raise asyncio.TimeoutError(f'Status is still {reply}')
+                wait = min(wait, deadline - loop.time())
+            await asyncio.sleep(wait)
+
+    async def start_procedure(self, procedure: str) -> str:
+        print(f"Start: {procedure}")
+        self.response = await self.query(f"StartProcedure, {procedure}\n")
+        return self.response
+
+    async def stop_procedure(self, procedure: str) -> str:
+        print(f"Stop: {procedure}")
+        self.response = await self.query(f"StopProcedure, {procedure}\n")
+        return self.response
+
+    async def set_bias(self, value: float) -> str:
+        # Set STM Bias. Value should be in unit of V. If polarity is inversed, Setpoint is also inversed.
+        value = float(value)
+        if np.abs(value) < self.BIAS_LIMIT[0] or np.abs(value) > self.BIAS_LIMIT[1]:
+            print("Bias range over")
+            return "Error"
+        print(f"STM Bias is set to {value} (V)")
+        self.response = await self.query(f"SetSWParameter, STM Bias, Value, {str(value)}\n")
+        return self.response
+
+    async def set_setpoint(self, value: float) -> str:
+        value = float(value)
+        # Set STM SetPoint. Value should be in unit of A. If polarity is inversed, Bias is also inversed.
+        if np.abs(value) < self.CURRENT_LIMIT[0] or np.abs(value) > self.CURRENT_LIMIT[1]:
+            print("SetPoint range over")
+            return "Error"
+        print(f"STM SetPoint is set to {value} (A)")
+        self.response = await self.query(f"SetHWSubParameter, Z PI Controller, Set Point, Value, {str(value)}\n")
+        return self.response
+
+    async def measure_save_enable(self) -> str:
+        self.response = await self.query("SetSWSubItemParameter, Scan Area Window, MeasureSave, Enable, 1\n")
+        return self.response
+
+    async def measure_save_disable(self) -> str:
+        self.response = await self.query("SetSWSubItemParameter, Scan Area Window, MeasureSave, Enable, 0\n")
+        return self.response
+
+    async def get_status(self) -> str:
+        self.response = await self.query("GetSWParameter, Measure Item, Status\n")
+        return self.response
+
+    async def get_save_index(self) -> str:
+        self.response = await self.query("GetSWSubItemParameter, Scan Area Window, MeasureSave, File Name Index\n")
+        return self.response
+
+    async def get_save_name(self) -> str:
+        self.response = await self.query("GetSWSubItemParameter, Scan Area Window, MeasureSave, File Name\n")
+        return self.response
+
+    async def get_save_path(self) -> str:
+        self.response = await self.query("GetSWSubItemParameter, Scan Area Window, MeasureSave, Save Path\n")
+        return self.response
+
+    async def start_image_scan(self) -> None:
+        await self.start_procedure(self.IMAGE_SCAN_PROCEDURE)
+
+    async def stop_image_scan(self) -> None:
+        await self.stop_procedure(self.IMAGE_SCAN_PROCEDURE)
+
+    async def get_x_offset(self):
+        value = await self.get_value('GetSWParameter, Scan Area Window, X Offset')
+        return value
+
+    async def get_y_offset(self):
+        value = await self.get_value('GetSWParameter, Scan Area Window, Y Offset')
+        return value
+
+    async def set_x_offset(self, value: float):
+        await self.query(f'SetSWParameter, Scan Area Window, X Offset, {str(value)}')
+
+    async def set_y_offset(self, value: float):
+        await self.query(f'SetSWParameter, Scan Area Window, Y Offset, {str(value)}')
+
+    async def set_lines_per_frame(self, value: int):
+        await self.query(f'SetSWSubItemParameter, Scan Area Window, Scan Settings, Lines Per Frame, {str(value)}')
+
+    async def set_line_time(self, value: float):
+        await self.query(f'SetSWParameter, Scan Area Window, Line Time, {str(value)}')
+
+    async def set_bias_mod(self, value: float):
+        await self.query(f'SetHWSubParameter, Drive CH1, Oscillation Amplitude, Value, {str(value)}')
+
+    async def set_scan_size(self, value: float):
+        await self.query(f'SetSWParameter, Scan Area Window, Scan Area Size, {str(value)}')
@@ -0,0 +1,56 @@
+import dataclasses
+from typing import List
+
+
+@dataclasses.dataclass
+class Reply:
+    command: str
+    response: str = None
+    error: str = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclasses.dataclass
+class Batch:
+    # Commands issued on the driver inside "with driver.batch() as batch:" are queued here
+    # and sent together over one connection when the block exits.
+    driver: 'Driver'
+    commands: List[str] = dataclasses.field(default_factory=list)
+    rejected: dict = dataclasses.field(default_factory=dict)
+    replies: List[Reply] = dataclasses.field(default_factory=list)
+
+    def __enter__(self) -> 'Batch':
+        self.driver._batch = self
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.driver._batch = None
+        if exc_type is None:
+            self.send()
+
+    def queue(self, message: str) -> str:
+        # Replies only arrive when the block exits, so a read cannot return its value here
+        if message.lstrip().startswith('Get'):
+            raise RuntimeError(f'{message.strip()} cannot be queued in a batch, read it before or after the with block')
+        if not message.endswith('\n'):
+            message += '\n'
+        self.commands.append(message)
+        return 'Queued'
+
+    def reject(self, command: str, error: str) -> None:
+        self.rejected[len(self.commands)] = error
+        self.commands.append(command)
+
+    def send(self) -> List[Reply]:
+        # Nothing is sent unless every queued value passed the driver's limit checks
+        if self.rejected:
+            print('Batch not sent')
+            self.replies = [Reply(command, error=self.rejected.get(i, 'Not sent')) for i, command in enumerate(self.commands)]
+            return self.replies
+        responses = self.driver.query_many(self.commands)
+        self.replies = [Reply(command, response) if response is not None else Reply(command, error='No reply') for command, response in zip(self.commands, responses)]
+        self.commands = []
+        return self.replies
@@ -1,14 +1,28 @@
 import dataclasses
 from typing import List, Tuple
 import socket
+import struct
+import time
 import numpy as np
 from ctypes import *
+from ..metrics import Metrics
+from .stream import RingBuffer, Stream
+from .multi import MultiStream
+from .recorder import Recorder, Recording
+from .live import LiveScan
+from . import stats
+
+HEADER = struct.Struct('<IQffI')  # packet_len, timestamp, interval, gain, label_size
+UINT32 = struct.Struct('<I')
 
 
 @dataclasses.dataclass
 class Listener:
     IP_Address: str
     BUFFER_SIZE: int = 2048
+    metrics: Metrics = None
+    TIMEOUT = None  # (s) None waits for a packet forever
+    TIMESTAMP_UNIT = 1e-6  # (s)
     DATA_FORMAT = {
         'packet_len': c_uint32,
         'timestamp': c_uint64,
@@ -38,40 +52,142 @@ class Listener:
     response_address: str = dataclasses.field(init=False, default=None)
     value: float = dataclasses.field(init=False, default=None)
     value_list: List[float] = dataclasses.field(init=False, default_factory=list)
+    streams: dict = dataclasses.field(init=False, default_factory=dict)
+    multi_streams: list = dataclasses.field(init=False, default_factory=list)
+    _next_timestamp: dict = dataclasses.field(init=False, default_factory=dict, repr=False)
+
+    def decode(self, buffer) -> Tuple[dict, int]:
+        # Returns the parsed packet and the offset of its data block.
+        # The header is unpacked with one struct call and data is a zero-copy int32 view of buffer.
+        packet_len, timestamp, interval, gain, label_size = HEADER.unpack_from(buffer, 0)
+        offset = HEADER.size
+        label = bytes(buffer[offset:offset + label_size * 2]).decode('utf-16-le')
+        offset += label_size * 2
+        unit_size, = UINT32.unpack_from(buffer, offset)
+        offset += 4
+        unit = bytes(buffer[offset:offset + unit_size * 2]).decode('utf-16-le')
+        offset += unit_size * 2
+        data_size, = UINT32.unpack_from(buffer, offset)
+        offset += 4
+        if data_size * 4 + offset > packet_len:
+            print('Incorrect data length')
+        data = np.frombuffer(buffer, dtype='<i4', count=min(data_size, (len(buffer) - offset) // 4), offset=offset)
+        result = dict(packet_len=packet_len, timestamp=timestamp, interval=interval, gain=gain, label_size=label_size, label=label,
+                      unit_size=unit_size, unit=unit, data_size=data_size, data=data)
+        return result, offset
+
+    @staticmethod
+    def packet_dtype(label_size: int, unit_size: int, data_size: int) -> np.dtype:
+        # Structured dtype of one whole packet with the given label, unit and data sizes
+        return np.dtype([
+            ('packet_len', '<u4'),
+            ('timestamp', '<u8'),
+            ('interval', '<f4'),
+            ('gain', '<f4'),
+            ('label_size', '<u4'),
+            ('label', f'V{label_size * 2}'),
+            ('unit_size', '<u4'),
+            ('unit', f'V{unit_size * 2}'),
+            ('data_size', '<u4'),
+            ('data', '<i4', (data_size,)),
+        ])
+
+    def decode_batch(self, packets: List[bytes]) -> dict:
+        # Parse many packets into columns: one array per header field, label and unit of the first packet,
+        # and 'data' as a (packet, sample) array. If packet layouts differ, 'data' holds the samples of all
+        # packets back to back and packet i is data[offsets[i]:offsets[i + 1]]. No packets give empty columns.
+        if len(packets) == 0:
+            columns = {name: np.zeros(0, dtype=dtype) for name, dtype in (('packet_len', '<u4'), ('timestamp', '<u8'), ('interval', '<f4'), ('gain', '<f4'), ('data_size', '<u4'), ('data', '<i4'))}
+            columns['offsets'] = np.zeros(1, dtype=np.int64)
+            columns['label'] = None
+            columns['unit'] = None
+            return columns
+        first, _ = self.decode(packets[0])
+        dtype = self.packet_dtype(first['label_size'], first['unit_size'], first['data_size'])
+        columns = None
+        if all(len(packet) == dtype.itemsize for packet in packets):
+            rows = np.frombuffer(b''.join(packets), dtype=dtype)
+            if (rows['label_size'] == first['label_size']).all() and (rows['unit_size'] == first['unit_size']).all() and (rows['data_size'] == first['data_size']).all():
+                columns = {name: rows[name] for name in ('packet_len', 'timestamp', 'interval', 'gain', 'data_size', 'data')}
+                columns['offsets'] = np.arange(len(rows) + 1, dtype=np.int64) * first['data_size']
+        if columns is None:
+            results = [self.decode(packet)[0] for packet in packets]
+            columns = {name: np.array([result[name] for result in results]) for name in ('packet_len', 'timestamp', 'interval', 'gain', 'data_size')}
+            columns['data'] = np.concatenate([result['data'] for result in results])
+            columns['offsets'] = np.concatenate([[0], np.cumsum([len(result['data']) for result in results], dtype=np.int64)])
+        columns['label'] = first['label']
+        columns['unit'] = first['unit']
+        return columns
 
     def parse(self) -> None:
-        self.offset = 0
-        self.result = {}
-        for item, item_format in self.DATA_FORMAT.items():
-            if self.length[item] != None:
-                self.result[item] = np.frombuffer(self.buffer, dtype=item_format, count=self.length[item], offset=self.offset)[0]
-                self.offset += self.length[item]
-            elif item == 'label':
-                self.result[item] = ''.join([char.decode('utf-8') for char in np.frombuffer(self.buffer, dtype=item_format, count=self.result['label_size'] * 2, offset=self.offset)])
-                self.offset += self.result['label_size'] * 2
-            elif item == 'unit':
-                self.result[item] = ''.join([char.decode('utf-8') for char in np.frombuffer(self.buffer, dtype=item_format, count=self.result['unit_size'] * 2, offset=self.offset)])
-                self.offset += self.result['unit_size'] * 2
-            elif item == 'data':
-                if self.result['data_size'] * 4 + self.offset > self.result['packet_len']:
-                    print('Incorrect data length')
-                self.result[item] = np.frombuffer(self.buffer, dtype=item_format, offset=self.offset)
+        self.result, self.offset = self.decode(self.buffer)
+        return
+
+    def _parse_measured(self, port: int) -> None:
+        if self.metrics is None:
+            self.parse()
+            return
+        start = time.perf_counter()
+        self.parse()
+        self._record(port, len(self.buffer), self.result, self.offset, time.perf_counter() - start)
+        return
+
+    def _record(self, port: int, size: int, result: dict, offset: int, seconds: float) -> None:
+        key = str(port)
+        self.metrics.observe('listener_parse', key, seconds)
+        self.metrics.increment('listener_packets', key)
+        self.metrics.increment('listener_bytes', key, size)
+        if size < result['packet_len'] or result['data_size'] * 4 + offset > result['packet_len']:
+            self.metrics.increment('listener_short_packets', key)
+        # Packets missing between this one and the previous one on the same port, from the timestamps
+        duration = result['data_size'] * result['interval'] / self.TIMESTAMP_UNIT
+        expected = self._next_timestamp.get(port)
+        if expected is not None and duration > 0:
+            missing = int(round((int(result['timestamp']) - expected) / duration))
+            if missing > 0:
+                self.metrics.increment('listener_dropped_packets', key, missing)
+        self._next_timestamp[port] = int(result['timestamp']) + duration
         return
 
     def fetch_averaged_value(self, port: int) -> float:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(self.TIMEOUT)
         s.bind((self.IP_Address, port))
         self.buffer, self.response_address = s.recvfrom(self.BUFFER_SIZE)
         s.close()
-        self.parse()
+        self._parse_measured(port)
         self.value = np.mean(self.result['data']) * self.result['gain']
         return self.value
 
     def fetch_all_value(self, port: int) -> list:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(self.TIMEOUT)
         s.bind((self.IP_Address, port))
         self.buffer, self.response_address = s.recvfrom(self.BUFFER_SIZE)
         s.close()
-        self.parse()
+        self._parse_measured(port)
         self.value_list = self.result['data'] * self.result['gain']
         return self.value_list
+
+    def stream(self, port: int, capacity: int = 2 ** 20, recorder: Recorder = None) -> Stream:
+        # Start capturing every packet on port in the background, or return the running capture
+        if port not in self.streams:
+            self.streams[port] = Stream(self, port, capacity, recorder)
+            self.streams[port].start()
+        return self.streams[port]
+
+    def stop_streams(self) -> None:
+        for stream in self.streams.values():
+            stream.stop()
+        for multi in self.multi_streams:
+            multi.stop()
+        self.streams = {}
+        self.multi_streams = []
+        return
+
+    def multi_stream(self, ports: List[int], capacity: int = 2 ** 20, recorders: dict = None) -> MultiStream:
+        # Capture several ports from one thread; see MultiStream.dataset for the time-aligned channels
+        multi = MultiStream(self, ports, capacity, recorders)
+        multi.start()
+        self.multi_streams.append(multi)
+        return multi
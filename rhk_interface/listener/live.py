@@ -0,0 +1,208 @@
+import dataclasses
+from typing import Tuple
+import threading
+import time
+import numpy as np
+
+# Live view of a running scan. LiveScan is a Stream operator (Stream.attach): update() bins the samples
+# of each packet into scan lines by their time since the frame start, so nothing is read back from the
+# ring buffer. A line is leveled once when it is complete and never changes afterwards, so each refresh
+# of the FigureWidget adds only the rows completed since the last one, as a heatmap trace of its own on a
+# shared colour axis. Past MAX_TRACES the traces are merged into one. Refreshes run at most fps times per
+# second, from their own thread, never from the Stream thread.
+
+
+def level_line(values: np.ndarray, leveling: str) -> np.ndarray:
+    # 'mean' subtracts the line mean, 'linear' a least-squares line, None leaves the line as measured
+    valid = np.isfinite(values)
+    if leveling is None or valid.sum() < 2:
+        return values
+    if leveling == 'mean':
+        return values - values[valid].mean()
+    columns = np.arange(len(values))
+    slope, intercept = np.polyfit(columns[valid], values[valid], 1)
+    return values - (slope * columns + intercept)
+
+
+@dataclasses.dataclass
+class LiveScan:
+    lines: int  # lines per frame, as set with Driver.set_lines_per_frame
+    line_time: float  # (s) as set with Driver.set_line_time
+    points: int = 256  # columns of the image; the samples of each line are averaged into this many bins
+    retrace: bool = False  # the second half of each line time is the backward trace, which is dropped
+    leveling: str = 'linear'  # per-line leveling, see level_line
+    continuous: bool = True  # start the next frame when one is complete, else stop filling
+    scan_size: float = None  # (nm) x/y coordinates in nm instead of columns and lines
+    fps: float = 5.0  # most widget refreshes per second
+    image: np.ndarray = dataclasses.field(init=False, default=None, repr=False)
+    frame: int = dataclasses.field(init=False, default=0)
+    completed: int = dataclasses.field(init=False, default=0)  # complete lines of the current frame
+    widget: object = dataclasses.field(init=False, default=None, repr=False)
+    thread: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+    MAX_TRACES = 16  # row traces on the widget before they are merged into one
+
+    def __post_init__(self) -> None:
+        self.image = np.full((self.lines, self.points), np.nan)
+        self._sums = np.zeros((self.lines, self.points))
+        self._counts = np.zeros((self.lines, self.points))
+        self._start = None
+        self._lock = threading.Lock()
+        self._begun = 0  # begin() calls, a new frame on the widget like a new frame index
+        self._shown = None  # (frame, begun, completed) on the widget
+        self._running = False
+        return
+
+    @classmethod
+    def configure(cls, driver, lines: int, line_time: float, start: bool = True, **kwargs) -> 'LiveScan':
+        # Sets the scan geometry on R9 and returns a LiveScan for it; with start, also starts the scan
+        driver.set_lines_per_frame(lines)
+        driver.set_line_time(line_time)
+        scan = cls(lines, line_time, **kwargs)
+        if start:
+            scan.start_scan(driver)
+        return scan
+
+    def start_scan(self, driver) -> None:
+        # Starts the image scan on R9; the frame starts at the first sample received after R9 replied
+        driver.start_image_scan()
+        self.begin()
+        return
+
+    def begin(self, start: float = None) -> None:
+        # The frame starts at start (s, Listener timestamps), or at the next sample received
+        with self._lock:
+            self._clear()
+            self._start = start
+            self._begun += 1
+        return
+
+    def _clear(self) -> None:
+        self.image[:] = np.nan
+        self._sums[:] = 0
+        self._counts[:] = 0
+        self.completed = 0
+        return
+
+    def _complete(self, line: int) -> None:
+        # Levels the lines before line, which no later sample can reach
+        line = min(line, self.lines)
+        for row in range(self.completed, line):
+            with np.errstate(invalid='ignore'):
+                values = self._sums[row] / self._counts[row]
+            self.image[row] = level_line(values, self.leveling)
+        self.completed = max(self.completed, line)
+        return
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        if len(values) == 0:
+            return
+        with self._lock:
+            if self._start is None:
+                self._start = start
+            if not self.continuous and self.completed >= self.lines:
+                return
+            times = start - self._start + interval * np.arange(len(values))
+            frame_time = self.lines * self.line_time
+            # Samples after the end of the frame start the next frames
+            while times[-1] >= frame_time:
+                inside = times < frame_time
+                self._add(values[inside], times[inside])
+                self._complete(self.lines)
+                if not self.continuous:
+                    return
+                values, times = values[~inside], times[~inside] - frame_time
+                self._start += frame_time
+                self.frame += 1
+                self._clear()
+            self._add(values, times)
+            self._complete(int(times[-1] // self.line_time))
+        return
+
+    def _add(self, values: np.ndarray, times: np.ndarray) -> None:
+        keep = times >= 0
+        values, times = values[keep], times[keep]
+        if len(values) == 0:
+            return
+        line = (times // self.line_time).astype(int)
+        fraction = times / self.line_time - line
+        if self.retrace:
+            forward = fraction < 0.5
+            values, line, fraction = values[forward], line[forward], 2 * fraction[forward]
+            if len(values) == 0:
+                return
+        flat = line * self.points + np.minimum((fraction * self.points).astype(int), self.points - 1)
+        # bincount over the touched range only, a packet spans a few lines at most
+        first, last = flat.min(), flat.max() + 1
+        self._sums.ravel()[first:last] += np.bincount(flat - first, values)
+        self._counts.ravel()[first:last] += np.bincount(flat - first)
+        return
+
+    def axes(self) -> Tuple[np.ndarray, np.ndarray]:
+        x, y = np.arange(self.points, dtype=float), np.arange(self.lines, dtype=float)
+        if self.scan_size is not None:
+            x *= self.scan_size / self.points
+            y *= self.scan_size / self.lines
+        return x, y
+
+    def figure(self, width: int = 600, height: int = 600):
+        import plotly.graph_objs as go
+        x, y = self.axes()
+        self.widget = go.FigureWidget()
+        self.widget.update_layout(
+            width=width,
+            height=height,
+            xaxis=dict(range=[x[0], x[-1]], title='x (nm)' if self.scan_size is not None else 'Column'),
+            yaxis=dict(range=[y[0], y[-1]], title='y (nm)' if self.scan_size is not None else 'Line', scaleanchor='x'),
+            coloraxis=dict(colorscale='Greys_r'),
+            template='plotly_white',
+        )
+        self._shown = None
+        return self.widget
+
+    def refresh(self) -> bool:
+        # Adds the rows completed since the last refresh to the widget, or redraws it for a new frame
+        import plotly.graph_objs as go
+        with self._lock:
+            if self.widget is None:
+                return False
+            state = (self.frame, self._begun, self.completed)
+            if state == self._shown:
+                return False
+            first = 0
+            if self._shown is not None and state[:2] == self._shown[:2] and len(self.widget.data) < self.MAX_TRACES:
+                first = self._shown[2]
+            z = self.image[first:self.completed].copy()
+        x, y = self.axes()
+        with self.widget.batch_update():
+            if first == 0:
+                self.widget.data = []
+            if len(z):
+                # y0 and dy place a trace of a single row as well
+                dy = float(y[1] - y[0]) if len(y) > 1 else 1.0
+                self.widget.add_trace(go.Heatmap(x=x, y0=float(y[first]), dy=dy, z=z, coloraxis='coloraxis'))
+        self._shown = state
+        return True
+
+    def _run(self) -> None:
+        while self._running:
+            last = time.monotonic()
+            self.refresh()
+            time.sleep(max(1 / self.fps - (time.monotonic() - last), 0))
+        return
+
+    def show(self, width: int = 600, height: int = 600):
+        # Returns the widget and refreshes it in the background until stop()
+        if self.widget is None:
+            self.figure(width, height)
+        if self.thread is None:
+            self._running = True
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self.widget
+
+    def stop(self) -> None:
+        self._running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return
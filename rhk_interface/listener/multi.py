@@ -0,0 +1,114 @@
+import dataclasses
+from typing import List, Tuple
+import selectors
+import socket
+import threading
+import numpy as np
+from .stream import Stream
+
+
+@dataclasses.dataclass
+class MultiStream:
+    # Captures several ports from one selector thread and aligns the channels on a shared time base.
+    # Each channel is a Stream that is never started, its packets are handed to it by this thread.
+    listener: 'Listener' = dataclasses.field(repr=False)
+    ports: List[int]
+    capacity: int = 2 ** 20  # samples per channel
+    recorders: dict = None  # port -> Recorder for the ports to save to disk
+    channels: dict = dataclasses.field(init=False, default_factory=dict)
+    thread: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+    RECEIVE_BUFFER = 2 ** 22  # (bytes)
+    POLL_TIMEOUT = 0.2  # (s)
+
+    def __post_init__(self) -> None:
+        recorders = self.recorders or {}
+        self.channels = {port: Stream(self.listener, port, self.capacity, recorders.get(port)) for port in self.ports}
+        self._running = False
+        self._selector = None
+
+    def __enter__(self) -> 'MultiStream':
+        if self.thread is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._selector = selectors.DefaultSelector()
+        for port, channel in self.channels.items():
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+            s.bind((self.listener.IP_Address, port))
+            s.setblocking(False)
+            self._selector.register(s, selectors.EVENT_READ, channel)
+        self._running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self) -> None:
+        self._running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self._selector is not None:
+            for key in list(self._selector.get_map().values()):
+                self._selector.unregister(key.fileobj)
+                key.fileobj.close()
+            self._selector.close()
+            self._selector = None
+        return
+
+    def _run(self) -> None:
+        packet = bytearray(max(self.listener.BUFFER_SIZE, 2 ** 16))
+        view = memoryview(packet)
+        while self._running:
+            for key, _ in self._selector.select(self.POLL_TIMEOUT):
+                channel = key.data
+                # Drain every queued packet of this port before going back to select()
+                while True:
+                    try:
+                        size = key.fileobj.recv_into(packet)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError:
+                        return
+                    channel._handle(view[:size])
+
+    def attach(self, port: int, operator):
+        self.channels[port].operators.append(operator)
+        return operator
+
+    def _time_base(self, windows: list, interval: float = None) -> np.ndarray:
+        # Times covered by every channel, stepped by the coarsest channel interval unless interval is given
+        if any(len(times) == 0 for times, _ in windows):
+            return np.zeros(0)
+        start = max(times[0] for times, _ in windows)
+        end = min(times[-1] for times, _ in windows)
+        if interval is None:
+            interval = max(channel.interval for channel in self.channels.values())
+        if end < start:
+            return np.zeros(0)
+        return start + np.arange(int(np.floor((end - start) / interval)) + 1) * interval
+
+    def aligned(self, seconds: float = None, interval: float = None) -> Tuple[np.ndarray, np.ndarray]:
+        # Returns the shared times and a (time, channel) array, each channel linearly interpolated onto them
+        windows = [channel.buffer.window(np.inf if seconds is None else seconds) for channel in self.channels.values()]
+        times = self._time_base(windows, interval)
+        values = np.empty((len(times), len(windows)))
+        for i, (channel_times, channel_values) in enumerate(windows):
+            if len(times):
+                values[:, i] = np.interp(times, channel_times, channel_values)
+        return times, values
+
+    def dataset(self, seconds: float = None, interval: float = None) -> 'xr.Dataset':
+        import xarray as xr
+        times, values = self.aligned(seconds, interval)
+        variables = {}
+        for i, channel in enumerate(self.channels.values()):
+            name = channel.label or str(channel.port)
+            if name in variables:
+                name = f'{name}_{channel.port}'
+            variables[name] = xr.DataArray(values[:, i], dims='time', attrs=dict(units=channel.unit, port=channel.port, interval=channel.interval))
+        return xr.Dataset(variables, coords=dict(time=times))
@@ -0,0 +1,179 @@
+import dataclasses
+from typing import List
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+PACKET_LEN = struct.Struct('<I')
+TIMESTAMP = struct.Struct('<Q')  # at offset 4 of every packet
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('timestamp', '<u8')])
+
+
+def segment_name(segment: int) -> str:
+    return f'packets_{segment:06d}'
+
+
+@dataclasses.dataclass
+class Recording:
+    # Raw packets stored back to back in segment files, packets_NNNNNN.bin. Packets frame themselves
+    # with their packet_len field. packets_NNNNNN.idx.npy holds the offset and timestamp of every packet
+    # of a closed segment and catalogue.json the timestamp range of each segment, so a time-range
+    # query only maps the segments and packets it needs.
+    path_dir: str
+    timestamp_unit: float = 1e-6  # (s) same as Listener.TIMESTAMP_UNIT
+    catalogue: List[dict] = dataclasses.field(init=False, default_factory=list)
+    CATALOGUE = 'catalogue.json'
+
+    def __post_init__(self) -> None:
+        path_catalogue = os.path.join(self.path_dir, self.CATALOGUE)
+        if os.path.exists(path_catalogue):
+            with open(path_catalogue) as f:
+                self.catalogue = json.load(f)
+        return
+
+    def _path(self, segment: int, extension: str) -> str:
+        return os.path.join(self.path_dir, segment_name(segment) + extension)
+
+    def index(self, segment: int) -> np.ndarray:
+        return np.load(self._path(segment, '.idx.npy'), mmap_mode='r')
+
+    def packets(self, start: float = None, end: float = None) -> List[memoryview]:
+        # Packets with start <= timestamp (s) < end, in recording order, as views of the memory-mapped segments
+        first = None if start is None else start / self.timestamp_unit
+        last = None if end is None else end / self.timestamp_unit
+        packets = []
+        for entry in self.catalogue:
+            if (first is not None and entry['last'] < first) or (last is not None and entry['first'] >= last) or entry['count'] == 0:
+                continue
+            index = self.index(entry['segment'])
+            a = 0 if first is None else int(np.searchsorted(index['timestamp'], first))
+            b = len(index) if last is None else int(np.searchsorted(index['timestamp'], last))
+            if b <= a:
+                continue
+            data = memoryview(np.memmap(self._path(entry['segment'], '.bin'), dtype=np.uint8, mode='r'))
+            ends = np.append(index['offset'][a + 1:b + 1], entry['bytes']) if b == len(index) else index['offset'][a + 1:b + 1]
+            packets += [data[int(offset):int(stop)] for offset, stop in zip(index['offset'][a:b], ends)]
+        return packets
+
+    def samples(self, listener: 'Listener', start: float = None, end: float = None) -> dict:
+        # Columns of the packets in the time range, parsed by Listener.decode_batch
+        return listener.decode_batch(self.packets(start, end))
+
+    def replay(self, port: int, IP_Address: str = '127.0.0.1', speed: float = 1.0, start: float = None, end: float = None) -> int:
+        # Send the recorded packets to port, spaced by their timestamps divided by speed (0 sends at once).
+        # Anything reading that port, e.g. Listener.fetch_all_value or Listener.stream, receives them as live data.
+        packets = self.packets(start, end)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        clock = time.monotonic()
+        first = None
+        try:
+            for packet in packets:
+                timestamp = TIMESTAMP.unpack_from(packet, 4)[0]
+                if first is None:
+                    first = timestamp
+                if speed > 0:
+                    wait = clock + (timestamp - first) * self.timestamp_unit / speed - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                s.sendto(packet, (IP_Address, port))
+        finally:
+            s.close()
+        return len(packets)
+
+
+@dataclasses.dataclass
+class Recorder(Recording):
+    # Appends raw packets to a Recording; a new segment starts once the current one exceeds segment_size.
+    # write() runs on the capture thread, flush() and close() may be called from any other thread.
+    segment_size: int = 2 ** 26  # (bytes)
+    segment: int = dataclasses.field(init=False, default=None)
+    _file: object = dataclasses.field(init=False, default=None, repr=False)
+    _offsets: List[int] = dataclasses.field(init=False, default_factory=list, repr=False)
+    _timestamps: List[int] = dataclasses.field(init=False, default_factory=list, repr=False)
+    _size: int = dataclasses.field(init=False, default=0, repr=False)
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __post_init__(self) -> None:
+        os.makedirs(self.path_dir, exist_ok=True)
+        super().__post_init__()
+        # A segment left without an index by a crash is indexed again from its packets
+        segment = len(self.catalogue)
+        while os.path.exists(self._path(segment, '.bin')):
+            self._recover(segment)
+            segment += 1
+        self.segment = segment
+        return
+
+    def __enter__(self) -> 'Recorder':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _recover(self, segment: int) -> None:
+        with open(self._path(segment, '.bin'), 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + 12 <= len(data):
+            packet_len = PACKET_LEN.unpack_from(data, offset)[0]
+            if packet_len < 12 or offset + packet_len > len(data):
+                break
+            self._offsets.append(offset)
+            self._timestamps.append(TIMESTAMP.unpack_from(data, offset + 4)[0])
+            offset += packet_len
+        if offset < len(data):
+            with open(self._path(segment, '.bin'), 'r+b') as f:
+                f.truncate(offset)
+        self.segment, self._size = segment, offset
+        self._close_segment()
+        return
+
+    def write(self, packet) -> None:
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._path(self.segment, '.bin'), 'ab')
+            self._offsets.append(self._size)
+            self._timestamps.append(TIMESTAMP.unpack_from(packet, 4)[0])
+            self._file.write(packet)
+            self._size += len(packet)
+            if self._size >= self.segment_size:
+                self._close_segment()
+        return
+
+    def _close_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        index = np.empty(len(self._offsets), dtype=INDEX_DTYPE)
+        index['offset'] = self._offsets
+        index['timestamp'] = self._timestamps
+        np.save(self._path(self.segment, '.idx.npy'), index)
+        self.catalogue.append(dict(
+            segment=self.segment,
+            first=int(index['timestamp'].min()) if len(index) else 0,
+            last=int(index['timestamp'].max()) if len(index) else 0,
+            count=len(index),
+            bytes=self._size,
+        ))
+        path_catalogue = os.path.join(self.path_dir, self.CATALOGUE)
+        with open(path_catalogue + '.tmp', 'w') as f:
+            json.dump(self.catalogue, f)
+        os.replace(path_catalogue + '.tmp', path_catalogue)
+        self.segment += 1
+        self._offsets, self._timestamps, self._size = [], [], 0
+        return
+
+    def flush(self) -> None:
+        # Close the current segment so everything written so far can be queried
+        with self._lock:
+            if self._offsets:
+                self._close_segment()
+        return
+
+    def close(self) -> None:
+        self.flush()
+        return
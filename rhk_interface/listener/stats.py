@@ -0,0 +1,217 @@
+import dataclasses
+from typing import Tuple
+import math
+import threading
+import numpy as np
+from .stream import RingBuffer
+
+# Operators attached to a Stream with Stream.attach. update() is called once per packet with the
+# gain-scaled samples, the time of the first sample and the sample interval (s), and costs a fixed
+# number of NumPy calls per packet. update() runs on the stream thread: the decimators publish through
+# their output RingBuffer, which other threads may read at any time, and RunningStats and EMA hold a
+# lock, so read them together with snapshot().
+
+
+@dataclasses.dataclass
+class RunningStats:
+    # Mean and variance of every sample seen, merged block by block (Welford / Chan et al.)
+    count: int = 0
+    mean: float = 0.0
+    m2: float = 0.0
+    min: float = math.inf
+    max: float = -math.inf
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False, compare=False)
+
+    def update(self, values: np.ndarray, start: float = None, interval: float = None) -> None:
+        n = len(values)
+        if n == 0:
+            return
+        block_mean = values.mean()
+        block_m2 = ((values - block_mean) ** 2).sum()
+        block_min, block_max = values.min(), values.max()
+        with self._lock:
+            total = self.count + n
+            delta = block_mean - self.mean
+            self.mean += delta * n / total
+            self.m2 += block_m2 + delta ** 2 * self.count * n / total
+            self.count = total
+            self.min = min(self.min, block_min)
+            self.max = max(self.max, block_max)
+        return
+
+    @property
+    def variance(self) -> float:
+        with self._lock:
+            return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            variance = self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+            return dict(count=self.count, mean=self.mean, std=math.sqrt(variance), min=self.min, max=self.max)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.count, self.mean, self.m2, self.min, self.max = 0, 0.0, 0.0, math.inf, -math.inf
+        return
+
+
+@dataclasses.dataclass
+class EMA:
+    # Exponential moving average with time constant tau (s), advanced over each block in closed form
+    tau: float
+    value: float = None
+    time: float = None
+    _weights: dict = dataclasses.field(init=False, default_factory=dict, repr=False)
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False, compare=False)
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        n = len(values)
+        if n == 0:
+            return
+        key = (n, interval)
+        if key not in self._weights:
+            alpha = 1 - math.exp(-interval / self.tau)
+            self._weights[key] = (alpha * (1 - alpha) ** np.arange(n - 1, -1, -1), (1 - alpha) ** n)
+        weights, decay = self._weights[key]
+        with self._lock:
+            value = values[0] if self.value is None else self.value
+            self.value = decay * value + weights @ values
+            self.time = start + (n - 1) * interval
+        return
+
+    def snapshot(self) -> Tuple[float, float]:
+        # (time, value) of the latest update
+        with self._lock:
+            return self.time, self.value
+
+
+@dataclasses.dataclass
+class WindowMean:
+    # Running prefix sums, so the mean of any recent window costs two binary searches
+    capacity: int = 2 ** 20
+    total: float = 0.0
+    sums: RingBuffer = dataclasses.field(init=False, default=None)
+
+    def __post_init__(self) -> None:
+        self.sums = RingBuffer(self.capacity)
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        if len(values) == 0:
+            return
+        cumulative = np.cumsum(values)
+        cumulative += self.total
+        self.total = cumulative[-1]
+        self.sums.append(cumulative, 1.0, start, interval)
+        return
+
+    def mean(self, seconds: float) -> float:
+        buffer = self.sums
+        with buffer._lock:
+            segments = [(a, b) for a, b in buffer._window_segments(seconds) if b > a]
+            if not segments:
+                return float('nan')
+            n = sum(b - a for a, b in segments)
+            first = segments[0][0]
+            oldest = 0 if buffer.count <= buffer.capacity else buffer.count % buffer.capacity
+            last = buffer.values[(buffer.count - 1) % buffer.capacity]
+            if first != oldest:
+                before = buffer.values[(first - 1) % buffer.capacity]
+            elif buffer.count <= buffer.capacity:
+                before = 0.0
+            else:
+                # The sum before the oldest kept sample is gone, so the window starts one sample later
+                before, n = buffer.values[first], n - 1
+        return (last - before) / n if n > 0 else float('nan')
+
+
+@dataclasses.dataclass
+class Boxcar:
+    # Decimates by factor, averaging each group of factor samples; leftover samples wait for the next block
+    factor: int
+    capacity: int = 2 ** 16  # decimated samples kept
+    output: RingBuffer = dataclasses.field(init=False, default=None)
+    _pending: np.ndarray = dataclasses.field(init=False, default=None, repr=False)
+    _pending_start: float = dataclasses.field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self.output = RingBuffer(self.capacity)
+        self._pending = np.zeros(0)
+
+    def _groups(self, values: np.ndarray, start: float, interval: float) -> Tuple[np.ndarray, float]:
+        # Full groups as a (group, factor) array and the time of the first group's first sample
+        if len(self._pending):
+            values = np.concatenate([self._pending, values])
+            start = self._pending_start
+        groups = len(values) // self.factor
+        self._pending = values[groups * self.factor:].copy()
+        self._pending_start = start + groups * self.factor * interval
+        return values[:groups * self.factor].reshape(groups, self.factor), start
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        groups, start = self._groups(values, start, interval)
+        if len(groups):
+            # Each output is stamped with the centre of its group
+            self.output.append(groups.mean(axis=1), 1.0, start + (self.factor - 1) / 2 * interval, interval * self.factor)
+        return
+
+
+@dataclasses.dataclass
+class Envelope(Boxcar):
+    # Min and max of each group of factor samples
+    lower: RingBuffer = dataclasses.field(init=False, default=None)
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        self.lower = RingBuffer(self.capacity)
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        groups, start = self._groups(values, start, interval)
+        if len(groups):
+            centre = start + (self.factor - 1) / 2 * interval
+            self.output.append(groups.max(axis=1), 1.0, centre, interval * self.factor)
+            self.lower.append(groups.min(axis=1), 1.0, centre, interval * self.factor)
+        return
+
+
+@dataclasses.dataclass
+class CIC:
+    # Cascaded integrator-comb decimator of the given order, computed as its equivalent FIR (a boxcar
+    # of length factor convolved order times) on floats, with unit DC gain. Only the kept outputs are
+    # computed, one dot product per output, so a block costs len(values) / factor * len(kernel).
+    # Samples are kept across blocks so the output equals filtering the whole stream at once.
+    factor: int
+    order: int = 3
+    capacity: int = 2 ** 16
+    output: RingBuffer = dataclasses.field(init=False, default=None)
+    _kernel: np.ndarray = dataclasses.field(init=False, default=None, repr=False)
+    _history: np.ndarray = dataclasses.field(init=False, default=None, repr=False)
+    _count: int = dataclasses.field(init=False, default=0, repr=False)
+
+    def __post_init__(self) -> None:
+        self.output = RingBuffer(self.capacity)
+        kernel = np.ones(1)
+        for _ in range(self.order):
+            kernel = np.convolve(kernel, np.ones(self.factor))
+        self._kernel = kernel / kernel.sum()
+        self._history = np.zeros(0)
+
+    def update(self, values: np.ndarray, start: float, interval: float) -> None:
+        k = len(self._kernel)
+        data = np.concatenate([self._history, values])
+        offset = self._count - len(self._history)  # stream index of data[0]
+        data_start = start - len(self._history) * interval
+        self._count += len(values)
+        self._history = data[max(len(data) - (k - 1), 0):]
+        if len(data) < k:
+            return
+        # Filter output j covers data[j:j + k]; keep the outputs at every factor-th stream index
+        first = (-offset) % self.factor
+        windows = np.lib.stride_tricks.sliding_window_view(data, k)[first::self.factor]
+        filtered = windows @ self._kernel[::-1]
+        if len(filtered):
+            self.output.append(filtered, 1.0, data_start + (first + (k - 1) / 2) * interval, interval * self.factor)
+        return
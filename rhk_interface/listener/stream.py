@@ -0,0 +1,186 @@
+import dataclasses
+from typing import List, Tuple
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+
+@dataclasses.dataclass
+class RingBuffer:
+    # Preallocated sample store. Writes wrap around and overwrite the oldest samples.
+    capacity: int
+    values: np.ndarray = dataclasses.field(init=False, repr=False)
+    times: np.ndarray = dataclasses.field(init=False, repr=False)
+    count: int = dataclasses.field(init=False, default=0)  # samples written since start
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False)
+    _ramp: np.ndarray = dataclasses.field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self.values = np.zeros(self.capacity)
+        self.times = np.zeros(self.capacity)
+        self._ramp = np.arange(0)
+
+    def append(self, data: np.ndarray, gain: float, start: float, interval: float) -> None:
+        # Stores data * gain with times start + i * interval (s)
+        n = len(data)
+        if n > self.capacity:
+            data = data[-self.capacity:]
+            start += (n - self.capacity) * interval
+            n = self.capacity
+        if len(self._ramp) < n:
+            self._ramp = np.arange(n, dtype=float)
+        with self._lock:
+            position = self.count % self.capacity
+            first = min(n, self.capacity - position)
+            for (a, b), (c, d) in (((position, position + first), (0, first)), ((0, n - first), (first, n))):
+                if b > a:
+                    np.multiply(data[c:d], gain, out=self.values[a:b])
+                    np.multiply(self._ramp[c:d], interval, out=self.times[a:b])
+                    self.times[a:b] += start
+            self.count += n
+        return
+
+    def _segments(self) -> List[Tuple[int, int]]:
+        # Index ranges holding valid samples, oldest first
+        if self.count <= self.capacity:
+            return [(0, self.count)]
+        position = self.count % self.capacity
+        return [(position, self.capacity), (0, position)]
+
+    def _window_segments(self, seconds: float) -> List[Tuple[int, int]]:
+        if self.count == 0:
+            return []
+        end = self.times[(self.count - 1) % self.capacity]
+        segments = []
+        for a, b in self._segments():
+            if b > a:
+                segments.append((a + int(np.searchsorted(self.times[a:b], end - seconds)), b))
+        return segments
+
+    def latest(self) -> Tuple[float, float]:
+        with self._lock:
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % self.capacity
+            return self.times[i], self.values[i]
+
+    def window(self, seconds: float) -> Tuple[np.ndarray, np.ndarray]:
+        # Copies of the times and values of the last seconds of samples
+        with self._lock:
+            segments = self._window_segments(seconds)
+            times = np.concatenate([self.times[a:b] for a, b in segments]) if segments else np.zeros(0)
+            values = np.concatenate([self.values[a:b] for a, b in segments]) if segments else np.zeros(0)
+        return times, values
+
+    def mean(self, seconds: float) -> float:
+        with self._lock:
+            segments = self._window_segments(seconds)
+            n = sum(b - a for a, b in segments)
+            if n == 0:
+                return float('nan')
+            return sum(self.values[a:b].sum() for a, b in segments) / n
+
+
+@dataclasses.dataclass
+class Stream:
+    # Keeps one UDP socket bound to port and appends every packet to a ring buffer from a background thread
+    listener: 'Listener' = dataclasses.field(repr=False)
+    port: int
+    capacity: int = 2 ** 20  # samples
+    recorder: 'Recorder' = None  # also appends every raw packet to disk
+    buffer: RingBuffer = dataclasses.field(init=False, default=None)
+    label: str = dataclasses.field(init=False, default=None)
+    unit: str = dataclasses.field(init=False, default=None)
+    interval: float = dataclasses.field(init=False, default=None)
+    packet_count: int = dataclasses.field(init=False, default=0)
+    bad_packet_count: int = dataclasses.field(init=False, default=0)  # packets too short or malformed to decode
+    operators: list = dataclasses.field(init=False, default_factory=list)
+    thread: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+    RECEIVE_BUFFER = 2 ** 22  # (bytes) kernel socket buffer, absorbs bursts while the thread is busy
+    POLL_TIMEOUT = 0.2  # (s) how often the thread checks for stop()
+
+    def __post_init__(self) -> None:
+        self.buffer = RingBuffer(self.capacity)
+        self._socket = None
+        self._running = False
+
+    def __enter__(self) -> 'Stream':
+        if self.thread is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER)
+        self._socket.settimeout(self.POLL_TIMEOUT)
+        self._socket.bind((self.listener.IP_Address, self.port))
+        self._running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return
+
+    def stop(self) -> None:
+        self._running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        return
+
+    def _run(self) -> None:
+        packet = bytearray(max(self.listener.BUFFER_SIZE, 2 ** 16))
+        view = memoryview(packet)
+        while self._running:
+            try:
+                size = self._socket.recv_into(packet)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            self._handle(view[:size])
+
+    def _handle(self, packet: memoryview) -> None:
+        # Records, decodes and stores one packet; also called by MultiStream for each of its channels
+        if self.recorder is not None:
+            self.recorder.write(packet)
+        start = time.perf_counter()
+        try:
+            result, offset = self.listener.decode(packet)
+            if self.listener.metrics is not None:
+                self.listener._record(self.port, len(packet), result, offset, time.perf_counter() - start)
+            self.label, self.unit, self.interval = result['label'], result['unit'], float(result['interval'])
+            sample_start = int(result['timestamp']) * self.listener.TIMESTAMP_UNIT
+            self.buffer.append(result['data'], float(result['gain']), sample_start, self.interval)
+            if self.operators:
+                values = result['data'] * float(result['gain'])
+                for operator in self.operators:
+                    operator.update(values, sample_start, self.interval)
+        except (struct.error, ValueError, IndexError):
+            # A truncated or malformed packet is counted and skipped, the capture goes on
+            self.bad_packet_count += 1
+            if self.listener.metrics is not None:
+                self.listener.metrics.increment('listener_short_packets', str(self.port))
+            return
+        self.packet_count += 1
+        return
+
+    def attach(self, operator):
+        # Feed every following packet to operator.update, e.g. a RunningStats or Boxcar from listener.stats
+        self.operators.append(operator)
+        return operator
+
+    def latest(self) -> Tuple[float, float]:
+        return self.buffer.latest()
+
+    def window(self, seconds: float) -> Tuple[np.ndarray, np.ndarray]:
+        return self.buffer.window(seconds)
+
+    def mean(self, seconds: float) -> float:
+        return self.buffer.mean(seconds)
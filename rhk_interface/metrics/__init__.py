@@ -0,0 +1,159 @@
+import bisect
+import dataclasses
+from typing import List
+import json
+import threading
+import time
+
+# Upper bounds of the histogram buckets (s), roughly log spaced from 10 us to 30 s
+BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+@dataclasses.dataclass
+class Histogram:
+    counts: List[int] = dataclasses.field(default_factory=lambda: [0] * (len(BUCKETS) + 1))
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        return
+
+    def quantile(self, q: float) -> float:
+        # Linear interpolation inside the bucket holding the q-th observation
+        if self.count == 0:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+    def summary(self) -> dict:
+        return dict(
+            count=self.count,
+            sum=self.total,
+            mean=self.total / self.count if self.count else float('nan'),
+            p50=self.quantile(0.5),
+            p99=self.quantile(0.99),
+            max=self.max,
+        )
+
+
+@dataclasses.dataclass
+class Metrics:
+    # Timing histograms and counters, each keyed by a metric name and one label value
+    # (e.g. the R9 command or the UDP port).
+    prefix: str = 'rhk'
+    histograms: dict = dataclasses.field(init=False, default_factory=dict)
+    counters: dict = dataclasses.field(init=False, default_factory=dict)
+    started: float = dataclasses.field(init=False, default_factory=time.monotonic)
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False)
+    _exporter: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+    _exporter_stop: threading.Event = dataclasses.field(init=False, default=None, repr=False)
+
+    def observe(self, name: str, key: str, seconds: float) -> None:
+        with self._lock:
+            family = self.histograms.setdefault(name, {})
+            histogram = family.get(key)
+            if histogram is None:
+                histogram = family[key] = Histogram()
+            histogram.observe(seconds)
+        return
+
+    def increment(self, name: str, key: str = '', n: int = 1) -> None:
+        with self._lock:
+            family = self.counters.setdefault(name, {})
+            family[key] = family.get(key, 0) + n
+        return
+
+    def reset(self) -> None:
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.monotonic()
+        return
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            return dict(
+                time=time.time(),
+                uptime=uptime,
+                counters={name: dict(family) for name, family in self.counters.items()},
+                rates={name: {key: n / uptime for key, n in family.items()} for name, family in self.counters.items()},
+                histograms={name: {key: histogram.summary() for key, histogram in family.items()} for name, family in self.histograms.items()},
+            )
+
+    def to_json_line(self) -> str:
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, family in self.counters.items():
+                metric = f'{self.prefix}_{name}_total'
+                lines.append(f'# TYPE {metric} counter')
+                for key, n in family.items():
+                    lines.append(f'{metric}{_labels(key)} {n}')
+            for name, family in self.histograms.items():
+                metric = f'{self.prefix}_{name}_seconds'
+                lines.append(f'# TYPE {metric} histogram')
+                for key, histogram in family.items():
+                    cumulative = 0
+                    for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += n
+                        lines.append(f'{metric}_bucket{_labels(key, le=bound)} {cumulative}')
+                    lines.append(f'{metric}_sum{_labels(key)} {histogram.total}')
+                    lines.append(f'{metric}_count{_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str, format: str = 'json') -> None:
+        # 'json' appends one snapshot line; 'prometheus' rewrites the file for a textfile collector
+        if format == 'json':
+            with open(path, 'a') as f:
+                f.write(self.to_json_line() + '\n')
+        elif format == 'prometheus':
+            with open(path, 'w') as f:
+                f.write(self.to_prometheus())
+        else:
+            raise ValueError('Unknown format')
+        return
+
+    def start_exporter(self, path: str, interval: float = 60.0, format: str = 'json') -> None:
+        # Replaces a running exporter, whose thread stops on its own event
+        self.stop_exporter()
+        stop = threading.Event()
+        def run() -> None:
+            while not stop.wait(interval):
+                self.write(path, format)
+        self._exporter = threading.Thread(target=run, daemon=True)
+        self._exporter_stop = stop
+        self._exporter.start()
+        return
+
+    def stop_exporter(self) -> None:
+        if self._exporter is not None:
+            self._exporter_stop.set()
+            self._exporter.join()
+        self._exporter = None
+        return
+
+
+def _labels(key: str, **extra) -> str:
+    labels = {'key': key} if key != '' else {}
+    labels.update({name: str(value) for name, value in extra.items()})
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
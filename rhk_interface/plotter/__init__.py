@@ -9,6 +9,13 @@ from plotly.missing_ipywidgets import FigureWidget
 from plotly.subplots import make_subplots
 from xarray.core.dataarray import DataArray
 from xarray.core.dataset import Dataset
+from . import lod
+from . import pipeline
+from . import sm4
+from . import spectra
+from .cache import FrameCache
+from .catalogue import Catalogue
+from .grid import GridCube
 
 
 @dataclasses.dataclass
@@ -18,6 +25,13 @@ class Plotter:
     path_dir: str
     file_prefix: str
     file_prefix_STS: str
+    cache: FrameCache = None  # shared by copies of the Plotter; pass one to share it between Plotters
+    lazy: bool = False  # read sm4 files with plotter.sm4, decoding only the channels used, instead of spym.load
+    catalogue: Catalogue = None  # metadata of path_dir, created by find()
+    spec_split: bool = False  # average forward (even) and backward (odd) sweeps of each location separately
+    spec_reject: float = None  # drop sweeps further than this many robust sigmas from the median sweep
+    lod: bool = False  # draw images from a resolution pyramid sized to the figure instead of at full resolution
+    lod_pixels: int = 600  # data points across the visible range of a lod image
     file_index: int = dataclasses.field(init=False, default=None)
     path_file: str = dataclasses.field(init=False, default=None)
     data_image: Dataset = dataclasses.field(init=False, default=None)
@@ -25,7 +39,8 @@ class Plotter:
     data_topo: DataArray = dataclasses.field(init=False, default=None)
     data_didv: DataArray = dataclasses.field(init=False, default=None)
     data_spec: DataArray = dataclasses.field(init=False, default=None)
-    spec_list: list = dataclasses.field(init=False, default_factory=list)
+    spec_list: np.ndarray = dataclasses.field(init=False, default=None)
+    spec_list_backward: np.ndarray = dataclasses.field(init=False, default=None)
     attrs_image: dict = dataclasses.field(init=False, default_factory=dict)
     attrs_spec: dict = dataclasses.field(init=False, default_factory=dict)
     bias_image: float = dataclasses.field(init=False, default=None)
@@ -44,6 +59,9 @@ class Plotter:
     trace_spec: List[FigureWidget] = dataclasses.field(init=False, default_factory=list)
     trace_spec_location: List[FigureWidget] = dataclasses.field(init=False, default_factory=list)
 
+    grid: GridCube = dataclasses.field(init=False, default=None)
+    pyramids: dict = dataclasses.field(init=False, default_factory=dict)
+
     spec_location_x: np.ndarray = dataclasses.field(init=False, default=None)
     spec_location_y: np.ndarray = dataclasses.field(init=False, default=None)
     width_single = 600
@@ -53,15 +71,36 @@ class Plotter:
     def __post_init__(self) -> None:
         if not os.path.exists(self.path_dir):
             raise ValueError('No such directory')
-        else:
-            return
+        if self.cache is None:
+            self.cache = FrameCache()
+        return
+
+    def _cached(self, path: str, steps: tuple, load):
+        value = self.cache.get(path, steps)
+        if value is None:
+            value = self.cache.put(path, steps, load())
+        return value
+
+    def _load(self, path: str, datatype_separate: bool):
+        if self.lazy:
+            return sm4.load(path, datatype_separate=datatype_separate)
+        return spym.load(path, datatype_separate=datatype_separate)
+
+    def find(self, **conditions) -> List[int]:
+        # Indices of the files matching conditions (see Catalogue.query), e.g.
+        # find(kind='image', bias=1.0, setpoint=1e-10, since='2024-05-01'); prefix defaults to file_prefix
+        if self.catalogue is None:
+            self.catalogue = Catalogue(self.path_dir)
+        self.catalogue.update()
+        conditions.setdefault('prefix', self.file_prefix)
+        return self.catalogue.indices(**conditions)
 
     def load_file(self, data_index: int) -> tuple:
         self.file_index = data_index
         self.path_file = os.path.join(self.path_dir, self.file_prefix + str(self.file_index).zfill(4) + '.sm4')
         if not os.path.exists(self.path_file):
             raise ValueError('No such data file')
-        self.data_image, self.data_line = spym.load(self.path_file, datatype_separate=True)
+        self.data_image, self.data_line = self._cached(self.path_file, ('load', 'separate'), lambda: self._load(self.path_file, datatype_separate=True))
         return self.data_image, self.data_line
 
     def load_file_STS(self, data_index: int) -> tuple:
@@ -69,14 +108,35 @@ class Plotter:
         self.path_file = os.path.join(self.path_dir, self.file_prefix_STS + str(self.file_index).zfill(4) + '.sm4')
         if not os.path.exists(self.path_file):
             raise ValueError('No such data file')
-        self.data_line = spym.load(self.path_file, datatype_separate=False)
+        self.data_line = self._cached(self.path_file, ('load',), lambda: self._load(self.path_file, datatype_separate=False))
         return self.data_line
 
+    def level_topo(self) -> DataArray:
+        # Leveled copy of Topography_Forward; the loaded Dataset stays as read from the file
+        data_topo = self.data_image.Topography_Forward.copy()
+        data_topo.spym.align()
+        data_topo.spym.plane()
+        data_topo.spym.fixzero()
+        return data_topo
+
+    def load_stack(self, indices: List[int], steps: tuple = ('align', 'plane', 'fixzero'), out: np.ndarray = None, **kwargs) -> DataArray:
+        # Topography_Forward of many files processed as one (frame, y, x) stack, see plotter.pipeline.process.
+        # Frames are read chunk by chunk; out, e.g. a memmap of shape (len(indices), y, x), receives the result.
+        stack = pipeline.FileStack(self, indices)
+        return stack.dataarray(pipeline.process(stack, steps, out=out, **kwargs))
+
+    def load_grid(self, data_index: int, channel: str = 'LIA_Current_Spec', current: str = None, STS: bool = False, **kwargs) -> GridCube:
+        # Grid spectroscopy of file data_index as a (y, x, bias) cube, memory-mapped rather than loaded
+        self.file_index = data_index
+        prefix = self.file_prefix_STS if STS else self.file_prefix
+        self.path_file = os.path.join(self.path_dir, prefix + str(self.file_index).zfill(4) + '.sm4')
+        if not os.path.exists(self.path_file):
+            raise ValueError('No such data file')
+        self.grid = GridCube.from_sm4(self.path_file, channel, current, **kwargs)
+        return self.grid
+
     def load_image(self) -> None:
-        self.data_topo = self.data_image.Topography_Forward
-        self.data_topo.spym.align()
-        self.data_topo.spym.plane()
-        self.data_topo.spym.fixzero()
+        self.data_topo = self._cached(self.path_file, ('Topography_Forward', 'align', 'plane', 'fixzero'), self.level_topo)
 
         self.data_didv = self.data_image.LIA_Current_Forward
 
@@ -136,17 +196,15 @@ class Plotter:
 
     def load_spec(self) -> None:
         self.data_spec = self.data_line.LIA_Current_Spec
-        self.spec_num = int(len(self.data_spec.values) / self.spec_average_num)
-        self.spec_list = []
-        for i in range(self.spec_num):
-            self.spec_list.append(self.data_spec.values[i * self.spec_average_num:(i + 1) * self.spec_average_num - 1].mean(axis=0))
+        self.spec_list, self.spec_list_backward = spectra.average_spectra(self.data_spec.values, self.spec_average_num, self.spec_split, self.spec_reject)
+        self.spec_num = len(self.spec_list)
 
         self.attrs_spec = self.data_spec.spym._dr.attrs
         self.bias_spec = self.attrs_spec['bias']
         self.bias_mod_spec = self.attrs_spec['bias_modulation']
         self.current_spec = self.attrs_spec['setpoint']
-        self.spec_location_x = np.array(self.attrs_spec['RHK_SpecDrift_Xcoord'])[0::self.spec_average_num] * 1e9
-        self.spec_location_y = np.array(self.attrs_spec['RHK_SpecDrift_Ycoord'])[0::self.spec_average_num] * 1e9
+        self.spec_location_x = np.array(self.attrs_spec['RHK_SpecDrift_Xcoord'])[0::self.spec_average_num][:self.spec_num] * 1e9
+        self.spec_location_y = np.array(self.attrs_spec['RHK_SpecDrift_Ycoord'])[0::self.spec_average_num][:self.spec_num] * 1e9
         self.xaxis_spec = dict(
             title='Voltage (V)',
             ticks='outside',
@@ -173,24 +231,40 @@ class Plotter:
             self.attrs_spec["bias_modulation_units"])
         return
 
+    def _image_xyz(self, data: DataArray, steps: tuple, name: str, shift: tuple = (0.0, 0.0)) -> tuple:
+        # Full-resolution arrays, or with lod the level of the frame's cached pyramid that matches the figure
+        if not self.lod:
+            return data.x + shift[0], data.y + shift[1], data.values
+        pyramid = self._cached(self.path_file, steps + ('pyramid',), lambda: lod.Pyramid(data.x.values, data.y.values, data.values))
+        self.pyramids[name] = (pyramid, shift)
+        x, y, z = pyramid.view(self.lod_pixels)
+        return x + shift[0], y + shift[1], z
+
     def get_trace_topo(self, offset: bool = False) -> None:
         self.load_image()
+        steps = ('Topography_Forward', 'align', 'plane', 'fixzero')
         if offset:
+            shift = (
+                float(self.data_topo.x.offset - (self.data_topo.x.max() - self.data_topo.x.min()) / 2),
+                float(self.data_topo.y.offset - (self.data_topo.y.max() - self.data_topo.y.min()) / 2),
+            )
+            x, y, z = self._image_xyz(self.data_topo, steps, 'Topography', shift)
             self.trace_topo = go.Heatmap(
-                x=self.data_topo.x + self.data_topo.x.offset - (self.data_topo.x.max() - self.data_topo.x.min()) / 2,
-                y=self.data_topo.y + self.data_topo.y.offset - (self.data_topo.y.max() - self.data_topo.y.min()) / 2,
-                z=self.data_topo.values,
+                x=x,
+                y=y,
+                z=z,
                 colorscale="Solar",
                 name='Topography',
                 zsmooth='best'
             )
-            self.xaxis_image['range'] = (self.data_topo.x.min() + self.data_topo.x.offset - (self.data_topo.x.max() - self.data_topo.x.min()) / 2, self.data_topo.x.max() + self.data_topo.x.offset - (self.data_topo.x.max() - self.data_topo.x.min()) / 2)
-            self.yaxis_image['range'] = (self.data_topo.y.min() + self.data_topo.y.offset - (self.data_topo.y.max() - self.data_topo.y.min()) / 2, self.data_topo.y.max() + self.data_topo.y.offset - (self.data_topo.y.max() - self.data_topo.y.min()) / 2)
+            self.xaxis_image['range'] = (self.data_topo.x.min() + shift[0], self.data_topo.x.max() + shift[0])
+            self.yaxis_image['range'] = (self.data_topo.y.min() + shift[1], self.data_topo.y.max() + shift[1])
         else:
+            x, y, z = self._image_xyz(self.data_topo, steps, 'Topography')
             self.trace_topo = go.Heatmap(
-                x=self.data_topo.x,
-                y=self.data_topo.y,
-                z=self.data_topo.values,
+                x=x,
+                y=y,
+                z=z,
                 colorscale="Solar",
                 name='Topography',
                 zsmooth='best'
@@ -199,78 +273,82 @@ class Plotter:
 
     def get_trace_didv(self) -> None:
         self.load_image()
+        x, y, z = self._image_xyz(self.data_didv, ('LIA_Current_Forward',), 'dI/dV')
         self.trace_didv = go.Heatmap(
-            x=self.data_didv.x,
-            y=self.data_didv.y,
-            z=self.data_didv.values,
+            x=x,
+            y=y,
+            z=z,
             colorscale="Gray",
             name='dI/dV',
             zsmooth='best'
         )
         return
 
-    def get_trace_spec(self, average_num: int) -> None:
-        self.spec_average_num = average_num
-        self.load_spec()
+    def zoomable(self, fig) -> FigureWidget:
+        # FigureWidget of fig whose lod heatmaps load finer pyramid levels as they are zoomed (needs ipywidgets)
+        widget = go.FigureWidget(fig)
+        for i, trace in enumerate(widget.data):
+            if trace.type == 'heatmap' and trace.name in self.pyramids:
+                pyramid, shift = self.pyramids[trace.name]
+                lod.attach(widget, i, pyramid, self.lod_pixels, shift)
+        return widget
+
+    def _spec_traces(self, names: List[str], colors: List[str]) -> None:
+        # One WebGL line per location (dashed for backward sweeps) and a single marker trace for all locations
+        # Lines sharing a name (all locations of one file in get_trace_spec2) share one legend entry
+        x = self.data_spec.x.values
         self.trace_spec = []
-        self.trace_spec_location = []
+        named = set()
         for i in range(self.spec_num):
-            self.trace_spec.append(go.Scatter(
-                x=self.data_spec.x.values,
+            self.trace_spec.append(go.Scattergl(
+                x=x,
                 y=self.spec_list[i],
                 mode='lines',
-                name="Point" + str(i),
-                marker_color=str(px.colors.qualitative.Plotly[i]),
-                showlegend=True,
+                name=names[i],
+                legendgroup=names[i],
+                line=dict(color=colors[i]),
+                showlegend=names[i] not in named,
             ))
-
-            self.trace_spec_location.append(go.Scatter(
-                x=[self.spec_location_x[i]],
-                y=[self.spec_location_y[i]],
-                mode='markers+text',
-                text=['Point' + str(i)],
-                textposition="middle right",
-                name="Point" + str(i),
-                marker=dict(
-                    color=str(px.colors.qualitative.Plotly[i]),
-                    size=15,
-                    line=dict(
-                        width=2
-                    ),
+            named.add(names[i])
+        if self.spec_list_backward is not None:
+            for i in range(self.spec_num):
+                self.trace_spec.append(go.Scattergl(
+                    x=x,
+                    y=self.spec_list_backward[i],
+                    mode='lines',
+                    name=names[i] + ' backward',
+                    legendgroup=names[i],
+                    line=dict(color=colors[i], dash='dash'),
+                    showlegend=False,
+                ))
+        self.trace_spec_location = [go.Scattergl(
+            x=self.spec_location_x,
+            y=self.spec_location_y,
+            mode='markers+text' if self.spec_num <= len(spectra.QUALITATIVE) else 'markers',
+            text=names,
+            hovertext=names,
+            textposition="middle right",
+            name='Location',
+            marker=dict(
+                color=colors,
+                size=15 if self.spec_num <= len(spectra.QUALITATIVE) else 8,
+                line=dict(
+                    width=2 if self.spec_num <= len(spectra.QUALITATIVE) else 0
                 ),
-                showlegend=False))
+            ),
+            showlegend=False)]
         return
 
-    def get_trace_spec2(self, average_num: int, index_ext: int) -> None:
+    def get_trace_spec(self, average_num: int) -> None:
         self.spec_average_num = average_num
         self.load_spec()
-        self.trace_spec = []
-        self.trace_spec_location = []
-        for i in range(self.spec_num):
-            self.trace_spec.append(go.Scatter(
-                x=self.data_spec.x.values,
-                y=self.spec_list[i],
-                mode='lines',
-                name="Point" + str(index_ext),
-                marker_color=str(px.colors.qualitative.Plotly[index_ext]),
-                showlegend=True,
-            ))
+        self._spec_traces(["Point" + str(i) for i in range(self.spec_num)], spectra.spec_colors(self.spec_num))
+        return
 
-            self.trace_spec_location.append(go.Scatter(
-                x=[self.spec_location_x[i]],
-                y=[self.spec_location_y[i]],
-                mode='markers+text',
-                text=['Point' + str(index_ext)],
-                textposition="middle right",
-                name="Point" + str(index_ext),
-                marker=dict(
-                    color=str(px.colors.qualitative.Plotly[index_ext]),
-                    size=15,
-                    line=dict(
-                        width=2
-                    ),
-                ),
-                showlegend=False))
+    def get_trace_spec2(self, average_num: int, index_ext: int) -> None:
+        self.spec_average_num = average_num
+        self.load_spec()
+        self._spec_traces(["Point" + str(index_ext)] * self.spec_num, [spectra.spec_color(index_ext)] * self.spec_num)
         return
 
     def fig_topo(self, data_index: int) -> FigureWidget:
@@ -308,9 +386,8 @@ class Plotter:
         fig.update_traces(colorbar=self.colorbar_topo, row=1, col=1)
         self.load_file(data_index_spec)
         self.get_trace_spec(average_num)
-        for i in range(self.spec_num):
-            fig.add_trace(self.trace_spec_location[i], row=1, col=1,)
-            fig.add_trace(self.trace_spec[i], row=1, col=2,)
+        fig.add_traces(self.trace_spec_location, rows=1, cols=1)
+        fig.add_traces(self.trace_spec, rows=1, cols=2)
         fig.update_layout(title_text=self.title, xaxis=self.xaxis_image, yaxis=self.yaxis_image, xaxis2=self.xaxis_spec, yaxis2=self.yaxis_spec, height=self.height, width=self.width_double, template='plotly_white')
         if self.display_flag:
             fig.show()
@@ -326,9 +403,17 @@ class Plotter:
         for i, data_index_spec in enumerate(data_index_spec_list):
             self.load_file_STS(data_index_spec)
             self.get_trace_spec2(average_num, i)
-            fig.add_trace(self.trace_spec_location[0], row=1, col=1,)
-            fig.add_trace(self.trace_spec[0], row=1, col=2,)
+            fig.add_traces(self.trace_spec_location, rows=1, cols=1)
+            fig.add_traces(self.trace_spec, rows=1, cols=2)
         fig.update_layout(title_text=self.title, xaxis=self.xaxis_image, yaxis=self.yaxis_image, xaxis2=self.xaxis_spec, yaxis2=self.yaxis_spec, height=self.height, width=self.width_double, template='plotly_white')
         if self.display_flag:
             fig.show()
         return fig
+
+    def fig_grid(self, data_index: int, count: int = 64, normalization: bool = False, STS: bool = False, **kwargs) -> FigureWidget:
+        self.load_grid(data_index, STS=STS, normalization=normalization, **kwargs)
+        fig = self.grid.viewer(count, width=self.width_double, height=self.height)
+        fig.update_layout(title_text=os.path.basename(self.path_file))
+        if self.display_flag:
+            fig.show()
+        return fig
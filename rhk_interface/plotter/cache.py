@@ -0,0 +1,79 @@
+import collections
+import dataclasses
+from typing import Any, Hashable, Tuple
+import os
+import threading
+import numpy as np
+
+
+def nbytes(value: Any) -> int:
+    # Memory held by the arrays of a cached value (Dataset, DataArray, ndarray or a tuple of them)
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    size = getattr(value, 'nbytes', 0)
+    return int(size) if isinstance(size, (int, np.integer)) else 0
+
+
+def file_key(path: str) -> Tuple[str, int, int]:
+    # Changes whenever the file is rewritten, so stale entries are never returned
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+@dataclasses.dataclass
+class FrameCache:
+    # LRU cache of loaded and processed sm4 data, keyed by (file_key(path), processing steps).
+    # The least recently used entries are evicted once the arrays held exceed max_bytes.
+    max_bytes: int = 2 ** 28
+    size: int = dataclasses.field(init=False, default=0)
+    hits: int = dataclasses.field(init=False, default=0)
+    misses: int = dataclasses.field(init=False, default=0)
+    _entries: collections.OrderedDict = dataclasses.field(init=False, default_factory=collections.OrderedDict, repr=False)
+    _lock: threading.Lock = dataclasses.field(init=False, default_factory=threading.Lock, repr=False)
+
+    def __getstate__(self) -> dict:
+        # A copy sent to another process starts empty
+        return dict(max_bytes=self.max_bytes)
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, path: str, steps: Tuple[Hashable, ...]) -> Any:
+        key = (file_key(path), steps)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            self.misses += 1
+        return None
+
+    def put(self, path: str, steps: Tuple[Hashable, ...], value: Any) -> Any:
+        key = (file_key(path), steps)
+        size = nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._entries.pop(key)
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            # Values of plotter.sm4.load decode pages after they were put, so every entry is measured again
+            self.size = 0
+            for entry_key, (entry, _) in list(self._entries.items()):
+                self._entries[entry_key] = (entry, nbytes(entry))
+                self.size += self._entries[entry_key][1]
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        return
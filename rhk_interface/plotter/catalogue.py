@@ -0,0 +1,190 @@
+import dataclasses
+from typing import List
+import contextlib
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import struct
+from . import sm4
+
+# SQLite catalogue of the header metadata of every .sm4 file in a directory. update() parses only
+# files that are new or whose mtime or size changed, from their page headers alone (plotter.sm4), and
+# drops files that were removed, so rescanning a directory of thousands of files costs one stat each.
+
+FILE_NAME = re.compile(r'^(.*?)(\d+)\.sm4$', re.IGNORECASE)
+COLUMNS = (
+    ('path', 'TEXT PRIMARY KEY'),
+    ('name', 'TEXT'),
+    ('prefix', 'TEXT'),
+    ('file_index', 'INTEGER'),
+    ('mtime_ns', 'INTEGER'),
+    ('size', 'INTEGER'),
+    ('datetime', 'TEXT'),
+    ('kind', 'TEXT'),  # 'image' if the file has image pages, else 'spectrum'
+    ('bias', 'REAL'),  # (V)
+    ('setpoint', 'REAL'),  # (A)
+    ('bias_modulation', 'REAL'),  # (V)
+    ('scan_size_x', 'REAL'),  # (nm)
+    ('scan_size_y', 'REAL'),  # (nm)
+    ('x_offset', 'REAL'),  # (nm)
+    ('y_offset', 'REAL'),  # (nm)
+    ('x_pixels', 'INTEGER'),
+    ('y_pixels', 'INTEGER'),
+    ('spec_count', 'INTEGER'),
+    ('spec_x', 'TEXT'),  # JSON list of the spectroscopy locations (nm)
+    ('spec_y', 'TEXT'),
+    ('channels', 'TEXT'),  # JSON list of page labels
+)
+JSON_COLUMNS = ('spec_x', 'spec_y', 'channels')
+
+
+def describe(path: str) -> dict:
+    # Catalogue row of one file, from its page headers
+    f = sm4.SM4File(path)
+    images = [page for page in f.pages if page.is_image]
+    lines = [page for page in f.pages if page.is_line]
+    attrs = (images or lines or f.pages)[0].attrs
+    match = FILE_NAME.match(os.path.basename(path))
+    stat = os.stat(path)
+    row = dict(
+        path=os.path.abspath(path),
+        name=os.path.basename(path),
+        prefix=match.group(1) if match else None,
+        file_index=int(match.group(2)) if match else None,
+        mtime_ns=stat.st_mtime_ns,
+        size=stat.st_size,
+        datetime=attrs.get('RHK_DateTime'),
+        kind='image' if images else 'spectrum',
+        bias=float(attrs['RHK_Bias']),
+        setpoint=float(attrs.get('RHK_ZPI_SetPoint', attrs['RHK_Current'])),
+        bias_modulation=float(attrs.get('RHK_CH1DriveValue', 0.0)),
+        scan_size_x=None,
+        scan_size_y=None,
+        x_offset=float(attrs['RHK_Xoffset']) * 1e9,
+        y_offset=float(attrs['RHK_Yoffset']) * 1e9,
+        x_pixels=None,
+        y_pixels=None,
+        spec_count=sum(int(page.attrs['RHK_Ysize']) for page in lines[:1]),
+        spec_x=[],
+        spec_y=[],
+        channels=f.channels,
+    )
+    if images:
+        row.update(
+            scan_size_x=abs(float(attrs['RHK_Xscale'])) * attrs['RHK_Xsize'] * 1e9,
+            scan_size_y=abs(float(attrs['RHK_Yscale'])) * attrs['RHK_Ysize'] * 1e9,
+            x_pixels=int(attrs['RHK_Xsize']),
+            y_pixels=int(attrs['RHK_Ysize']),
+        )
+    for page in lines:
+        if 'RHK_SpecDrift_Xcoord' in page.attrs:
+            row.update(
+                spec_x=[x * 1e9 for x in page.attrs['RHK_SpecDrift_Xcoord'].tolist()],
+                spec_y=[y * 1e9 for y in page.attrs['RHK_SpecDrift_Ycoord'].tolist()],
+            )
+            break
+    return row
+
+
+@dataclasses.dataclass
+class Catalogue:
+    path_dir: str
+    path_db: str = None  # defaults to a file in CACHE_DIR named after path_dir, which may be read-only
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rhk_interface')
+
+    def __post_init__(self) -> None:
+        if self.path_db is None:
+            path_dir = os.path.abspath(self.path_dir)
+            key = hashlib.sha1(path_dir.encode()).hexdigest()[:16]
+            os.makedirs(self.CACHE_DIR, exist_ok=True)
+            self.path_db = os.path.join(self.CACHE_DIR, f'{os.path.basename(path_dir)}-{key}.sqlite')
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS files ({})'.format(', '.join(name + ' ' + kind for name, kind in COLUMNS)))
+            db.execute('CREATE INDEX IF NOT EXISTS files_index ON files (prefix, file_index)')
+            db.commit()
+        return
+
+    @contextlib.contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path_db)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def update(self) -> dict:
+        # Index new and changed files, forget removed ones; returns the number of files of each kind
+        with self._connect() as db:
+            known = {row['path']: (row['mtime_ns'], row['size']) for row in db.execute('SELECT path, mtime_ns, size FROM files')}
+            seen = set()
+            added, changed, failed = 0, 0, 0
+            for entry in os.scandir(self.path_dir):
+                if not entry.is_file() or not entry.name.lower().endswith('.sm4'):
+                    continue
+                path = os.path.abspath(entry.path)
+                seen.add(path)
+                stat = entry.stat()
+                if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                try:
+                    row = describe(path)
+                except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+                    # Usually a file R9 is still writing; it is retried on the next update
+                    print(f'Catalogue: cannot read {entry.name}: {e}')
+                    failed += 1
+                    continue
+                for name in JSON_COLUMNS:
+                    row[name] = json.dumps(row[name])
+                db.execute('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+                    ', '.join(name for name, _ in COLUMNS), ', '.join('?' * len(COLUMNS))),
+                    [row[name] for name, _ in COLUMNS])
+                if path in known:
+                    changed += 1
+                else:
+                    added += 1
+            removed = [(path,) for path in known if path not in seen]
+            db.executemany('DELETE FROM files WHERE path = ?', removed)
+            db.commit()
+        return dict(added=added, changed=changed, removed=len(removed), failed=failed, total=len(seen) - failed)
+
+    def query(self, kind: str = None, prefix: str = None, bias: float = None, setpoint: float = None,
+              bias_modulation: float = None, since: str = None, until: str = None, channel: str = None,
+              tolerance: float = 0.01, order: str = 'file_index') -> List[dict]:
+        # Rows matching every given condition. bias, setpoint and bias_modulation match within a relative
+        # tolerance; since and until are ISO dates or datetimes compared with the file's datetime.
+        conditions, parameters = [], []
+        for name, value in (('kind', kind), ('prefix', prefix)):
+            if value is not None:
+                conditions.append(f'{name} = ?')
+                parameters.append(value)
+        for name, value in (('bias', bias), ('setpoint', setpoint), ('bias_modulation', bias_modulation)):
+            if value is not None:
+                conditions.append(f'ABS({name} - ?) <= ?')
+                parameters += [value, abs(value) * tolerance]
+        if since is not None:
+            conditions.append('datetime >= ?')
+            parameters.append(since)
+        if until is not None:
+            conditions.append('datetime < ?')
+            parameters.append(until)
+        if order not in dict(COLUMNS):
+            raise ValueError(f'Unknown column {order}')
+        sql = 'SELECT * FROM files'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += f' ORDER BY {order}'
+        with self._connect() as db:
+            rows = [dict(row) for row in db.execute(sql, parameters)]
+        for row in rows:
+            for name in JSON_COLUMNS:
+                row[name] = json.loads(row[name])
+        if channel is not None:
+            rows = [row for row in rows if channel in row['channels']]
+        return rows
+
+    def indices(self, **conditions) -> List[int]:
+        return [row['file_index'] for row in self.query(**conditions)]
+
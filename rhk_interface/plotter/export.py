@@ -0,0 +1,149 @@
+import argparse
+import concurrent.futures
+import dataclasses
+import html
+import os
+import time
+from typing import Iterable, List
+from . import Plotter
+
+# Batch export of overview figures. Each file is loaded, leveled and rendered in its own worker process,
+# so the total time falls with the number of cores. Every figure is written as HTML, or as a static image
+# when format is png/svg/pdf and a Plotly image renderer (kaleido) is installed, and index.html links them.
+
+FIGURES = {
+    'topo': 'fig_topo',
+    'topo_and_didv': 'fig_topo_and_didv',
+}
+IMAGE_FORMATS = ('png', 'svg', 'pdf', 'jpg', 'webp')
+SHARED_FIELDS = ('cache', 'catalogue')  # Plotter fields a worker builds for itself instead of receiving a copy
+
+_worker_plotter = None  # the Plotter of this worker process, built once by _init_worker
+
+
+def plotter_options(plotter: Plotter) -> dict:
+    # Constructor arguments of plotter, enough to build an equal Plotter in another process
+    options = {field.name: getattr(plotter, field.name) for field in dataclasses.fields(plotter)
+               if field.init and field.name not in SHARED_FIELDS}
+    options['display_flag'] = False
+    return options
+
+
+def _init_worker(options: dict) -> None:
+    global _worker_plotter
+    _worker_plotter = Plotter(**options)
+    return
+
+
+def _render(index: int, kind: str, path_out: str, format: str) -> dict:
+    return render(_worker_plotter, index, kind, path_out, format)
+
+
+def render(plotter: Plotter, index: int, kind: str, path_out: str, format: str = 'html') -> dict:
+    start = time.perf_counter()
+    result = dict(index=index, path=None, title=None, seconds=None, error=None)
+    try:
+        plotter.display_flag = False
+        fig = getattr(plotter, FIGURES[kind])(index)
+        name = os.path.splitext(os.path.basename(plotter.path_file))[0] + '_' + kind
+        if format in IMAGE_FORMATS:
+            try:
+                path = os.path.join(path_out, name + '.' + format)
+                fig.write_image(path)
+            except (ImportError, ValueError, RuntimeError) as e:
+                print(f'No image renderer ({e}), writing HTML')
+                format = 'html'
+        if format == 'html':
+            path = os.path.join(path_out, name + '.html')
+            # plotly.min.js is written once next to the figures instead of into every file
+            fig.write_html(path, include_plotlyjs='directory', full_html=True)
+        result.update(path=os.path.basename(path), title=plotter.title)
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def write_index(path_out: str, results: List[dict], kind: str, elapsed: float) -> str:
+    rows = []
+    for result in sorted(results, key=lambda result: result['index']):
+        if result['error'] is None:
+            link = '<a href="{0}">{0}</a>'.format(html.escape(result['path']))
+            title = html.escape(result['title'] or '').replace('&lt;br&gt;', ' ')
+        else:
+            link, title = 'failed', html.escape(result['error'])
+        rows.append(f"<tr><td>{result['index']}</td><td>{link}</td><td>{title}</td><td>{result['seconds']:.2f}</td></tr>")
+    path = os.path.join(path_out, 'index.html')
+    with open(path, 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{0}</title></head><body>\n'
+                '<h1>{0}</h1>\n<p>{1} files in {2:.1f} s</p>\n'
+                '<table border="1" cellpadding="4">\n<tr><th>Index</th><th>File</th><th>Parameters</th><th>Time (s)</th></tr>\n'
+                .format(html.escape(kind), len(results), elapsed))
+        f.write('\n'.join(rows))
+        f.write('\n</table>\n</body></html>\n')
+    return path
+
+
+def export(plotter: Plotter, indices: Iterable[int], path_out: str, kind: str = 'topo', format: str = 'html',
+           workers: int = None, progress: bool = True) -> List[dict]:
+    # Renders the figure kind of every index into path_out and writes index.html; returns one result per index
+    if kind not in FIGURES:
+        raise ValueError(f'Unknown figure {kind}, expected one of {list(FIGURES)}')
+    os.makedirs(path_out, exist_ok=True)
+    indices = list(indices)
+    results = []
+    start = time.perf_counter()
+    # Each worker builds its Plotter once from the constructor arguments; tasks send only an index
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(plotter_options(plotter),)) as pool:
+        futures = [pool.submit(_render, index, kind, path_out, format) for index in indices]
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            result = future.result()
+            results.append(result)
+            if progress:
+                status = result['path'] if result['error'] is None else result['error']
+                print(f"[{i + 1}/{len(indices)}] {result['index']}: {status} ({result['seconds']:.2f} s)")
+    elapsed = time.perf_counter() - start
+    write_index(path_out, results, kind, elapsed)
+    if progress:
+        busy = sum(result['seconds'] for result in results)
+        print(f'{len(results)} files in {elapsed:.1f} s ({busy:.1f} s of work, {busy / elapsed if elapsed > 0 else 0:.1f}x parallel)')
+    return results
+
+
+def parse_indices(text: str) -> List[int]:
+    # '3,5,10-20' -> [3, 5, 10, ..., 20]
+    indices = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            indices += range(int(first), int(last) + 1)
+        elif part:
+            indices.append(int(part))
+    return indices
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Export overview figures of many sm4 files')
+    parser.add_argument('path_dir')
+    parser.add_argument('file_prefix')
+    parser.add_argument('-i', '--indices', help="file indices, e.g. '1-40' or '3,5,10-20' (default: catalogue query)")
+    parser.add_argument('-o', '--out', default='export', help='output directory')
+    parser.add_argument('-k', '--kind', default='topo', choices=list(FIGURES))
+    parser.add_argument('-f', '--format', default='html', choices=('html',) + IMAGE_FORMATS)
+    parser.add_argument('-j', '--workers', type=int, default=None, help='processes (default: CPU count)')
+    parser.add_argument('--bias', type=float, help='catalogue query: bias (V)')
+    parser.add_argument('--setpoint', type=float, help='catalogue query: setpoint (A)')
+    parser.add_argument('--since', help='catalogue query: ISO date or datetime')
+    parser.add_argument('--until', help='catalogue query: ISO date or datetime')
+    args = parser.parse_args()
+
+    plotter = Plotter(False, args.path_dir, args.file_prefix, args.file_prefix)
+    if args.indices is not None:
+        indices = parse_indices(args.indices)
+    else:
+        indices = plotter.find(kind='image', bias=args.bias, setpoint=args.setpoint, since=args.since, until=args.until)
+    export(plotter, indices, args.out, args.kind, args.format, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import dataclasses
+from typing import Iterator, Tuple
+import numpy as np
+import plotly.graph_objs as go
+import xarray as xr
+from plotly.subplots import make_subplots
+from . import sm4
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+# Grid spectroscopy: the sweeps of a spectroscopy page taken on a regular (y, x) lattice, average_num
+# sweeps per pixel in raster order, viewed as a (y, x, bias) cube. The raw page stays memory-mapped and
+# every operation runs over blocks of rows, so grids larger than RAM can be sliced and averaged; with
+# Dask installed dataarray() gives the whole cube as a lazy chunked array.
+
+
+def integrate(didv: np.ndarray, bias: np.ndarray) -> np.ndarray:
+    # I(V) from dI/dV by the trapezoid rule along the last axis, with I = 0 at the bias closest to 0 V
+    steps = (didv[..., 1:] + didv[..., :-1]) / 2 * np.diff(bias)
+    current = np.concatenate([np.zeros(didv.shape[:-1] + (1,), dtype=didv.dtype), np.cumsum(steps, axis=-1)], axis=-1)
+    return current - current[..., np.argmin(np.abs(bias))][..., None]
+
+
+def normalize(didv: np.ndarray, bias: np.ndarray, current: np.ndarray = None, broadening: float = 0.1) -> np.ndarray:
+    # (dI/dV) / (I/V) along the last axis. I/V is broadened by broadening times its mean magnitude per
+    # spectrum so the ratio stays finite near the gap; without a current channel I is integrated from dI/dV.
+    if current is None:
+        current = integrate(didv, bias)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conductance = np.where(np.abs(bias) > 1e-12, current / bias, didv)
+    epsilon = broadening * np.abs(conductance).mean(axis=-1, keepdims=True)
+    return didv / np.sqrt(conductance ** 2 + epsilon ** 2)
+
+
+def grid_shape(attrs: dict, sweeps: int) -> Tuple[int, int]:
+    # (ny, nx) from the grid size in the page header, else from the distinct spectroscopy locations
+    nx, ny = int(attrs.get('RHK_GridXsize', 0)), int(attrs.get('RHK_GridYsize', 0))
+    if nx > 0 and ny > 0:
+        return ny, nx
+    if 'RHK_SpecDrift_Xcoord' in attrs:
+        x = np.round(np.asarray(attrs['RHK_SpecDrift_Xcoord']) * 1e12)
+        y = np.round(np.asarray(attrs['RHK_SpecDrift_Ycoord']) * 1e12)
+        nx, ny = len(np.unique(x)), len(np.unique(y))
+        if nx * ny > 0 and sweeps % (nx * ny) == 0:
+            return ny, nx
+    raise ValueError('Cannot infer the grid shape, give nx and ny')
+
+
+@dataclasses.dataclass
+class GridCube:
+    raw: np.ndarray = dataclasses.field(repr=False)  # flat raw page data, usually a memmap
+    bias: np.ndarray = dataclasses.field(repr=False)
+    nx: int
+    ny: int
+    average_num: int
+    scale: float = 1.0
+    offset: float = 0.0
+    x: np.ndarray = dataclasses.field(default=None, repr=False)  # (nm)
+    y: np.ndarray = dataclasses.field(default=None, repr=False)  # (nm)
+    attrs: dict = dataclasses.field(default_factory=dict, repr=False)
+    current: 'GridCube' = None  # current channel of the same grid, used by normalization
+    normalization: bool = False  # return (dI/dV) / (I/V) instead of dI/dV
+    broadening: float = 0.1
+    chunk_bytes: int = 2 ** 26  # raw bytes read per block
+    _slices: dict = dataclasses.field(init=False, default_factory=dict, repr=False)
+
+    @classmethod
+    def from_sm4(cls, path: str, label: str = 'LIA_Current_Spec', current_label: str = None, nx: int = None,
+                 ny: int = None, **kwargs) -> 'GridCube':
+        f = sm4.SM4File(path)
+        page = f.page(label)
+        if not page.is_line:
+            raise ValueError(f'{label} is not a spectroscopy page')
+        if page.line_type == sm4.LINE_DISCRETE_SPECTROSCOPY:
+            # Bias column and sweeps are interleaved, so the page is decoded as sm4 does instead of mapped
+            cube = cls.from_dataarray(f[label], nx, ny, **kwargs)
+        else:
+            attrs = page.attrs
+            raw = f.memmap(label)
+            xsize = attrs['RHK_Xsize']
+            bias = attrs['RHK_Xscale'] * np.arange(xsize, dtype=np.float64) + attrs['RHK_Xoffset']
+            cube = cls._build(raw, bias, attrs, nx, ny, **kwargs)
+        if current_label is not None:
+            cube.current = cls.from_sm4(path, current_label, None, cube.nx, cube.ny)
+        return cube
+
+    @classmethod
+    def from_dataarray(cls, dr: xr.DataArray, nx: int = None, ny: int = None, **kwargs) -> 'GridCube':
+        # An in-memory (sweep, bias) DataArray such as Plotter.data_spec, already scaled
+        return cls._build(np.ascontiguousarray(dr.values).ravel(), dr.x.values, dict(dr.attrs), nx, ny, **kwargs)
+
+    @classmethod
+    def _build(cls, raw: np.ndarray, bias: np.ndarray, attrs: dict, nx: int, ny: int, **kwargs) -> 'GridCube':
+        sweeps = len(raw) // len(bias)
+        if nx is None or ny is None:
+            ny, nx = grid_shape(attrs, sweeps)
+        average_num = sweeps // (nx * ny)
+        if average_num == 0:
+            raise ValueError(f'{sweeps} sweeps do not fill a {nx} x {ny} grid')
+        x = y = None
+        if 'RHK_SpecDrift_Xcoord' in attrs:
+            locations_x = np.asarray(attrs['RHK_SpecDrift_Xcoord'])[::average_num][:nx * ny].reshape(ny, nx) * 1e9
+            locations_y = np.asarray(attrs['RHK_SpecDrift_Ycoord'])[::average_num][:nx * ny].reshape(ny, nx) * 1e9
+            x, y = locations_x[0], locations_y[:, 0]
+        if x is None:
+            x, y = np.arange(nx, dtype=float), np.arange(ny, dtype=float)
+        scale = float(attrs.get('RHK_Zscale', 1.0)) if isinstance(raw, np.memmap) else 1.0
+        offset = float(attrs.get('RHK_Zoffset', 0.0)) if isinstance(raw, np.memmap) else 0.0
+        return cls(raw, bias, nx, ny, average_num, scale, offset, x, y, attrs, **kwargs)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.ny, self.nx, len(self.bias)
+
+    @property
+    def _sweeps(self) -> np.ndarray:
+        # (y, x, sweep, bias) view of the raw data, nothing is read
+        return self.raw[:self.ny * self.nx * self.average_num * len(self.bias)].reshape(self.ny, self.nx, self.average_num, len(self.bias))
+
+    @property
+    def chunk_rows(self) -> int:
+        return max(1, self.chunk_bytes // (self.nx * self.average_num * len(self.bias) * self.raw.itemsize))
+
+    def _scaled(self, raw: np.ndarray) -> np.ndarray:
+        # Mean over the sweeps of each pixel, in physical units, float32
+        return (raw.mean(axis=-2, dtype=np.float64) * self.scale + self.offset).astype(np.float32)
+
+    def _finish(self, block: np.ndarray, rows: slice, columns: slice = slice(None)) -> np.ndarray:
+        # Normalization needs the whole bias range of each spectrum, so it is applied to full blocks only
+        if not self.normalization:
+            return block
+        current = None
+        if self.current is not None:
+            current = self.current._scaled(self.current._sweeps[rows, columns])
+        return normalize(block, self.bias, current, self.broadening).astype(np.float32)
+
+    def rows(self, y0: int, y1: int) -> np.ndarray:
+        # (y1 - y0, nx, bias) block of the cube
+        return self._finish(self._scaled(self._sweeps[y0:y1]), slice(y0, y1))
+
+    def blocks(self) -> Iterator[Tuple[int, int, np.ndarray]]:
+        for y0 in range(0, self.ny, self.chunk_rows):
+            y1 = min(y0 + self.chunk_rows, self.ny)
+            yield y0, y1, self.rows(y0, y1)
+
+    def values(self) -> np.ndarray:
+        cube = np.empty(self.shape, dtype=np.float32)
+        for y0, y1, block in self.blocks():
+            cube[y0:y1] = block
+        return cube
+
+    def dataarray(self, chunks: bool = True) -> xr.DataArray:
+        # The cube as (y, x, bias) DataArray; Dask-backed and lazy when Dask is installed and chunks is set
+        if chunks and da is not None and not self.normalization:
+            data = da.from_array(self._sweeps, chunks=(self.chunk_rows, self.nx, self.average_num, len(self.bias)))
+            data = (data.mean(axis=2) * self.scale + self.offset).astype(np.float32)
+        else:
+            data = self.values()
+        return xr.DataArray(data, dims=('y', 'x', 'bias'), coords=dict(y=self.y, x=self.x, bias=self.bias), attrs=self.attrs,
+                            name=self.attrs.get('RHK_Label'))
+
+    def _bias_index(self, bias: float, width: float = 0.0) -> slice:
+        if width > 0:
+            inside = np.nonzero(np.abs(self.bias - bias) <= width / 2)[0]
+            if len(inside):
+                return slice(inside.min(), inside.max() + 1)
+        i = int(np.argmin(np.abs(self.bias - bias)))
+        return slice(i, i + 1)
+
+    def energy_slice(self, bias: float, width: float = 0.0) -> np.ndarray:
+        # (y, x) map at the bias closest to bias, or averaged over a window of width (V)
+        index = self._bias_index(bias, width)
+        result = np.empty((self.ny, self.nx), dtype=np.float32)
+        for y0 in range(0, self.ny, self.chunk_rows):
+            y1 = min(y0 + self.chunk_rows, self.ny)
+            if self.normalization:
+                block = self.rows(y0, y1)[..., index]
+            else:
+                block = self._scaled(self._sweeps[y0:y1, :, :, index])
+            result[y0:y1] = block.mean(axis=-1)
+        return result
+
+    def spectrum(self, ix: int, iy: int) -> np.ndarray:
+        return self._finish(self._scaled(self._sweeps[iy:iy + 1, ix:ix + 1]), slice(iy, iy + 1), slice(ix, ix + 1))[0, 0]
+
+    def spatial_average(self, x_range: Tuple[float, float] = None, y_range: Tuple[float, float] = None,
+                        mask: np.ndarray = None) -> np.ndarray:
+        # Mean spectrum of the pixels inside x_range and y_range (nm) and a (y, x) boolean mask
+        selected = np.ones((self.ny, self.nx), dtype=bool) if mask is None else np.asarray(mask, dtype=bool).copy()
+        if x_range is not None:
+            selected &= ((self.x >= min(x_range)) & (self.x <= max(x_range)))[None, :]
+        if y_range is not None:
+            selected &= ((self.y >= min(y_range)) & (self.y <= max(y_range)))[:, None]
+        total = np.zeros(len(self.bias))
+        count = 0
+        for y0, y1 in ((y0, min(y0 + self.chunk_rows, self.ny)) for y0 in range(0, self.ny, self.chunk_rows)):
+            rows = selected[y0:y1]
+            if rows.any():
+                total += self.rows(y0, y1)[rows].sum(axis=0)
+                count += int(rows.sum())
+        return total / count if count else np.full(len(self.bias), np.nan)
+
+    def slices(self, count: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+        # count maps, each the mean over an equal bias bin, and the bin centres; computed in one pass and kept
+        key = (count, self.normalization, self.broadening)
+        if key not in self._slices:
+            count = min(count, len(self.bias))
+            edges = np.linspace(0, len(self.bias), count + 1).astype(int)
+            maps = np.empty((count, self.ny, self.nx), dtype=np.float32)
+            for y0, y1, block in self.blocks():
+                sums = np.add.reduceat(block, edges[:-1], axis=-1)
+                maps[:, y0:y1] = np.moveaxis(sums / np.diff(edges), -1, 0)
+            centres = np.add.reduceat(self.bias, edges[:-1]) / np.diff(edges)
+            self._slices[key] = (maps, centres)
+        return self._slices[key]
+
+    def viewer(self, count: int = 64, colorscale: str = 'Gray', width: int = 1250, height: int = 600):
+        # Energy-slice heatmap with a bias slider next to a spectrum. The slices are precomputed, so the slider
+        # runs in the browser. With ipywidgets a FigureWidget is returned and clicking a pixel shows its spectrum.
+        maps, centres = self.slices(count)
+        fig = make_subplots(rows=1, cols=2, subplot_titles=('Map', 'Spectrum'), horizontal_spacing=0.15)
+        fig.add_trace(go.Heatmap(x=self.x, y=self.y, z=maps[0], colorscale=colorscale, colorbar=dict(x=0.44, len=1, thickness=10), name='Map'), row=1, col=1)
+        fig.add_trace(go.Scattergl(x=self.bias, y=self.spatial_average(), mode='lines', name='Average'), row=1, col=2)
+
+        def marker(bias: float) -> list:
+            return [dict(type='line', xref='x2', yref='paper', x0=bias, x1=bias, y0=0, y1=1, line=dict(dash='dot', color='Black'))]
+
+        steps = [dict(method='update', label=f'{bias:.3f}', args=[dict(z=[maps[i]]), dict(shapes=marker(bias)), [0]])
+                 for i, bias in enumerate(centres)]
+        fig.update_layout(
+            sliders=[dict(active=0, currentvalue=dict(prefix='Bias (V): '), pad=dict(t=50), steps=steps)],
+            shapes=marker(centres[0]),
+            xaxis=dict(title='x (nm)'),
+            yaxis=dict(title='y (nm)', scaleanchor='x'),
+            xaxis2=dict(title='Bias (V)'),
+            yaxis2=dict(title='(dI/dV)/(I/V)' if self.normalization else 'dI/dV'),
+            width=width,
+            height=height,
+            template='plotly_white',
+        )
+        try:
+            import ipywidgets  # noqa: F401
+        except ImportError:
+            return fig
+        widget = go.FigureWidget(fig)
+
+        def show_pixel(trace, points, state) -> None:
+            if not points.xs:
+                return
+            ix = int(np.argmin(np.abs(self.x - points.xs[0])))
+            iy = int(np.argmin(np.abs(self.y - points.ys[0])))
+            with widget.batch_update():
+                widget.data[1].y = self.spectrum(ix, iy)
+                widget.data[1].name = f'({self.x[ix]:.2f}, {self.y[iy]:.2f}) nm'
+            return
+
+        widget.data[0].on_click(show_pixel)
+        return widget
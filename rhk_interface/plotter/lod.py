@@ -0,0 +1,76 @@
+import dataclasses
+from typing import List, Tuple
+import numpy as np
+
+# Level-of-detail rendering of large images. A Pyramid halves the resolution of a frame level by level,
+# once per processed frame (Plotter caches it with the frame), and view() returns the coarsest level that
+# still has about one data point per screen pixel over the visible range. The heatmap payload is then
+# bounded by the figure size instead of the scan resolution. attach() swaps in finer data on zoom.
+
+
+def halve(x: np.ndarray, y: np.ndarray, z: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # 2 x 2 block means; an odd last row or column is paired with itself
+    ny, nx = z.shape
+    z = np.pad(z, ((0, ny % 2), (0, nx % 2)), mode='edge')
+    x = np.pad(x, (0, nx % 2), mode='edge')
+    y = np.pad(y, (0, ny % 2), mode='edge')
+    z = z.reshape(z.shape[0] // 2, 2, z.shape[1] // 2, 2).mean(axis=(1, 3))
+    return x.reshape(-1, 2).mean(axis=1), y.reshape(-1, 2).mean(axis=1), z
+
+
+@dataclasses.dataclass
+class Pyramid:
+    x: np.ndarray = dataclasses.field(repr=False)
+    y: np.ndarray = dataclasses.field(repr=False)
+    z: np.ndarray = dataclasses.field(repr=False)
+    min_size: int = 64  # the coarsest level is at most this many points on its long side
+    levels: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = dataclasses.field(init=False, default_factory=list, repr=False)
+
+    def __post_init__(self) -> None:
+        level = (np.asarray(self.x, dtype=float), np.asarray(self.y, dtype=float), np.asarray(self.z, dtype=np.float32))
+        self.levels = [level]
+        while max(level[2].shape) > self.min_size:
+            level = halve(*level)
+            self.levels.append(level)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x.nbytes + y.nbytes + z.nbytes for x, y, z in self.levels)
+
+    def view(self, pixels: int, x_range: Tuple[float, float] = None,
+             y_range: Tuple[float, float] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Level closest to pixels points across the visible range (in log scale), cropped to that range
+        x0, x1 = (min(x_range), max(x_range)) if x_range is not None else (-np.inf, np.inf)
+        y0, y1 = (min(y_range), max(y_range)) if y_range is not None else (-np.inf, np.inf)
+        for x, y, z in reversed(self.levels):
+            columns = np.nonzero((x >= x0) & (x <= x1))[0]
+            rows = np.nonzero((y >= y0) & (y <= y1))[0]
+            if max(len(columns), len(rows)) >= pixels / np.sqrt(2):
+                break
+        if len(columns) == 0 or len(rows) == 0:
+            return x, y, z
+        # One point of margin so the edges of the view are covered
+        a, b = max(columns.min() - 1, 0), min(columns.max() + 2, len(x))
+        c, d = max(rows.min() - 1, 0), min(rows.max() + 2, len(y))
+        return x[a:b], y[c:d], z[c:d, a:b]
+
+
+def attach(widget, trace_index: int, pyramid: Pyramid, pixels: int, shift: Tuple[float, float] = (0.0, 0.0)) -> None:
+    # Re-slices the pyramid whenever the axes of the trace are zoomed or panned in a FigureWidget
+    trace = widget.data[trace_index]
+    xaxis = 'xaxis' + (trace.xaxis or 'x')[1:]
+    yaxis = 'yaxis' + (trace.yaxis or 'y')[1:]
+
+    def update(layout, *args) -> None:
+        x_range = widget.layout[xaxis].range
+        y_range = widget.layout[yaxis].range
+        x_range = None if x_range is None else (x_range[0] - shift[0], x_range[1] - shift[0])
+        y_range = None if y_range is None else (y_range[0] - shift[1], y_range[1] - shift[1])
+        x, y, z = pyramid.view(pixels, x_range, y_range)
+        with widget.batch_update():
+            trace.x, trace.y, trace.z = x + shift[0], y + shift[1], z
+        return
+
+    widget.layout[xaxis].on_change(update, 'range')
+    widget.layout[yaxis].on_change(update, 'range')
+    return
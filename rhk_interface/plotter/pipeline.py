@@ -0,0 +1,141 @@
+import concurrent.futures
+import dataclasses
+from typing import List, Sequence, Tuple
+import os
+import numpy as np
+from xarray.core.dataarray import DataArray
+
+# Batch processing of (frame, y, x) image stacks. Every step works on a whole chunk of frames at once and
+# gives the same result as the single-frame path, spym's align(), plane() and fixzero() on a DataArray and
+# tools.edge. Chunks are sized by chunk_bytes and processed by a thread pool; NumPy and scipy.ndimage
+# release the GIL in the heavy loops, and threads share the input and output arrays without copies.
+# A FileStack reads its frames from the sm4 files only when a chunk is processed, so a stack of many
+# files never has to fit in memory; with out a memmap, neither does the result.
+
+STEPS = ('align', 'plane', 'fixzero', 'edge')
+
+
+def poly_background(lines: np.ndarray, degree: int) -> np.ndarray:
+    # Least-squares polynomial of every line along the last axis, on x from -0.5 to 0.5 like spym
+    x = np.linspace(-.5, .5, lines.shape[-1])
+    vander = np.vander(x, degree + 1)
+    return lines @ np.linalg.pinv(vander).T @ vander.T
+
+
+def align(stack: np.ndarray, baseline: str = 'mean', poly_degree: int = 2) -> np.ndarray:
+    # Subtracts the baseline of every row (line) of every frame
+    if baseline == 'mean':
+        return stack - stack.mean(axis=2, keepdims=True)
+    if baseline == 'median':
+        return stack - np.median(stack, axis=2, keepdims=True)
+    if baseline == 'poly':
+        return stack - poly_background(stack, poly_degree)
+    raise ValueError(f'Unknown baseline {baseline}')
+
+
+def plane(stack: np.ndarray) -> np.ndarray:
+    # Subtracts the linear fits of the column and row means of every frame
+    return stack - poly_background(stack.mean(axis=1), 1)[:, None, :] - poly_background(stack.mean(axis=2), 1)[:, :, None]
+
+
+def fixzero(stack: np.ndarray, to_mean: bool = False) -> np.ndarray:
+    if to_mean:
+        return stack - stack.mean(axis=(1, 2), keepdims=True)
+    return stack - stack.min(axis=(1, 2), keepdims=True)
+
+
+def edge(stack: np.ndarray) -> np.ndarray:
+    # Gradient magnitude of every frame, as tools.edge; sigma 0 leaves the frame axis unfiltered
+    from scipy import ndimage
+    return np.hypot(ndimage.gaussian_filter(stack, (0, 5, 5), (0, 0, 1)), ndimage.gaussian_filter(stack, (0, 5, 5), (0, 1, 0)))
+
+
+def process_chunk(stack: np.ndarray, steps: Sequence[str], baseline: str = 'mean', to_mean: bool = False) -> np.ndarray:
+    stack = np.array(stack, dtype=float)
+    for step in steps:
+        if step == 'align':
+            stack = align(stack, baseline)
+        elif step == 'plane':
+            stack = plane(stack)
+        elif step == 'fixzero':
+            stack = fixzero(stack, to_mean)
+        elif step == 'edge':
+            stack = edge(stack)
+        else:
+            raise ValueError(f'Unknown step {step}, expected one of {STEPS}')
+    return stack
+
+
+def chunk_frames(shape: tuple, chunk_bytes: int) -> int:
+    # Frames per chunk; a step holds a few float64 copies of its chunk
+    return max(1, chunk_bytes // (4 * shape[1] * shape[2] * 8))
+
+
+def process(stack, steps: Sequence[str] = ('align', 'plane', 'fixzero'), baseline: str = 'mean', to_mean: bool = False,
+            chunk_bytes: int = 2 ** 27, workers: int = None, out: np.ndarray = None) -> np.ndarray:
+    # Applies steps in order to a (frame, y, x) stack, which may be a memmap or any array read chunk by chunk.
+    # out, e.g. a memmap, receives the float64 result; by default a new array.
+    shape = tuple(stack.shape)
+    if len(shape) != 3:
+        raise ValueError(f'Expected a (frame, y, x) stack, got shape {shape}')
+    if out is None:
+        out = np.empty(shape)
+    size = chunk_frames(shape, chunk_bytes)
+
+    def run(start: int) -> None:
+        out[start:start + size] = process_chunk(stack[start:start + size], steps, baseline, to_mean)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        # list() re-raises the first error of a chunk
+        list(pool.map(run, range(0, shape[0], size)))
+    return out
+
+
+@dataclasses.dataclass
+class FileStack:
+    # (frame, y, x) stack of one channel of the image files indices; slicing reads only those frames.
+    # Files are read with the Plotter's loader but not kept in its FrameCache, and from any thread.
+    plotter: 'Plotter' = dataclasses.field(repr=False)
+    indices: List[int]
+    channel: str = 'Topography_Forward'
+    first: DataArray = dataclasses.field(init=False, default=None, repr=False)  # coordinates and attrs of the stack
+
+    def __post_init__(self) -> None:
+        self.indices = list(self.indices)
+        if not self.indices:
+            raise ValueError('No frames')
+        self.first = self.read(self.indices[0])
+        return
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return (len(self.indices),) + self.first.shape
+
+    def read(self, index: int) -> DataArray:
+        path = os.path.join(self.plotter.path_dir, self.plotter.file_prefix + str(index).zfill(4) + '.sm4')
+        if not os.path.exists(path):
+            raise ValueError(f'No such data file {path}')
+        frame = getattr(self.plotter._load(path, datatype_separate=True)[0], self.channel)
+        if self.first is not None and frame.shape != self.first.shape:
+            raise ValueError(f'Frame {index} is {frame.shape}, expected {self.first.shape}')
+        return frame
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def __getitem__(self, key: slice) -> np.ndarray:
+        indices = self.indices[key]
+        frames = np.empty((len(indices),) + self.first.shape)
+        for i, index in enumerate(indices):
+            frames[i] = self.read(index).values
+        return frames
+
+    def dataarray(self, values: np.ndarray = None) -> DataArray:
+        # values, by default all raw frames, with the frame indices and the coordinates of the first frame
+        return DataArray(
+            self[:] if values is None else values,
+            dims=('frame',) + self.first.dims,
+            coords={'frame': self.indices, **{dim: self.first[dim].values for dim in self.first.dims}},
+            attrs=dict(self.first.attrs),
+            name=self.channel,
+        )
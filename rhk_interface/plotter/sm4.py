@@ -0,0 +1,383 @@
+import dataclasses
+from typing import Iterator, List, Tuple
+import contextlib
+import mmap
+import struct
+import numpy as np
+import xarray as xr
+
+# Lazy reader for RHK .sm4 files. Opening a file reads only the page index and the page headers and
+# metadata objects, a few kB; the data of a channel is decoded from a memory map the first time it is
+# accessed. The file is mapped only while it is read, so R9 can keep writing to the data directory.
+# Pages are named as spym names them (Topography_Forward, LIA_Current_Spec, ...) and carry the attrs
+# Plotter uses (bias, setpoint, bias_modulation, RHK_SpecDrift_Xcoord, filename, ...).
+
+OBJECT = struct.Struct('<III')  # id, offset, size
+FILE_HEADER = struct.Struct('<H36sIII8x')
+PAGE_INDEX_HEADER = struct.Struct('<II8x')
+PAGE_INDEX = struct.Struct('<16sIIII')
+PAGE_HEADER = struct.Struct('<HH13I11f4I64x')
+SPEC_DRIFT_HEADER = struct.Struct('<QII')
+PI_CONTROLLER = struct.Struct('<5dI')
+CHANNEL_DRIVE = struct.Struct('<II4d')
+LOCKIN = struct.Struct('<II3d')
+
+OBJECT_PAGE_INDEX_HEADER = 1
+OBJECT_PAGE_INDEX_ARRAY = 2
+OBJECT_PAGE_HEADER = 3
+OBJECT_PAGE_DATA = 4
+OBJECT_SPEC_DRIFT_HEADER = 7
+OBJECT_SPEC_DRIFT_DATA = 8
+OBJECT_STRING_DATA = 10
+
+DATA_IMAGE = 0
+DATA_LINE = 1
+DATA_SEQUENTIAL = 6
+LINE_DISCRETE_SPECTROSCOPY = 22
+FLOAT_LINE_TYPES = (1, 6, 9, 10, 11, 13, 18, 19, 21, 22)
+LINE_XLABELS = {7: 'Bias', 8: 'Z', 24: 'Time'}  # spym's label for an empty RHK_Xlabel (IV, IZ, time spectra)
+
+PAGE_HEADER_FIELDS = (
+    'RHK_PageType', 'RHK_DataSubSource', 'RHK_LineType', 'RHK_Xcorner', 'RHK_Ycorner', 'RHK_Xsize', 'RHK_Ysize',
+    'RHK_ImageType', 'RHK_ScanType', 'RHK_GroupId', '_page_data_size', 'RHK_MinZvalue', 'RHK_MaxZvalue',
+    'RHK_Xscale', 'RHK_Yscale', 'RHK_Zscale', 'RHK_XYscale', 'RHK_Xoffset', 'RHK_Yoffset', 'RHK_Zoffset',
+    'RHK_Period', 'RHK_Bias', 'RHK_Current', 'RHK_Angle',
+    '_color_info_count', 'RHK_GridXsize', 'RHK_GridYsize', '_object_list_count',
+)
+STRING_FIELDS = (
+    'RHK_Label', 'RHK_SystemText', 'RHK_SessionText', 'RHK_UserText', 'RHK_FileName', 'RHK_Date', 'RHK_Time',
+    'RHK_Xunits', 'RHK_Yunits', 'RHK_Zunits', 'RHK_Xlabel', 'RHK_Ylabel', 'RHK_StatusChannelText',
+    'RHK_CompletedLineCount', 'RHK_OverSamplingCount', 'RHK_SlicedVoltage', 'RHK_PLLProStatus',
+    'RHK_SetpointUnit', 'CHlist',
+)
+SPEC_DRIFT_FIELDS = ('Time', 'Xcoord', 'Ycoord', 'dX', 'dY', 'CumulativeX', 'CumulativeY')
+PI_CONTROLLERS = {27: 'RHK_ZPI', 28: 'RHK_KPI', 29: 'RHK_AuxPI'}
+CHANNEL_DRIVES = {23: 'RHK_CH1Drive', 24: 'RHK_CH2Drive'}
+LOCKINS = {25: 'RHK_Lockin0', 26: 'RHK_Lockin1'}
+LENGTH_UNITS = {'m': 1e9}  # lateral coordinates are given in nm
+
+
+def read_string(buffer, offset: int) -> Tuple[str, int]:
+    # RHK strings are a uint16 character count followed by UTF-16 characters
+    length = struct.unpack_from('<H', buffer, offset)[0]
+    end = offset + 2 + 2 * length
+    return bytes(buffer[offset + 2:end]).decode('utf-16-le', errors='replace').rstrip('\x00'), end
+
+
+def read_objects(buffer, offset: int, count: int) -> Tuple[dict, int]:
+    objects = {}
+    for _ in range(count):
+        object_id, object_offset, size = OBJECT.unpack_from(buffer, offset)
+        if object_offset != 0 and size != 0:
+            objects[object_id] = (object_offset, size)
+        offset += OBJECT.size
+    return objects, offset
+
+
+@dataclasses.dataclass
+class Page:
+    label: str
+    data_type: int
+    line_type: int
+    data_offset: int
+    data_size: int
+    attrs: dict = dataclasses.field(repr=False)
+
+    @property
+    def is_image(self) -> bool:
+        return self.data_type == DATA_IMAGE
+
+    @property
+    def is_line(self) -> bool:
+        return self.data_type == DATA_LINE
+
+
+@dataclasses.dataclass
+class SM4File:
+    path: str
+    pages: List[Page] = dataclasses.field(init=False, default_factory=list)
+    signature: str = dataclasses.field(init=False, default=None)
+    _decoded: dict = dataclasses.field(init=False, default_factory=dict, repr=False)
+
+    def __post_init__(self) -> None:
+        with self._map() as buffer:
+            header_size, signature, _, count, _ = FILE_HEADER.unpack_from(buffer, 0)
+            self.signature = signature.decode('utf-16-le').rstrip('\x00')
+            objects, _ = read_objects(buffer, header_size + 2, count)
+            offset = objects[OBJECT_PAGE_INDEX_HEADER][0]
+            page_count, count = PAGE_INDEX_HEADER.unpack_from(buffer, offset)
+            objects, _ = read_objects(buffer, offset + PAGE_INDEX_HEADER.size, count)
+            offset = objects[OBJECT_PAGE_INDEX_ARRAY][0]
+            for _ in range(page_count):
+                page, offset = self._read_page(buffer, offset)
+                if page is not None:
+                    self.pages.append(page)
+        return
+
+    @contextlib.contextmanager
+    def _map(self) -> Iterator[mmap.mmap]:
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            yield buffer
+
+    def _read_page(self, buffer, offset: int) -> Tuple[Page, int]:
+        page_id, data_type, source_type, count, minor_version = PAGE_INDEX.unpack_from(buffer, offset)
+        objects, offset = read_objects(buffer, offset + PAGE_INDEX.size, count)
+        if data_type == DATA_SEQUENTIAL or OBJECT_PAGE_HEADER not in objects:
+            # Sequential pages have their own header layout and are not used by Plotter
+            return None, offset
+        attrs = dict(
+            RHK_PageID=np.frombuffer(page_id, dtype='<u2').copy(),
+            RHK_PageDataType=data_type,
+            RHK_PageSourceType=source_type,
+            RHK_MinorVer=minor_version,
+            RHK_Signature=self.signature,
+        )
+        header_offset = objects[OBJECT_PAGE_HEADER][0]
+        fields = PAGE_HEADER.unpack_from(buffer, header_offset)
+        string_count = fields[1]
+        attrs.update(zip(PAGE_HEADER_FIELDS, fields[2:]))
+        page_objects, _ = read_objects(buffer, header_offset + PAGE_HEADER.size, attrs.pop('_object_list_count'))
+        attrs.pop('_color_info_count')
+        data_size = attrs.pop('_page_data_size')
+        if OBJECT_STRING_DATA in page_objects:
+            self._read_strings(buffer, page_objects[OBJECT_STRING_DATA][0], string_count, attrs)
+        if not attrs.get('RHK_Xlabel'):
+            attrs['RHK_Xlabel'] = LINE_XLABELS.get(attrs['RHK_LineType'], '')
+        if OBJECT_SPEC_DRIFT_HEADER in page_objects:
+            self._read_spec_drift_header(buffer, page_objects[OBJECT_SPEC_DRIFT_HEADER][0], attrs)
+        if OBJECT_SPEC_DRIFT_DATA in page_objects:
+            self._read_spec_drift_data(buffer, page_objects[OBJECT_SPEC_DRIFT_DATA][0], attrs)
+        for object_id, (object_offset, _) in page_objects.items():
+            if object_id in PI_CONTROLLERS:
+                self._read_pi_controller(buffer, object_offset, PI_CONTROLLERS[object_id], attrs)
+            elif object_id in CHANNEL_DRIVES:
+                self._read_channel_drive(buffer, object_offset, CHANNEL_DRIVES[object_id], attrs)
+            elif object_id in LOCKINS:
+                self._read_lockin(buffer, object_offset, LOCKINS[object_id], attrs)
+
+        label = attrs.get('RHK_Label', '').replace(' ', '_').replace('-', '_')
+        if label.startswith('_'):
+            label = label[1:]
+        if not label:
+            label = 'ID' + str(attrs['RHK_PageID'])
+        elif data_type == DATA_IMAGE:
+            label += {0: '_Forward', 1: '_Backward'}.get(attrs['RHK_ScanType'], '')
+        data_offset = objects[OBJECT_PAGE_DATA][0] if OBJECT_PAGE_DATA in objects else 0
+        return Page(label, data_type, attrs['RHK_LineType'], data_offset, data_size, attrs), offset
+
+    def _read_strings(self, buffer, offset: int, count: int, attrs: dict) -> None:
+        for k in range(count):
+            value, offset = read_string(buffer, offset)
+            name = STRING_FIELDS[k] if k < len(STRING_FIELDS) else 'RHK_Unknown{:0>3d}'.format(k - len(STRING_FIELDS))
+            if name == 'RHK_FileName':
+                attrs['RHK_FilePath'] = value
+                value = self.path
+            elif name in ('RHK_CompletedLineCount', 'RHK_OverSamplingCount'):
+                value = int(value) if value.strip().lstrip('-').isdigit() else 0
+            elif name == 'CHlist':
+                for i, line in enumerate(value.split('\n')):
+                    words = line.split(' ')
+                    if len(words) > 4:
+                        attrs['RHK_CH' + str(i + 1) + 'DriveValue'] = float(words[3])
+                        attrs['RHK_CH' + str(i + 1) + 'DriveValueUnits'] = words[4]
+                continue
+            attrs[name] = value
+        if attrs.get('RHK_Date', '').count('/') == 2:
+            mm, dd, yy = attrs['RHK_Date'].split('/')
+            attrs['RHK_DateTime'] = '20' + yy + '-' + mm + '-' + dd + 'T' + attrs.get('RHK_Time', '') + '.000'
+        return
+
+    def _read_spec_drift_header(self, buffer, offset: int, attrs: dict) -> None:
+        filetime, option, _ = SPEC_DRIFT_HEADER.unpack_from(buffer, offset)
+        attrs['RHK_SpecDrift_Filetime'] = filetime
+        attrs['RHK_SpecDrift_DriftOptionType'] = option
+        attrs['RHK_SpecDrift_Channel'] = read_string(buffer, offset + SPEC_DRIFT_HEADER.size)[0]
+        return
+
+    def _read_spec_drift_data(self, buffer, offset: int, attrs: dict) -> None:
+        # One record of 7 float32 per spectrum
+        records = np.frombuffer(buffer, dtype='<f4', count=7 * attrs['RHK_Ysize'], offset=offset).reshape(-1, 7)
+        for i, name in enumerate(SPEC_DRIFT_FIELDS):
+            attrs['RHK_SpecDrift_' + name] = records[:, i].astype(float)
+        del records
+        return
+
+    def _read_pi_controller(self, buffer, offset: int, name: str, attrs: dict) -> None:
+        values = PI_CONTROLLER.unpack_from(buffer, offset)
+        for key, value in zip(('SetPoint', 'ProportionalGain', 'IntegralGain', 'LowerBound', 'UpperBound'), values):
+            attrs[name + '_' + key] = value
+        offset += PI_CONTROLLER.size
+        for key in ('FeedbackType', 'SetPointUnit', 'ProportionalGainUnit', 'IntegralGainUnit', 'OutputUnit'):
+            attrs[name + '_' + key], offset = read_string(buffer, offset)
+        return
+
+    def _read_channel_drive(self, buffer, offset: int, name: str, attrs: dict) -> None:
+        _, master, *values = CHANNEL_DRIVE.unpack_from(buffer, offset)
+        attrs[name + '_MasterOscillator'] = master
+        for key, value in zip(('Amplitude', 'Frequency', 'PhaseOffset', 'HarmonicFactor'), values):
+            attrs[name + '_' + key] = value
+        offset += CHANNEL_DRIVE.size
+        for key in ('AmplitudeUnit', 'FrequencyUnit', 'PhaseOffsetUnit', 'ReservedUnit'):
+            attrs[name + '_' + key], offset = read_string(buffer, offset)
+        return
+
+    def _read_lockin(self, buffer, offset: int, name: str, attrs: dict) -> None:
+        _, oscillator, *values = LOCKIN.unpack_from(buffer, offset)
+        attrs[name + '_NonMasterOscillator'] = oscillator
+        for key, value in zip(('Frequency', 'HarmonicFactor', 'PhaseOffset'), values):
+            attrs[name + '_' + key] = value
+        return
+
+    @property
+    def channels(self) -> List[str]:
+        return [page.label for page in self.pages]
+
+    def page(self, label: str) -> Page:
+        for page in self.pages:
+            if page.label == label:
+                return page
+        raise KeyError(label)
+
+    def __getitem__(self, label: str) -> xr.DataArray:
+        if label not in self._decoded:
+            self._decoded[label] = self._to_dataarray(self.page(label))
+        return self._decoded[label]
+
+    def __contains__(self, label: str) -> bool:
+        return label in self.channels
+
+    def _read_data(self, page: Page) -> np.ndarray:
+        attrs = page.attrs
+        dtype = '<f4' if page.line_type in FLOAT_LINE_TYPES else '<i4'
+        with self._map() as buffer:
+            raw = np.frombuffer(buffer, dtype=dtype, count=page.data_size // 4, offset=page.data_offset)
+            data = raw * float(attrs['RHK_Zscale']) + float(attrs['RHK_Zoffset'])
+            del raw
+        return data
+
+    def memmap(self, label: str) -> np.ndarray:
+        # Raw (unscaled) page data mapped from disk, for pages too large to decode at once. The map keeps
+        # the file open until the array is released; scale with attrs RHK_Zscale and RHK_Zoffset.
+        page = self.page(label)
+        dtype = '<f4' if page.line_type in FLOAT_LINE_TYPES else '<i4'
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=page.data_offset, shape=(page.data_size // 4,))
+
+    def _to_dataarray(self, page: Page) -> xr.DataArray:
+        attrs = dict(page.attrs)
+        data = self._read_data(page)
+        xsize, ysize = attrs['RHK_Xsize'], attrs['RHK_Ysize']
+        xscale, yscale = attrs['RHK_Xscale'], attrs['RHK_Yscale']
+        coords_attrs = {}
+        if page.is_image:
+            data = data.reshape(ysize, xsize)
+            if xscale < 0:
+                data = data[:, ::-1]
+            if yscale > 0:
+                data = data[::-1, :]
+            dims = ('y', 'x')
+            coords = {}
+            for axis, size, scale in (('x', xsize, xscale), ('y', ysize, yscale)):
+                unit = attrs.get('RHK_' + axis.upper() + 'units', '')
+                factor = LENGTH_UNITS.get(unit, 1.0)
+                coords[axis] = abs(scale) * factor * np.arange(size, dtype=np.float64)
+                coords_attrs[axis] = dict(
+                    units='nm' if unit in LENGTH_UNITS else unit,
+                    offset=attrs['RHK_' + axis.upper() + 'offset'] * factor,
+                    long_name=axis,
+                )
+        elif page.is_line:
+            dims = ('y', 'x')
+            if page.line_type == LINE_DISCRETE_SPECTROSCOPY:
+                table = data.reshape(xsize, ysize + 1).T
+                x, data = table[0], table[1:]
+            else:
+                data = data.reshape(ysize, xsize)
+                x = xscale * np.arange(xsize, dtype=np.float64) + attrs['RHK_Xoffset']
+            coords = dict(x=x, y=np.arange(ysize))
+            coords_attrs['x'] = dict(units=attrs.get('RHK_Xunits', ''), long_name=attrs.get('RHK_Xlabel') or 'x')
+            coords_attrs['y'] = dict(long_name='Trace')
+        else:
+            dims = ('x',)
+            coords = dict(x=np.arange(len(data)))
+
+        attrs.update(
+            long_name=page.label.replace('_', ' '),
+            units=attrs.get('RHK_Zunits', ''),
+            scaling_factor=1.0,
+            offset=0.0,
+            start_time=attrs.get('RHK_DateTime', ''),
+            notes=attrs.get('RHK_UserText', ''),
+            interpretation={DATA_IMAGE: 'image', DATA_LINE: 'spectrum'}.get(page.data_type),
+            bias=attrs['RHK_Bias'],
+            bias_units='V',
+            scan_angle=attrs['RHK_Angle'],
+            time_per_point=attrs['RHK_Period'],
+            filename=self.path,
+        )
+        if 'RHK_ZPI_SetPoint' in attrs:
+            attrs.update(
+                setpoint=attrs['RHK_ZPI_SetPoint'],
+                setpoint_units=attrs['RHK_ZPI_SetPointUnit'],
+                feedback_active=attrs['RHK_ZPI_FeedbackType'] != 'Off',
+            )
+            if attrs['feedback_active']:
+                attrs['feedback_pgain'] = attrs['RHK_ZPI_ProportionalGain']
+        else:
+            attrs.update(setpoint=0, setpoint_units='', feedback_active=None, feedback_pgain=0)
+        # The bias modulation is the CH1 drive value R9 lists in CHlist (Driver.set_bias_mod); like the
+        # setpoint, it is 0 when the file does not record it
+        if 'RHK_CH1DriveValue' in attrs:
+            attrs.update(bias_modulation=attrs['RHK_CH1DriveValue'], bias_modulation_units=attrs['RHK_CH1DriveValueUnits'])
+        else:
+            attrs.update(bias_modulation=0, bias_modulation_units='')
+
+        dr = xr.DataArray(data, dims=dims, coords=coords, attrs=attrs, name=page.label)
+        for axis, axis_attrs in coords_attrs.items():
+            dr.coords[axis].attrs.update(axis_attrs)
+        return dr
+
+
+@dataclasses.dataclass
+class LazyDataset:
+    # Dataset-like view of some pages of an SM4File: ds.Topography_Forward or ds['LIA_Current_Spec']
+    # decodes that page only. dataset() decodes the pages into an xarray Dataset.
+    file: SM4File = dataclasses.field(repr=False)
+    labels: List[str]
+
+    def __getattr__(self, label: str) -> xr.DataArray:
+        if label.startswith('_') or label not in self.__dict__.get('labels', ()):
+            raise AttributeError(label)
+        return self.file[label]
+
+    def __getitem__(self, label: str) -> xr.DataArray:
+        if label not in self.labels:
+            raise KeyError(label)
+        return self.file[label]
+
+    def __contains__(self, label: str) -> bool:
+        return label in self.labels
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.labels)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    @property
+    def nbytes(self) -> int:
+        # Bytes decoded so far
+        return sum(self.file._decoded[label].nbytes for label in self.labels if label in self.file._decoded)
+
+    def dataset(self, labels: List[str] = None) -> xr.Dataset:
+        # Pages of different shapes share the x and y dimension names, so only pages of one data type combine
+        return xr.Dataset({label: self.file[label] for label in labels or self.labels})
+
+
+def load(path: str, datatype_separate: bool = True):
+    # Same return values as spym.load(path, datatype_separate): (images, lines) or all pages, lazily decoded
+    sm4 = SM4File(path)
+    if not datatype_separate:
+        return LazyDataset(sm4, sm4.channels)
+    images = LazyDataset(sm4, [page.label for page in sm4.pages if page.is_image])
+    lines = LazyDataset(sm4, [page.label for page in sm4.pages if not page.is_image])
+    return images, lines
@@ -0,0 +1,49 @@
+from typing import List, Tuple
+import numpy as np
+import plotly.express as px
+
+QUALITATIVE = px.colors.qualitative.Plotly
+CONTINUOUS = 'Turbo'
+
+
+def group_sweeps(values: np.ndarray, average_num: int) -> np.ndarray:
+    # (sweep, point) -> (location, sweep of that location, point); trailing sweeps of an incomplete group are dropped
+    spec_num = len(values) // average_num
+    return values[:spec_num * average_num].reshape(spec_num, average_num, -1)
+
+
+def sweep_mask(groups: np.ndarray, reject: float) -> np.ndarray:
+    # Keeps the sweeps whose RMS distance from the median sweep of their group is within reject robust
+    # sigmas (1.4826 MAD) of the typical distance; a group without spread keeps every sweep
+    median = np.median(groups, axis=1, keepdims=True)
+    distance = np.sqrt(((groups - median) ** 2).mean(axis=2))
+    typical = np.median(distance, axis=1, keepdims=True)
+    sigma = 1.4826 * np.median(np.abs(distance - typical), axis=1, keepdims=True)
+    return (distance - typical <= reject * sigma) | (sigma == 0)
+
+
+def average_spectra(values: np.ndarray, average_num: int, split: bool = False, reject: float = None) -> Tuple[np.ndarray, np.ndarray]:
+    # Mean of every average_num consecutive sweeps, as (location, point) arrays. With split, even and odd
+    # sweeps of a group (forward and backward) are averaged separately and the backward mean is returned
+    # second, else the second value is None. reject drops outlier sweeps, see sweep_mask.
+    groups = group_sweeps(np.asarray(values, dtype=float), average_num)
+    directions = [groups[:, 0::2], groups[:, 1::2]] if split else [groups]
+    means = []
+    for group in directions:
+        if reject is None or group.shape[1] < 3:
+            means.append(group.mean(axis=1))
+        else:
+            mask = sweep_mask(group, reject)[:, :, None]
+            means.append((group * mask).sum(axis=1) / mask.sum(axis=1))
+    return means[0], (means[1] if split else None)
+
+
+def spec_colors(count: int) -> List[str]:
+    # The qualitative palette while it has enough colors, else evenly spaced samples of a continuous colormap
+    if count <= len(QUALITATIVE):
+        return list(QUALITATIVE[:count])
+    return px.colors.sample_colorscale(CONTINUOUS, np.linspace(0, 1, count))
+
+
+def spec_color(index: int) -> str:
+    return QUALITATIVE[index % len(QUALITATIVE)]
@@ -1,15 +1,16 @@
-from scipy.signal.signaltools import correlate2d as c2d
-from scipy import ndimage
+import dataclasses
+from typing import List, Tuple
 import numpy as np
-import cv2
-import matplotlib.pyplot as plt
+
+# scipy, cv2 and matplotlib are imported by the functions using them, so importing tools stays cheap
 
 
 def edge(img):
+    from scipy import ndimage
     # Diff in x-directioin
-    img_x = ndimage.filters.gaussian_filter(img, (5, 5), (0, 1))
+    img_x = ndimage.gaussian_filter(img, (5, 5), (0, 1))
     # Diff in y-directioin
-    img_y = ndimage.filters.gaussian_filter(img, (5, 5), (1, 0))
+    img_y = ndimage.gaussian_filter(img, (5, 5), (1, 0))
     # Merge
 
     img_xy = np.hypot(img_x, img_y)
@@ -17,6 +18,7 @@ def edge(img):
 
 
 def correct_drift_deprecated(image1, image2):
+    from scipy.signal import correlate2d as c2d
     x_array = image1.x.values
     y_array = image1.y.values
     index = np.array([x_array.shape[0] / 2 - 1, y_array.shape[0] / 2 - 1])
@@ -27,7 +29,8 @@ def correct_drift_deprecated(image1, image2):
 
 
 # This is much better than the one above
-def moving_amount(image1, image2):
+def moving_amount(image1, image2, plot=True):
+    import cv2
 
     x_array = image1.x.values
     y_array = image1.y.values
@@ -50,6 +53,9 @@ def moving_amount(image1, image2):
 
     move_list = []
 
+    # Running sums of the moves, so the std of the first i + 1 matches costs O(1)
+    move_sum = np.zeros(2)
+    move_square_sum = np.zeros(2)
     best_match_std = 1
     for i, item in enumerate(matches):
         pt2 = np.array([kp2[item.trainIdx].pt[0], kp2[item.trainIdx].pt[1]])
@@ -57,7 +63,10 @@ def moving_amount(image1, image2):
         move = pt2 - pt1
         move[1] = -move[1]  # fix image flipping
         move_list.append(move)
-        match_std = np.array(move_list).std(axis=0).mean()
+        move_sum += move
+        move_square_sum += move ** 2
+        mean = move_sum / (i + 1)
+        match_std = np.sqrt(np.maximum(move_square_sum / (i + 1) - mean ** 2, 0)).mean()
         if i == 0:
             valild_match_num = 1
         elif match_std > best_match_std:
@@ -67,9 +76,150 @@ def moving_amount(image1, image2):
             best_match_std = match_std
 
     move_array = np.array(move_list)[:valild_match_num]
-    out = cv2.drawMatches(image1, kp1, image2, kp2, matches[:valild_match_num], None, flags=2)
-    plt.imshow(out), plt.show()
+    if plot:
+        import matplotlib.pyplot as plt
+        out = cv2.drawMatches(image1, kp1, image2, kp2, matches[:valild_match_num], None, flags=2)
+        plt.imshow(out), plt.show()
     move_index = move_array.mean(axis=0)
     move_index_std = move_array.std(axis=0)
     delta = np.array([(x_array.max() - x_array.min()) / x_array.shape[0], (y_array.max() - y_array.min()) / y_array.shape[0]])
     return delta * move_index, delta * move_index_std
+
+
+def pixel_size(image) -> np.ndarray:
+    # (x, y) spacing of an image DataArray in its coordinate units (nm), signed as the coordinates run
+    return np.array([np.diff(image.x.values).mean(), np.diff(image.y.values).mean()])
+
+
+def image_spectrum(values: np.ndarray, edge_filter: bool = False) -> np.ndarray:
+    # FFT of a frame prepared for phase correlation: optional edge filter, mean removed, Hann window
+    values = np.asarray(values, dtype=float)
+    if edge_filter:
+        values = edge(values)
+    window = np.outer(np.hanning(values.shape[0]), np.hanning(values.shape[1]))
+    return np.fft.fft2((values - values.mean()) * window)
+
+
+def _upsampled_dft(data: np.ndarray, size: int, factor: int, offsets: np.ndarray) -> np.ndarray:
+    # Inverse DFT of data on a size x size grid with spacing 1 / factor pixel around offsets, by matrix products
+    ny, nx = data.shape
+    kernel_x = np.exp(-2j * np.pi / (nx * factor) * np.outer(np.fft.ifftshift(np.arange(nx)) - nx // 2, np.arange(size) - offsets[1]))
+    kernel_y = np.exp(-2j * np.pi / (ny * factor) * np.outer(np.arange(size) - offsets[0], np.fft.ifftshift(np.arange(ny)) - ny // 2))
+    return kernel_y @ data @ kernel_x
+
+
+def phase_correlation(spectrum1: np.ndarray, spectrum2: np.ndarray, upsample: int = 20,
+                      whitening: float = 1.0) -> Tuple[np.ndarray, np.ndarray, float]:
+    # Shift (row, column) in pixels that moves frame 1 onto frame 2, its uncertainty and the correlation peak.
+    # The cross-power spectrum is divided by its magnitude ** whitening: 1 is pure phase correlation, 0 plain
+    # cross-correlation, which is less sensitive to noise on smooth frames. The integer peak is refined to
+    # 1 / upsample pixel by a local upsampled DFT. The uncertainty is the least-squares bound from the
+    # residual of the aligned frames and the gradient energy of frame 1, plus the upsampling step.
+    cross = spectrum2 * spectrum1.conj()
+    if whitening:
+        cross /= np.maximum(np.abs(cross), 1e-30) ** whitening
+    correlation = np.fft.ifft2(cross).real
+    shape = np.array(correlation.shape)
+    peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape))
+    shift = np.where(peak > shape // 2, peak - shape, peak).astype(float)
+    if upsample > 1:
+        size = int(np.ceil(upsample * 1.5))
+        offset = size // 2 - shift * upsample
+        local = _upsampled_dft(cross.conj(), size, upsample, offset).conj().real
+        fine = np.array(np.unravel_index(np.argmax(local), local.shape))
+        shift += (fine - size // 2) / upsample
+    ky = 2 * np.pi * np.fft.fftfreq(shape[0])[:, None]
+    kx = 2 * np.pi * np.fft.fftfreq(shape[1])[None, :]
+    residual = np.sum(np.abs(spectrum2 - spectrum1 * np.exp(-1j * (ky * shift[0] + kx * shift[1]))) ** 2)
+    power = np.abs(spectrum1) ** 2
+    gradient = np.array([np.sum(ky ** 2 * power), np.sum(kx ** 2 * power)])
+    sigma = np.sqrt(residual / (shape.prod() * np.maximum(gradient, 1e-30)) + 1 / (12 * max(upsample, 1) ** 2))
+    return shift, sigma, float(correlation[tuple(peak)] / np.abs(cross).sum())
+
+
+def register(image1, image2, upsample: int = 20, whitening: float = 0.0, edge_filter: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    # (dx, dy) drift of image2 relative to image1 and its uncertainty, in the coordinate units (nm)
+    shift, sigma, _ = phase_correlation(image_spectrum(image1.values, edge_filter), image_spectrum(image2.values, edge_filter), upsample, whitening)
+    size = pixel_size(image1)
+    return shift[::-1] * size, sigma[::-1] * np.abs(size)
+
+
+@dataclasses.dataclass
+class DriftTracker:
+    # Drift of an image series. Each frame is registered once against the previous frame, from cached
+    # spectra (phase correlation) or SIFT descriptors, and the steps are summed into the drift relative to
+    # the first frame. Runs headless; plot() returns a Plotly figure of the result.
+    method: str = 'phase'  # 'phase' or 'sift'
+    upsample: int = 20
+    whitening: float = 0.0  # see phase_correlation
+    edge_filter: bool = False
+    results: List[dict] = dataclasses.field(init=False, default_factory=list)
+    _previous: tuple = dataclasses.field(init=False, default=None, repr=False)
+
+    def _features(self, image):
+        if self.method == 'phase':
+            return image_spectrum(image.values, self.edge_filter)
+        import cv2
+        values = np.asarray(image.values, dtype=float)
+        values = ((values - values.min()) / max(np.ptp(values), 1e-30) * 255).astype(np.uint8)
+        return cv2.SIFT_create().detectAndCompute(values, None)
+
+    def _step(self, previous, current) -> Tuple[np.ndarray, np.ndarray]:
+        # Shift (row, column) in pixels from the previous frame to this one, and its uncertainty
+        if self.method == 'phase':
+            shift, sigma, _ = phase_correlation(previous, current, self.upsample, self.whitening)
+            return shift, sigma
+        import cv2
+        (kp1, des1), (kp2, des2) = previous, current
+        if des1 is None or des2 is None:
+            return np.full(2, np.nan), np.full(2, np.nan)
+        matches = cv2.BFMatcher(crossCheck=True).match(des1, des2)
+        if not matches:
+            return np.full(2, np.nan), np.full(2, np.nan)
+        moves = np.array([np.subtract(kp2[m.trainIdx].pt, kp1[m.queryIdx].pt)[::-1] for m in matches])
+        # Median and robust spread of the matched keypoint moves
+        median = np.median(moves, axis=0)
+        spread = 1.4826 * np.median(np.abs(moves - median), axis=0)
+        return median, np.maximum(spread, 0.5) / np.sqrt(len(moves))
+
+    def add(self, image, index: int = None) -> dict:
+        # Registers image (an xarray image with x and y coordinates in nm) and returns its drift
+        features = self._features(image)
+        size = pixel_size(image)
+        if self._previous is None:
+            drift, sigma = np.zeros(2), np.zeros(2)
+        else:
+            shift, shift_sigma = self._step(self._previous, features)
+            last = self.results[-1]
+            drift = np.array([last['dx'], last['dy']]) + shift[::-1] * size
+            sigma = np.hypot([last['sigma_x'], last['sigma_y']], shift_sigma[::-1] * np.abs(size))
+        self._previous = features
+        result = dict(
+            index=len(self.results) if index is None else index,
+            dx=float(drift[0]),
+            dy=float(drift[1]),
+            sigma_x=float(sigma[0]),
+            sigma_y=float(sigma[1]),
+        )
+        self.results.append(result)
+        return result
+
+    def track(self, images, indices: list = None) -> List[dict]:
+        for i, image in enumerate(images):
+            self.add(image, None if indices is None else indices[i])
+        return self.results
+
+    def plot(self):
+        import plotly.graph_objs as go
+        index = [result['index'] for result in self.results]
+        fig = go.Figure()
+        for axis in ('x', 'y'):
+            fig.add_trace(go.Scatter(
+                x=index,
+                y=[result['d' + axis] for result in self.results],
+                error_y=dict(type='data', array=[result['sigma_' + axis] for result in self.results]),
+                mode='lines+markers',
+                name='d' + axis,
+            ))
+        fig.update_layout(xaxis=dict(title='Frame'), yaxis=dict(title='Drift (nm)'), template='plotly_white')
+        return fig
@@ -0,0 +1,162 @@
+import concurrent.futures
+import copy
+import dataclasses
+from typing import Any, Callable, List
+import json
+import os
+import threading
+import time
+from ..driver import Driver
+
+
+@dataclasses.dataclass
+class Measurement:
+    # Parameters left as None are not sent, so they keep the value of the previous measurement
+    bias: float = None  # (V)
+    setpoint: float = None  # (A)
+    bias_mod: float = None
+    scan_size: float = None
+    line_time: float = None
+    lines_per_frame: int = None
+    x_offset: float = None
+    y_offset: float = None
+    procedure: str = Driver.IMAGE_SCAN_PROCEDURE
+    name: str = ''
+
+
+def render_topo(plotter: 'Plotter', index: int):
+    plotter.display_flag = False
+    return plotter.fig_topo(index)
+
+
+def render_topo_and_didv(plotter: 'Plotter', index: int):
+    plotter.display_flag = False
+    return plotter.fig_topo_and_didv(index)
+
+
+@dataclasses.dataclass
+class Scheduler:
+    # Runs measurements back to back. The analysis of frame N runs in a worker pool while
+    # frame N+1 is being acquired.
+    driver: Driver
+    plotter: 'Plotter' = None
+    measurements: List[Measurement] = dataclasses.field(default_factory=list)
+    queue_file: str = None  # JSON file holding the pending and finished measurements
+    analysis: Callable[['Plotter', int], Any] = render_topo
+    workers: int = 2
+    use_processes: bool = True
+    poll_interval: float = 1.0  # (s)
+    timeout: float = None  # (s) longest wait for one frame
+    done: List[dict] = dataclasses.field(init=False, default_factory=list)
+    futures: dict = dataclasses.field(init=False, default_factory=dict)
+    results: dict = dataclasses.field(init=False, default_factory=dict)
+    thread: threading.Thread = dataclasses.field(init=False, default=None, repr=False)
+
+    def __post_init__(self) -> None:
+        self._resume = threading.Event()
+        self._resume.set()
+        self._stop = False
+        self.measurements = list(self.measurements)
+        return
+
+    @classmethod
+    def from_file(cls, queue_file: str, driver: Driver, plotter: 'Plotter' = None, **kwargs) -> 'Scheduler':
+        # Resume a run from its queue file. An interrupted measurement is still pending and runs again.
+        with open(queue_file) as f:
+            state = json.load(f)
+        scheduler = cls(driver, plotter, [Measurement(**item) for item in state['pending']], queue_file, **kwargs)
+        scheduler.done = state['done']
+        return scheduler
+
+    def save(self) -> None:
+        if self.queue_file is None:
+            return
+        state = dict(pending=[dataclasses.asdict(item) for item in self.measurements], done=self.done)
+        path_tmp = self.queue_file + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(state, f, indent=1)
+        os.replace(path_tmp, self.queue_file)
+        return
+
+    def pause(self) -> None:
+        # Takes effect after the running measurement is finished
+        self._resume.clear()
+        print('Pause')
+        return
+
+    def resume(self) -> None:
+        self._resume.set()
+        print('Resume')
+        return
+
+    def stop(self) -> None:
+        self._stop = True
+        self._resume.set()
+        return
+
+    def apply(self, measurement: Measurement) -> bool:
+        setters = [
+            (self.driver.set_bias, measurement.bias),
+            (self.driver.set_setpoint, measurement.setpoint),
+            (self.driver.set_bias_mod, measurement.bias_mod),
+            (self.driver.set_scan_size, measurement.scan_size),
+            (self.driver.set_line_time, measurement.line_time),
+            (self.driver.set_lines_per_frame, measurement.lines_per_frame),
+            (self.driver.set_x_offset, measurement.x_offset),
+            (self.driver.set_y_offset, measurement.y_offset),
+        ]
+        with self.driver.batch() as batch:
+            for setter, value in setters:
+                if value is not None:
+                    setter(value)
+        return all(reply.ok for reply in batch.replies)
+
+    def acquire(self, measurement: Measurement) -> int:
+        # R9 saves the frame under the file index read before the scan and then increments it
+        if not self.apply(measurement):
+            raise ValueError(f'Parameters not applied: {measurement}')
+        index = int(float(self.driver.get_save_index()))
+        self.driver.start_procedure(measurement.procedure)
+        start = time.monotonic()
+        while int(float(self.driver.get_save_index())) == index:
+            if self.timeout is not None and time.monotonic() - start > self.timeout:
+                self.driver.stop_procedure(measurement.procedure)
+                raise TimeoutError(f'No frame saved for {measurement}')
+            time.sleep(self.poll_interval)
+        return index
+
+    def run(self) -> dict:
+        self._stop = False
+        executor = concurrent.futures.ProcessPoolExecutor if self.use_processes else concurrent.futures.ThreadPoolExecutor
+        with executor(self.workers) as pool:
+            while self.measurements:
+                self._resume.wait()
+                if self._stop:
+                    break
+                measurement = self.measurements[0]
+                try:
+                    index = self.acquire(measurement)
+                except (ValueError, TimeoutError) as e:
+                    print(e)
+                    index = None
+                self.measurements.pop(0)
+                self.done.append(dict(measurement=dataclasses.asdict(measurement), index=index))
+                self.save()
+                if index is not None and self.plotter is not None and self.analysis is not None:
+                    self.futures[index] = pool.submit(self.analysis, copy.copy(self.plotter), index)
+        for index, future in self.futures.items():
+            try:
+                self.results[index] = future.result()
+            except Exception as e:
+                print(f'Analysis of {index} failed: {e}')
+                self.results[index] = e
+        return self.results
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return
+
+    def join(self, timeout: float = None) -> None:
+        self.thread.join(timeout)
+        return
@@ -0,0 +1,191 @@
+import dataclasses
+from typing import List
+import random
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+
+@dataclasses.dataclass
+class Simulator:
+    # Local stand-in for the R9 PC. Answers the R9 text command protocol on a TCP port and
+    # emits UDP packets in the layout of Listener.DATA_FORMAT.
+    IP_Address: str = '127.0.0.1'
+    TCP_Port: int = 0  # 0 picks a free port, stored after start()
+    latency: float = 0.0  # (s) delay before each reply
+    drop_rate: float = 0.0  # probability of closing the connection instead of replying
+    garbage_rate: float = 0.0  # probability of replying a truncated value
+    scan_time: float = 0.0  # (s) a started procedure stays running this long
+    seed: int = None
+    parameters: dict = dataclasses.field(default_factory=dict)
+    status: str = dataclasses.field(init=False, default='Idle')
+    save_index: int = dataclasses.field(init=False, default=0)
+    command_count: int = dataclasses.field(init=False, default=0)
+    fault_count: int = dataclasses.field(init=False, default=0)
+    packet_count: int = dataclasses.field(init=False, default=0)
+    DONE = 'Done'
+    SAVE_PATH = 'C:\\Users\\RHK\\Documents\\R9\\Data\\'
+    SAVE_NAME = 'Sample_'
+    DEFAULT_PARAMETERS = {
+        ('SWParameter', 'STM Bias', 'Value'): '0.1',
+        ('HWSubParameter', 'Z PI Controller', 'Set Point', 'Value'): '1e-10',
+        ('SWParameter', 'Scan Area Window', 'X Offset'): '0',
+        ('SWParameter', 'Scan Area Window', 'Y Offset'): '0',
+        ('SWParameter', 'Scan Area Window', 'Line Time'): '0.1',
+        ('SWParameter', 'Scan Area Window', 'Scan Area Size'): '1e-08',
+        ('SWSubItemParameter', 'Scan Area Window', 'Scan Settings', 'Lines Per Frame'): '256',
+        ('HWSubParameter', 'Drive CH1', 'Oscillation Amplitude', 'Value'): '0.01',
+        ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'Enable'): '1',
+    }
+
+    def __post_init__(self) -> None:
+        self.parameters = {**self.DEFAULT_PARAMETERS, **self.parameters}
+        self._random = random.Random(self.seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._procedure_end = None
+        self._running = False
+
+    def __enter__(self) -> 'Simulator':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.IP_Address, self.TCP_Port))
+        self._server.listen()
+        self.TCP_Port = self._server.getsockname()[1]
+        self._running = True
+        threading.Thread(target=self._serve, daemon=True).start()
+        return
+
+    def stop(self) -> None:
+        self._running = False
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        return
+
+    def _serve(self) -> None:
+        while self._running:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._handle_connection, args=(connection,), daemon=True).start()
+
+    def _handle_connection(self, connection: socket.socket) -> None:
+        pending = b''
+        with connection:
+            while self._running:
+                try:
+                    data = connection.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    return
+                pending += data
+                *lines, pending = pending.split(b'\n')
+                replies = []
+                for line in lines:
+                    if self._random.random() < self.drop_rate:
+                        self.fault_count += 1
+                        return
+                    reply = self.handle(line.decode())
+                    if self._random.random() < self.garbage_rate:
+                        self.fault_count += 1
+                        reply = reply[:len(reply) // 2] + '#'
+                    replies.append(reply + '\n')
+                if self.latency > 0 and replies:
+                    time.sleep(self.latency)
+                try:
+                    connection.sendall(''.join(replies).encode())
+                except OSError:
+                    return
+
+    def _update_status(self) -> None:
+        if self._procedure_end is not None and time.monotonic() >= self._procedure_end:
+            self._procedure_end = None
+            self.status = 'Idle'
+            self.save_index += 1
+        return
+
+    def handle(self, message: str) -> str:
+        fields = [field.strip() for field in message.split(',')]
+        verb = fields[0]
+        with self._lock:
+            self.command_count += 1
+            self._update_status()
+            if verb == 'StartProcedure':
+                self.status = 'Running'
+                self._procedure_end = time.monotonic() + self.scan_time
+                self._update_status()
+                return self.DONE
+            if verb == 'StopProcedure':
+                if self._procedure_end is not None:
+                    self._procedure_end = time.monotonic()
+                    self._update_status()
+                return self.DONE
+            if verb.startswith('Set') and len(fields) > 2:
+                self.parameters[(verb[3:],) + tuple(fields[1:-1])] = fields[-1]
+                return self.DONE
+            if verb.startswith('Get'):
+                path = (verb[3:],) + tuple(fields[1:])
+                if path == ('SWParameter', 'Measure Item', 'Status'):
+                    return self.status
+                if path == ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'File Name Index'):
+                    return str(self.save_index)
+                if path == ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'File Name'):
+                    return self.SAVE_NAME + str(self.save_index).zfill(4) + '.sm4'
+                if path == ('SWSubItemParameter', 'Scan Area Window', 'MeasureSave', 'Save Path'):
+                    return self.SAVE_PATH
+                return self.parameters.get(path, '0')
+        return 'Error'
+
+    @staticmethod
+    def make_packet(timestamp: int, interval: float, gain: float, label: str, unit: str, data: np.ndarray) -> bytes:
+        # Same layout as Listener.DATA_FORMAT; label and unit are UTF-16 with a byte count of 2 per char
+        data = np.ascontiguousarray(data, dtype='<i4')
+        label_bytes = label.encode('utf-16-le')
+        unit_bytes = unit.encode('utf-16-le')
+        body = b''.join([
+            struct.pack('<QffI', timestamp, interval, gain, len(label)),
+            label_bytes,
+            struct.pack('<I', len(unit)),
+            unit_bytes,
+            struct.pack('<I', len(data)),
+            data.tobytes(),
+        ])
+        return struct.pack('<I', len(body) + 4) + body
+
+    def send_packets(self, port: int, count: int, rate: float = 0.0, samples: int = 128, label: str = 'Current',
+                     unit: str = 'A', gain: float = 1e-12, IP_Address: str = None) -> List[bytes]:
+        # Send count packets of random data to port, at rate packets/s (0 sends as fast as possible)
+        rng = np.random.default_rng(self.seed)
+        interval = 1 / rate / samples if rate > 0 else 1e-5
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packets = []
+        start = time.monotonic()
+        # Timestamps in us, contiguous from packet to packet as for an uninterrupted stream
+        timestamp = time.time_ns() // 1000
+        try:
+            for i in range(count):
+                if rate > 0:
+                    wait = start + i / rate - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                data = rng.integers(-2 ** 20, 2 ** 20, samples, dtype=np.int32)
+                packet = self.make_packet(timestamp + round(i * samples * interval * 1e6), interval, gain, label, unit, data)
+                s.sendto(packet, (IP_Address or self.IP_Address, port))
+                packets.append(packet)
+                self.packet_count += 1
+        finally:
+            s.close()
+        return packets
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import contextlib
+import socket
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from ..driver import Driver, AsyncDriver
+from ..listener import Listener
+from . import Simulator
+
+QUERY = 'GetSWParameter, Scan Area Window, X Offset\n'
+IMPORTS = {
+    'import rhk_interface': 'import rhk_interface',
+    'import Driver, Listener': 'from rhk_interface import Driver, Listener',
+    'import Plotter': 'from rhk_interface import Plotter',
+}
+# Run in a fresh interpreter: prints the import time (s) and the peak RSS (MB, nan where resource is missing)
+IMPORT_PROBE = '''
+import time
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+try:
+    import resource, sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+except ImportError:
+    rss = float('nan')
+print(seconds, rss)
+'''
+
+
+def summarize(name: str, latencies: list, elapsed: float, count: int = None) -> dict:
+    latencies = np.asarray(latencies) * 1e3
+    count = len(latencies) if count is None else count
+    return dict(
+        name=name,
+        count=count,
+        rate=count / elapsed if elapsed > 0 else float('nan'),
+        p50=np.percentile(latencies, 50) if len(latencies) else float('nan'),
+        p99=np.percentile(latencies, 99) if len(latencies) else float('nan'),
+    )
+
+
+def bench_driver(simulator: Simulator, count: int, **driver_kwargs) -> dict:
+    driver = Driver(simulator.IP_Address, simulator.TCP_Port, **driver_kwargs)
+    latencies = []
+    start = time.perf_counter()
+    with driver if driver.persistent else contextlib.nullcontext():
+        for _ in range(count):
+            t = time.perf_counter()
+            driver.get_value(QUERY)
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    name = 'persistent' if driver.persistent else 'per-query'
+    result = summarize(f'Driver {name}', latencies, elapsed)
+    result['retries'] = driver.retry_count
+    result['reconnects'] = driver.reconnect_count
+    return result
+
+
+def bench_batch(simulator: Simulator, count: int, size: int = 8) -> dict:
+    latencies = []
+    start = time.perf_counter()
+    with Driver(simulator.IP_Address, simulator.TCP_Port) as driver:
+        for _ in range(count // size):
+            t = time.perf_counter()
+            with driver.batch():
+                for i in range(size):
+                    driver.set_line_time(0.1 + i * 1e-3)
+            latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    return summarize(f'Driver batch of {size}', latencies, elapsed, count=len(latencies) * size)
+
+
+def bench_async(simulator: Simulator, count: int) -> dict:
+    async def run() -> list:
+        latencies = []
+        async with AsyncDriver(simulator.IP_Address, simulator.TCP_Port) as driver:
+            for _ in range(count):
+                t = time.perf_counter()
+                await driver.get_value(QUERY)
+                latencies.append(time.perf_counter() - t)
+        return latencies
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run())
+    return summarize('AsyncDriver', latencies, time.perf_counter() - start)
+
+
+def bench_listener(simulator: Simulator, count: int, port: int, rate: float = 0.0) -> dict:
+    listener = Listener(simulator.IP_Address)
+    listener.TIMEOUT = 1.0
+    latencies = []
+    received = 0
+    sender = threading.Thread(target=simulator.send_packets, args=(port, count), kwargs=dict(rate=rate))
+    start = time.perf_counter()
+    sender.start()
+    while sender.is_alive() or received == 0:
+        t = time.perf_counter()
+        try:
+            listener.fetch_all_value(port)
+        except socket.timeout:
+            break
+        latencies.append(time.perf_counter() - t)
+        received += 1
+        if received >= count:
+            break
+    elapsed = time.perf_counter() - start
+    sender.join()
+    result = summarize('Listener.fetch_all_value', latencies, elapsed)
+    result['lost'] = count - received
+    return result
+
+
+def legacy_decode(listener: Listener, buffer: bytes) -> dict:
+    # The per-field parser Listener used before decode(), kept as the baseline for bench_parse
+    offset = 0
+    result = {}
+    for item, item_format in listener.DATA_FORMAT.items():
+        if listener.length[item] != None:
+            result[item] = np.frombuffer(buffer, dtype=item_format, count=listener.length[item], offset=offset)[0]
+            offset += listener.length[item]
+        elif item in ('label', 'unit'):
+            result[item] = ''.join([char.decode('utf-8') for char in np.frombuffer(buffer, dtype=item_format, count=result[item + '_size'] * 2, offset=offset)])
+            offset += result[item + '_size'] * 2
+        elif item == 'data':
+            result[item] = np.frombuffer(buffer, dtype=item_format, offset=offset)
+    return result
+
+
+def bench_parse(count: int, samples: int = 128) -> list:
+    listener = Listener('127.0.0.1')
+    rng = np.random.default_rng(0)
+    packets = [Simulator.make_packet(i * samples * 10, 1e-5, 1e-12, 'Current', 'A', rng.integers(-2 ** 20, 2 ** 20, samples, dtype=np.int32))
+               for i in range(count)]
+    results = []
+    for name, parse in (('legacy per-field parse', lambda packet: legacy_decode(listener, packet)), ('Listener.decode', listener.decode)):
+        latencies = []
+        start = time.perf_counter()
+        for packet in packets:
+            t = time.perf_counter()
+            parse(packet)
+            latencies.append(time.perf_counter() - t)
+        results.append(summarize(name, latencies, time.perf_counter() - start))
+    start = time.perf_counter()
+    listener.decode_batch(packets)
+    elapsed = time.perf_counter() - start
+    results.append(summarize('Listener.decode_batch', [elapsed / count] * count, elapsed))
+    for result in results[1:]:
+        result['speedup'] = f"{result['rate'] / results[0]['rate']:.1f}x"
+    return results
+
+
+def bench_import(name: str, statement: str, count: int = 5) -> dict:
+    latencies, rss = [], []
+    start = time.perf_counter()
+    for _ in range(count):
+        probe = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(statement=statement)], capture_output=True, text=True)
+        if probe.returncode != 0:
+            # e.g. Plotter without the plot extra; the other benchmarks still run
+            error = probe.stderr.strip().splitlines()[-1] if probe.stderr.strip() else f'exit status {probe.returncode}'
+            result = summarize(name, [], time.perf_counter() - start)
+            result['error'] = 'not installed' if 'ModuleNotFoundError' in error or 'ImportError' in error else error
+            return result
+        seconds, peak = probe.stdout.split()
+        latencies.append(float(seconds))
+        rss.append(float(peak))
+    result = summarize(name, latencies, time.perf_counter() - start)
+    result['rss_mb'] = f'{np.median(rss):.0f}'
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Latency benchmark against the local R9 simulator')
+    parser.add_argument('-n', '--count', type=int, default=200, help='commands or packets per benchmark')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated R9 reply delay (s)')
+    parser.add_argument('--garbage-rate', type=float, default=0.0, help='probability of a truncated reply')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='probability of a dropped connection')
+    parser.add_argument('--udp-port', type=int, default=50001)
+    parser.add_argument('--packet-rate', type=float, default=1000.0, help='UDP packets/s (0 = unthrottled)')
+    parser.add_argument('--imports', type=int, default=5, help='fresh interpreters per import benchmark (0 = skip)')
+    args = parser.parse_args()
+
+    results = []
+    with Simulator(latency=args.latency, garbage_rate=args.garbage_rate, drop_rate=args.drop_rate, seed=0) as simulator:
+        # The per-query driver sleeps 0.2 s per command, so it gets a smaller sample
+        results.append(bench_driver(simulator, max(args.count // 20, 5)))
+        results.append(bench_driver(simulator, args.count, persistent=True))
+        results.append(bench_batch(simulator, args.count))
+        results.append(bench_async(simulator, args.count))
+        results.append(bench_listener(simulator, args.count, args.udp_port, args.packet_rate))
+    results += bench_parse(max(args.count, 1000))
+    if args.imports > 0:
+        results += [bench_import(name, statement, args.imports) for name, statement in IMPORTS.items()]
+
+    print(f"{'benchmark':<28}{'count':>8}{'per s':>12}{'p50 (ms)':>11}{'p99 (ms)':>11}  extra")
+    for result in results:
+        extra = ', '.join(f'{key}={result[key]}' for key in ('retries', 'reconnects', 'lost', 'speedup', 'rss_mb', 'error') if key in result)
+        print(f"{result['name']:<28}{result['count']:>8}{result['rate']:>12.1f}{result['p50']:>11.3f}{result['p99']:>11.3f}  {extra}")
+
+
+if __name__ == '__main__':
+    main()
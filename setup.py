@@ -14,8 +14,15 @@ setuptools.setup(
     ],
     install_requires=[
         "numpy",
-        "xarray",
-        "plotly",
     ],
+    # Driver, Listener and the simulator need numpy only; Plotter and tools need the plot extra
+    extras_require={
+        "plot": ["xarray", "plotly", "spym", "scipy"],
+        "vision": ["opencv-python", "matplotlib"],
+        "grid": ["dask"],
+        "widgets": ["ipywidgets"],
+        "export": ["kaleido"],
+        "all": ["xarray", "plotly", "spym", "scipy", "opencv-python", "matplotlib", "dask", "ipywidgets", "kaleido"],
+    },
     python_requires='>=3',
 )
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import time
+import numpy as np
+from rhk_interface.plotter.cache import FrameCache
+
+
+def make_files(tmp_path, n: int) -> list:
+    paths = []
+    for i in range(n):
+        path = os.path.join(tmp_path, f'T{i:04d}.sm4')
+        with open(path, 'wb') as f:
+            f.write(b'sm4')
+        paths.append(path)
+    return paths
+
+
+def test_evicts_least_recently_used(tmp_path):
+    a, b, c = make_files(tmp_path, 3)
+    cache = FrameCache(max_bytes=2 * 800)
+    cache.put(a, ('load',), np.zeros(100))
+    cache.put(b, ('load',), np.zeros(100))
+    assert cache.get(a, ('load',)) is not None
+    cache.put(c, ('load',), np.zeros(100))
+    assert cache.get(b, ('load',)) is None
+    assert cache.get(a, ('load',)) is not None and cache.get(c, ('load',)) is not None
+    assert len(cache) == 2 and cache.size == 1600
+
+
+def test_value_larger_than_cache_is_not_kept(tmp_path):
+    a, = make_files(tmp_path, 1)
+    cache = FrameCache(max_bytes=100)
+    value = np.zeros(100)
+    assert cache.put(a, ('load',), value) is value
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_rewritten_file_misses(tmp_path):
+    a, = make_files(tmp_path, 1)
+    cache = FrameCache()
+    cache.put(a, ('load',), np.zeros(10))
+    with open(a, 'ab') as f:
+        f.write(b'more')
+    os.utime(a, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    assert cache.get(a, ('load',)) is None
+    assert cache.get(a, ('other',)) is None
+    assert (cache.hits, cache.misses) == (0, 2)
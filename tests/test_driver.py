@@ -0,0 +1,98 @@
+import socket
+import threading
+import time
+import pytest
+from rhk_interface.driver import Driver
+from rhk_interface.simulator import Simulator
+
+
+@pytest.fixture
+def pair():
+    # Driver reading from one end of a socketpair, the test writing R9's replies to the other
+    driver = Driver('127.0.0.1', 0)
+    driver.s, r9 = socket.socketpair()
+    driver.s.settimeout(driver.TIMEOUT)
+    yield driver, r9
+    driver.close()
+    r9.close()
+
+
+def test_terminated_replies(pair):
+    driver, r9 = pair
+    r9.sendall(b'Done\n1.5\r\nIdle\n')
+    assert driver._read_reply() == 'Done'
+    assert driver._read_reply() == '1.5'
+    assert driver._read_reply() == 'Idle'
+    assert driver._buffered == 0
+
+
+def test_split_reply(pair):
+    driver, r9 = pair
+
+    def send() -> None:
+        for part in (b'C:\\Data', b'\\2024\\', b'05\nDone\n'):
+            r9.sendall(part)
+            time.sleep(0.05)
+
+    threading.Thread(target=send).start()
+    assert driver._read_reply() == 'C:\\Data\\2024\\05'
+    assert driver._read_reply() == 'Done'
+
+
+def test_long_reply_grows_buffer(pair):
+    driver, r9 = pair
+    reply = 'x' * (3 * driver.BUFFER_SIZE)
+    threading.Thread(target=r9.sendall, args=((reply + '\n').encode(),)).start()
+    assert driver._read_reply() == reply
+
+
+def test_unterminated_reply_closed(pair):
+    driver, r9 = pair
+    r9.sendall(b'Done')
+    r9.shutdown(socket.SHUT_WR)
+    assert driver._read_reply() == 'Done'
+    with pytest.raises(ConnectionResetError):
+        driver._read_reply()
+
+
+def test_unterminated_reply_times_out(pair):
+    driver, r9 = pair
+    driver.TIMEOUT = 0.2
+    driver.s.settimeout(driver.TIMEOUT)
+    r9.sendall(b'Done')
+    with pytest.raises(socket.timeout):
+        driver._read_reply()
+
+
+def test_unterminated_reply_idle_gap(pair):
+    driver, r9 = pair
+    driver.IDLE_GAP = 0.05
+    r9.sendall(b'Done')
+    start = time.perf_counter()
+    assert driver._read_reply() == 'Done'
+    assert time.perf_counter() - start < driver.TIMEOUT
+
+
+def test_commands_are_terminated():
+    with Simulator() as simulator:
+        with Driver(simulator.IP_Address, simulator.TCP_Port) as driver:
+            driver.set_x_offset(1e-9)
+            assert driver.get_x_offset() == 1e-9
+            assert driver.get_status() == 'Idle'
+
+
+def test_batch_rejects_out_of_range_value():
+    with Simulator() as simulator:
+        driver = Driver(simulator.IP_Address, simulator.TCP_Port)
+        with driver.batch() as batch:
+            driver.set_setpoint(100e-12)
+            driver.set_bias(5)
+        assert [reply.ok for reply in batch.replies] == [False, False]
+        assert batch.replies[1].error == 'Bias range over'
+        assert simulator.command_count == 0
+
+        with driver.batch() as batch:
+            driver.set_setpoint(100e-12)
+            driver.set_bias(0.5)
+        assert [reply.response for reply in batch.replies] == ['Done', 'Done']
+        assert simulator.command_count == 2
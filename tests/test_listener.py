@@ -0,0 +1,106 @@
+import socket
+import numpy as np
+import pytest
+from rhk_interface.listener import Listener
+from rhk_interface.listener.multi import MultiStream
+from rhk_interface.listener.stream import RingBuffer
+from rhk_interface.simulator import Simulator
+
+
+def free_ports(n: int) -> list:
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(n)]
+    for s in sockets:
+        s.bind(('127.0.0.1', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+@pytest.fixture
+def listener():
+    listener = Listener('127.0.0.1')
+    yield listener
+    listener.stop_streams()
+
+
+def test_multi_stream_stop_before_start_and_twice(listener):
+    multi = MultiStream(listener, free_ports(2))
+    multi.stop()
+    multi.start()
+    multi.stop()
+    multi.stop()
+    assert multi.thread is None
+
+
+def test_stop_streams_stops_multi_streams(listener):
+    ports = free_ports(3)
+    multi = listener.multi_stream(ports[:2])
+    listener.stream(ports[2])
+    listener.stop_streams()
+    assert multi.thread is None and listener.multi_streams == []
+    # The ports are free again
+    listener.multi_stream(ports[:2])
+
+
+def test_ring_buffer_wraps():
+    buffer = RingBuffer(10)
+    buffer.append(np.arange(6), 2.0, 0.0, 0.5)
+    buffer.append(np.arange(6, 13), 2.0, 3.0, 0.5)
+    times, values = buffer.window(100.0)
+    np.testing.assert_array_equal(values, 2.0 * np.arange(3, 13))
+    np.testing.assert_array_equal(times, 0.5 * np.arange(3, 13))
+    assert buffer.latest() == (6.0, 24.0)
+    assert buffer.mean(1.0) == pytest.approx(2.0 * 11)
+
+
+def test_ring_buffer_block_larger_than_capacity():
+    buffer = RingBuffer(4)
+    buffer.append(np.arange(10), 1.0, 0.0, 1.0)
+    times, values = buffer.window(100.0)
+    np.testing.assert_array_equal(values, [6, 7, 8, 9])
+    np.testing.assert_array_equal(times, [6, 7, 8, 9])
+
+
+def test_ring_buffer_empty():
+    buffer = RingBuffer(4)
+    assert buffer.latest() is None
+    assert len(buffer.window(1.0)[1]) == 0
+    assert np.isnan(buffer.mean(1.0))
+
+
+def test_decode(listener):
+    data = np.array([1, -2, 3, 2 ** 31 - 1], dtype='<i4')
+    packet = Simulator.make_packet(123456789, 1e-5, 1e-12, 'Current', 'A', data)
+    result, offset = listener.decode(packet)
+    assert (result['timestamp'], result['label'], result['unit'], result['data_size']) == (123456789, 'Current', 'A', 4)
+    assert result['interval'] == pytest.approx(1e-5)
+    assert result['gain'] == pytest.approx(1e-12)
+    assert result['packet_len'] == len(packet)
+    np.testing.assert_array_equal(result['data'], data)
+    assert offset == len(packet) - data.nbytes
+
+
+def test_decode_batch_same_layout(listener):
+    rng = np.random.default_rng(0)
+    data = rng.integers(-1000, 1000, (5, 16))
+    packets = [Simulator.make_packet(1000 + 16 * i, 1e-6, 2.0, 'Z', 'm', row) for i, row in enumerate(data)]
+    columns = listener.decode_batch(packets)
+    np.testing.assert_array_equal(columns['data'], data)
+    np.testing.assert_array_equal(columns['timestamp'], 1000 + 16 * np.arange(5))
+    np.testing.assert_array_equal(columns['offsets'], 16 * np.arange(6))
+    assert (columns['label'], columns['unit']) == ('Z', 'm')
+
+
+def test_decode_batch_mixed_layout(listener):
+    rows = [np.arange(3), np.arange(5), np.arange(2)]
+    packets = [Simulator.make_packet(i, 1e-6, 1.0, 'Z', 'm', row) for i, row in enumerate(rows)]
+    columns = listener.decode_batch(packets)
+    for i, row in enumerate(rows):
+        np.testing.assert_array_equal(columns['data'][columns['offsets'][i]:columns['offsets'][i + 1]], row)
+    np.testing.assert_array_equal(columns['data_size'], [3, 5, 2])
+
+
+def test_decode_batch_empty(listener):
+    columns = listener.decode_batch([])
+    assert len(columns['data']) == 0 and columns['label'] is None
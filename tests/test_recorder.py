@@ -0,0 +1,40 @@
+import os
+import numpy as np
+from rhk_interface.listener import Listener
+from rhk_interface.listener.recorder import Recorder, Recording, segment_name
+from rhk_interface.simulator import Simulator
+
+
+def packets(n: int, first: int = 0) -> list:
+    return [Simulator.make_packet(1000 * (first + i), 1e-6, 1.0, 'Z', 'm', np.full(8, first + i)) for i in range(n)]
+
+
+def test_round_trip(tmp_path):
+    with Recorder(str(tmp_path), segment_size=500) as recorder:
+        for packet in packets(10):
+            recorder.write(packet)
+    recording = Recording(str(tmp_path))
+    assert len(recording.catalogue) > 1
+    assert [bytes(packet) for packet in recording.packets()] == packets(10)
+    assert [bytes(packet) for packet in recording.packets(3e-3, 6e-3)] == packets(10)[3:6]
+
+
+def test_recovers_segment_left_by_a_crash(tmp_path):
+    recorder = Recorder(str(tmp_path))
+    for packet in packets(3):
+        recorder.write(packet)
+    recorder.flush()
+    for packet in packets(4, first=3):
+        recorder.write(packet)
+    # Crash: the last packet is cut short and the segment is never indexed
+    recorder._file.write(packets(1, first=7)[0][:20])
+    recorder._file.close()
+    path_bin = os.path.join(tmp_path, segment_name(1) + '.bin')
+    assert not os.path.exists(os.path.join(tmp_path, segment_name(1) + '.idx.npy'))
+
+    recorder = Recorder(str(tmp_path))
+    assert recorder.segment == 2
+    assert os.path.getsize(path_bin) == sum(len(packet) for packet in packets(4))
+    assert [bytes(packet) for packet in Recording(str(tmp_path)).packets()] == packets(7)
+    columns = Recording(str(tmp_path)).samples(Listener('127.0.0.1'))
+    np.testing.assert_array_equal(columns['data'][:, 0], np.arange(7))
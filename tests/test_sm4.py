@@ -0,0 +1,62 @@
+import os
+import numpy as np
+import pytest
+from rhk_interface.plotter import sm4
+
+rhksm4 = pytest.importorskip('spym.io.rhksm4')
+
+PATH = os.path.join(os.path.dirname(__file__), 'data', 'sample.sm4')
+# Attrs spym adds that Plotter does not use: enum names of the header fields, the PRM file text.
+# spym reads only the first word of the page ID, sm4 keeps all 8.
+IGNORED = {'RHK_PageTypeName', 'RHK_PageDataTypeName', 'RHK_PageSourceTypeName', 'RHK_LineTypeName',
+           'RHK_ImageTypeName', 'RHK_ScanTypeName', 'RHK_SpecDrift_DriftOptionTypeName', 'RHK_PRMdata',
+           'RHK_PageID'}
+
+
+@pytest.fixture(scope='module')
+def pages():
+    # spym.load builds its Dataset from these DataArrays
+    return rhksm4.to_dataset(PATH)
+
+
+def test_channels(pages):
+    assert sm4.SM4File(PATH).channels == list(pages.data_vars)
+
+
+@pytest.mark.parametrize('label', ['Topography_Forward', 'Topography_Backward', 'LIA_Current_Forward', 'LIA_Current_Spec'])
+def test_data_matches_spym(pages, label):
+    expected = pages[label]
+    page = sm4.SM4File(PATH)[label]
+    if page.attrs['interpretation'] == 'spectrum':
+        # spym keeps one spectrum per column
+        expected = expected.T
+        np.testing.assert_allclose(page.x, expected[expected.dims[1]], rtol=1e-6)
+    else:
+        # Lateral coordinates are in nm, as Plotter's axes
+        for axis, dim in zip(('y', 'x'), expected.dims):
+            np.testing.assert_allclose(page[axis], np.abs(expected[dim]) * 1e9, rtol=1e-6)
+    np.testing.assert_allclose(page.values, expected.values, rtol=1e-6, atol=0)
+
+
+@pytest.mark.parametrize('label', ['Topography_Forward', 'Topography_Backward', 'LIA_Current_Forward', 'LIA_Current_Spec'])
+def test_attrs_match_spym(pages, label):
+    expected = pages[label].attrs
+    attrs = sm4.SM4File(PATH)[label].attrs
+    assert set(expected) - IGNORED <= set(attrs)
+    for key in set(expected) - IGNORED:
+        assert np.array_equal(np.asarray(attrs[key]), np.asarray(expected[key])), key
+
+
+def test_plotter_attrs():
+    spec = sm4.SM4File(PATH)['LIA_Current_Spec']
+    assert spec.attrs['bias_modulation'] == 0.02
+    assert spec.attrs['bias_modulation_units'] == 'V'
+    assert spec.x.attrs['long_name'] == 'Bias'
+    assert len(spec.attrs['RHK_SpecDrift_Xcoord']) == spec.sizes['y']
+
+
+def test_lazy_load_decodes_on_access():
+    images, lines = sm4.load(PATH)
+    assert images.nbytes == 0
+    images.Topography_Forward
+    assert images.nbytes == 16 * 16 * 8
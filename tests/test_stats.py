@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+from rhk_interface.listener.stats import CIC, EMA, RunningStats
+
+
+def feed(operator, values: np.ndarray, seed: int = 0) -> None:
+    # values split into blocks of random sizes, 1 ms per sample
+    rng = np.random.default_rng(seed)
+    i = 0
+    while i < len(values):
+        n = int(rng.integers(1, 500))
+        operator.update(values[i:i + n], i * 1e-3, 1e-3)
+        i += n
+    return
+
+
+@pytest.mark.parametrize('factor, order', [(8, 3), (5, 1), (16, 4)])
+def test_cic_matches_whole_stream_filter(factor, order):
+    values = np.random.default_rng(1).normal(size=20011)
+    cic = CIC(factor, order)
+    feed(cic, values)
+    expected = np.convolve(values, cic._kernel, mode='valid')[::factor]
+    assert cic.output.count == len(expected)
+    np.testing.assert_allclose(cic.output.values[:len(expected)], expected)
+
+
+def test_running_stats_snapshot():
+    values = np.random.default_rng(2).normal(3.0, 2.0, size=10007)
+    stats = RunningStats()
+    feed(stats, values)
+    snapshot = stats.snapshot()
+    assert snapshot['count'] == len(values)
+    assert snapshot['mean'] == pytest.approx(values.mean())
+    assert snapshot['std'] == pytest.approx(values.std(ddof=1))
+    assert (snapshot['min'], snapshot['max']) == (values.min(), values.max())
+
+
+def test_ema_settles_on_constant():
+    ema = EMA(tau=0.01)
+    feed(ema, np.full(2000, 5.0))
+    time, value = ema.snapshot()
+    assert value == pytest.approx(5.0)
+    assert time == pytest.approx(1.999)